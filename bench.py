@@ -0,0 +1,428 @@
+#!/usr/bin/python3
+
+"""Benchmark the BASIC interpreters from every chapter, and Tinycat BASIC.
+
+Each workload is a small BASIC program together with the same program
+written in plain Python. Every interpreter runs the workloads it has the
+statements for, a few times after a warmup; the report gives the median
+and 95th percentile time of each, and how many times slower that is than
+the Python version. The last number every workload prints is checked
+against the Python version, so an interpreter that stops on an error
+can't pass for a fast one. Tinycat prints six significant digits, so
+the check allows for that much rounding.
+
+Results can be saved as JSON, and compared with a previous run: any
+median that got slower than the baseline by more than the threshold
+counts as a regression, and makes the exit status nonzero.
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import io
+import json
+import math
+import os
+import platform
+import statistics
+import sys
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, "tinycat-basic"))
+
+import basic
+
+def arithmetic():
+	lines = ["10 let a = 1"]
+	for i in range(300):
+		lines.append("{} let a = a / 2 + a * {} / 3".format(20 + i, i % 7 + 1))
+	lines.append("{} print a".format(20 + 300))
+	native = "a = 1\n"
+	for i in range(300):
+		native += "a = a / 2 + a * {} / 3\n".format(i % 7 + 1)
+	native += "print(a)\n"
+	return lines, native
+
+def goto_loop():
+	lines = [
+		"10 let a = 1",
+		"20 let i = 0",
+		"30 let i = i + 1",
+		"40 let a = a / 2 + i / 3",
+		"50 if i < 3000 then goto 30",
+		"60 print a"]
+	native = """
+a = 1
+i = 0
+while True:
+	i = i + 1
+	a = a / 2 + i / 3
+	if not i < 3000: break
+print(a)
+"""
+	return lines, native
+
+def gosub():
+	lines = [
+		"10 let i = 0",
+		"20 let s = 0",
+		"30 gosub 100",
+		"40 if i < 2000 then goto 30",
+		"50 print s",
+		"60 end",
+		"100 let i = i + 1",
+		"110 let s = s + i * 2",
+		"120 return"]
+	native = """
+def sub():
+	global i, s
+	i = i + 1
+	s = s + i * 2
+i = 0
+s = 0
+while True:
+	sub()
+	if not i < 2000: break
+print(s)
+"""
+	return lines, native
+
+def for_loop():
+	lines = [
+		"10 let a = 1",
+		"20 for i = 1 to 3000",
+		"30 let a = a / 2 + i / 3",
+		"40 next i",
+		"50 print a"]
+	native = """
+a = 1
+for i in range(1, 3001):
+	a = a / 2 + i / 3
+print(a)
+"""
+	return lines, native
+
+def empty_for():
+	lines = [
+		"10 for i = 1 to 20000",
+		"20 next i",
+		"30 print i"]
+	native = """
+for i in range(1, 20001):
+	pass
+print(i + 1)
+"""
+	return lines, native
+
+def user_fn():
+	lines = [
+		"10 def fn f(x) = x * x / 2 + 1",
+		"20 let s = 0",
+		"30 for i = 1 to 2000",
+		"40 let s = s + f(i)",
+		"50 next i",
+		"60 print s"]
+	native = """
+def f(x):
+	return x * x / 2 + 1
+s = 0
+for i in range(1, 2001):
+	s = s + f(i)
+print(s)
+"""
+	return lines, native
+
+def benchmark1():
+	"""The loop-and-math benchmark that ships with the chapters, read from
+	benchmark1.bas and benchmark1.py. Both time themselves and print the
+	result last; that is the harness's job here, so those lines go."""
+	lines = []
+	with open(os.path.join(here, "benchmark1.bas"), "r") as f:
+		for i in f:
+			number, text = i.split(None, 1)
+			if "timer" in text or "finish" in text:
+				continue
+			lines.append(number + " " + text.strip())
+	native = ""
+	with open(os.path.join(here, "benchmark1.py"), "r") as f:
+		for i in f:
+			if "time" not in i and "finish" not in i:
+				native += i
+	return lines, native
+
+# Name, statements it needs, and the function making its sources
+workloads = [
+	("arithmetic", {"let", "print"}, arithmetic),
+	("goto-loop", {"program", "if", "goto"}, goto_loop),
+	("gosub", {"program", "if", "goto", "gosub"}, gosub),
+	("for-loop", {"program", "for"}, for_loop),
+	("empty-for", {"program", "for"}, empty_for),
+	("user-fn", {"program", "for", "def"}, user_fn),
+	("benchmark1", {"program", "for", "rem"}, benchmark1),
+]
+
+class Chapter(object):
+	"""One of the chapter interpreters, loaded into a private namespace.
+
+	The chapters run their command loop at import time, so they get a
+	single BYE for input. Those with stored programs take the workload as
+	numbered lines and run it; the earlier ones execute it line by line
+	in immediate mode.
+	"""
+	def __init__(self, path):
+		with open(path, "r") as f:
+			code = compile(f.read(), path, "exec")
+		self.ns = {"__name__": "chapter"}
+		saved = sys.stdin, sys.stdout
+		sys.stdin = io.StringIO("bye\n")
+		sys.stdout = io.StringIO()
+		try:
+			exec(code, self.ns)
+		finally:
+			sys.stdin, sys.stdout = saved
+		self.lines = None
+
+	def load(self, lines):
+		if "program" in self.ns:
+			self.lines = lines
+		else:
+			self.lines = [i.split(" ", 1)[1] for i in lines]
+
+	def run(self):
+		ns = self.ns
+		ns["variables"].clear()
+		if "function_code" in ns:
+			# Chapter 8 can't clear these itself on a second RUN
+			ns["function_code"].clear()
+			ns["function_args"].clear()
+		if "program" in ns:
+			ns["program"].clear()
+			for i in self.lines:
+				ns["line"] = i
+				ns["cursor"] = 0
+				ns["parse_line"]()
+			ns["run_program"]()
+		else:
+			execute = ns.get("parse_block", ns["parse_statement"])
+			for i in self.lines:
+				ns["line"] = i
+				ns["cursor"] = 0
+				execute()
+
+class Tinycat(object):
+	def __init__(self, engine):
+		self.fast = engine == "fast"
+		if self.fast:
+			engine = "classic"
+		self.interpreter = basic.Interpreter(
+			stdout=sys.stdout, engine=engine)
+		self.lines = None
+
+	def load(self, lines):
+		self.lines = lines
+
+	def run(self):
+		interpreter = self.interpreter
+		interpreter.stdout = sys.stdout
+		interpreter.new_program()
+		interpreter.variables.clear()
+		interpreter.load_lines(self.lines)
+		if self.fast:
+			interpreter.run_fast()
+		else:
+			interpreter.run_program()
+
+class Native(object):
+	def __init__(self):
+		self.code = None
+
+	def load(self, source):
+		self.code = compile(source, "<native>", "exec")
+
+	def run(self):
+		exec(self.code, {})
+
+chapter_features = {
+	"chapter3": {"let", "print"},
+	"chapter4": {"let", "print", "if", "rem"},
+	"chapter5": {"let", "print", "if", "rem", "program", "goto", "gosub"},
+	"chapter6": {"let", "print", "if", "rem", "program", "goto", "gosub"},
+	"chapter7": {"let", "print", "if", "rem", "program", "goto", "gosub",
+		"for"},
+	"chapter8": {"let", "print", "if", "rem", "program", "goto", "gosub",
+		"for", "def"},
+}
+tinycat_features = chapter_features["chapter8"]
+
+def interpreters(names=None):
+	"""Return a list of (name, features, factory) for the interpreters."""
+	found = []
+	for i in sorted(chapter_features):
+		path = os.path.join(here, i + ".py")
+		found.append((i, chapter_features[i],
+			lambda path=path: Chapter(path)))
+	found.append(("tinycat", tinycat_features,
+		lambda: Tinycat("classic")))
+	found.append(("tinycat-closures", tinycat_features,
+		lambda: Tinycat("closures")))
+	found.append(("tinycat-bytecode", tinycat_features,
+		lambda: Tinycat("bytecode")))
+	found.append(("tinycat-tracing", tinycat_features,
+		lambda: Tinycat("tracing")))
+	found.append(("tinycat-fast", tinycat_features,
+		lambda: Tinycat("fast")))
+	if names:
+		found = [i for i in found if i[0] in names]
+	return found
+
+def percentile(times, fraction):
+	ordered = sorted(times)
+	rank = int(math.ceil(fraction * len(ordered))) - 1
+	return ordered[min(max(rank, 0), len(ordered) - 1)]
+
+def last_number(text):
+	for i in reversed(text.split()):
+		try:
+			return float(i)
+		except ValueError:
+			pass
+	return None
+
+def measure(runner, warmup, iterations):
+	"""Time the runner; return the list of times, and the output of the
+	first run."""
+	saved = sys.stdout
+	output = io.StringIO()
+	sys.stdout = output
+	try:
+		runner.run()
+		first = output.getvalue()
+		for i in range(warmup):
+			runner.run()
+		times = []
+		for i in range(iterations):
+			sys.stdout = io.StringIO()
+			mark = time.perf_counter()
+			runner.run()
+			times.append(time.perf_counter() - mark)
+	finally:
+		sys.stdout = saved
+	return times, first
+
+def summarize(times):
+	return {
+		"median": statistics.median(times),
+		"p95": percentile(times, 0.95),
+		"runs": times,
+	}
+
+def run_benchmarks(names=None, only=None, warmup=1, iterations=5,
+		progress=None):
+	"""Run the benchmarks; return a dict of results per workload."""
+	results = {}
+	found = interpreters(names)
+	for name, needs, make in workloads:
+		if only and name not in only:
+			continue
+		lines, source = make()
+		native = Native()
+		native.load(source)
+		times, output = measure(native, warmup, iterations)
+		expected = last_number(output)
+		entry = {"native": summarize(times), "interpreters": {}}
+		base = entry["native"]["median"]
+		for i, features, factory in found:
+			if not needs <= features:
+				continue
+			runner = factory()
+			runner.load(lines)
+			times, output = measure(runner, warmup, iterations)
+			stats = summarize(times)
+			stats["ratio"] = stats["median"] / base if base > 0 else 0
+			got = last_number(output)
+			stats["ok"] = got is not None and math.isclose(
+				got, expected, rel_tol=1e-5)
+			entry["interpreters"][i] = stats
+			if progress:
+				progress(name, i, stats)
+		results[name] = entry
+	return results
+
+def compare(results, baseline, threshold):
+	"""Return a list of (workload, interpreter, old, new) for every
+	median that got slower than the baseline by more than threshold."""
+	slower = []
+	for name, entry in results.items():
+		if name not in baseline:
+			continue
+		old = baseline[name]["interpreters"]
+		for i, stats in entry["interpreters"].items():
+			if i not in old:
+				continue
+			before = old[i]["median"]
+			after = stats["median"]
+			if after > before * (1 + threshold):
+				slower.append((name, i, before, after))
+	return slower
+
+def show(name, interpreter, stats):
+	print("{:<12} {:<18} {:10.6f}s {:10.6f}s {:9.1f}x{}".format(
+		name, interpreter, stats["median"], stats["p95"], stats["ratio"],
+		"" if stats["ok"] else "  WRONG OUTPUT"))
+
+if __name__ == "__main__":
+	import argparse
+	cmdline = argparse.ArgumentParser(
+		description="Benchmark the BASIC interpreters against Python.")
+	cmdline.add_argument("-i", "--interpreter", action="append",
+		help="only run this interpreter (may be repeated)")
+	cmdline.add_argument("-w", "--workload", action="append",
+		help="only run this workload (may be repeated)")
+	cmdline.add_argument("-n", "--iterations", type=int, default=5,
+		help="timed runs of each benchmark (default: %(default)s)")
+	cmdline.add_argument("--warmup", type=int, default=1,
+		help="untimed runs first (default: %(default)s)")
+	cmdline.add_argument("-o", "--json",
+		help="save the results as JSON in this file")
+	cmdline.add_argument("-b", "--baseline",
+		help="compare with results saved by an earlier run")
+	cmdline.add_argument("-t", "--threshold", type=float, default=0.25,
+		help="slowdown that counts as a regression (default: %(default)s)")
+	options = cmdline.parse_args()
+
+	print("{:<12} {:<18} {:>11} {:>11} {:>10}".format(
+		"workload", "interpreter", "median", "p95", "vs Python"))
+	results = run_benchmarks(
+		options.interpreter,
+		options.workload,
+		options.warmup,
+		max(1, options.iterations),
+		show)
+	failed = False
+	for entry in results.values():
+		for stats in entry["interpreters"].values():
+			if not stats["ok"]:
+				failed = True
+	if options.json:
+		with open(options.json, "w") as f:
+			json.dump({
+				"python": platform.python_version(),
+				"machine": platform.machine(),
+				"warmup": options.warmup,
+				"iterations": options.iterations,
+				"workloads": results,
+			}, f, indent=1)
+	if options.baseline:
+		with open(options.baseline, "r") as f:
+			baseline = json.load(f)["workloads"]
+		slower = compare(results, baseline, options.threshold)
+		for name, i, before, after in slower:
+			print("Regression: {} on {}: {:.6f}s -> {:.6f}s ({:+.0%})".format(
+				i, name, before, after, after / before - 1))
+		if slower:
+			failed = True
+		else:
+			print("No regressions over {:.0%}.".format(options.threshold))
+	if failed:
+		sys.exit(1)
@@ -1,660 +1,1738 @@
 #!/usr/bin/python3
 
-"""Embeddable line-number Basic interpreter in under 1000 lines of Python."""
+"""Embeddable line-number Basic interpreter, with engines that compile programs
+to closures, bytecode or Python."""
 
 from __future__ import division
 from __future__ import print_function
 
+import bisect
+import collections.abc
+import io
+import json
 import math
+import operator
 import random
+import sys
 import time
 
+import bytecode
+import cache
+import cfg
+import compiler
+import transpiler
+import tracing
+
 try:
 	import readline
 except ImportError as e:
 	print("(Command line editing is unavailable.)\n")
 
-line = ""
-cursor = 0 # Index of current reading position
-token = None # The last token matched, if any
+# Each token is a tuple of (kind, text, value, column). Names are lowercased,
+# strings keep their double quotes in the text and lose them in the value,
+# numbers are parsed to a float value once. Every list ends in an "eol" token,
+# so matchers never have to check bounds. An interpreter then fills in the
+# value of each name with the slot of its variable (see Variables).
 
-def skip_whitespace():
-	global cursor
-	while cursor < len(line) and line[cursor].isspace():
-		cursor += 1
+relations = ("=", "<>", "<=", ">=", "<", ">")
+relation_ops = {
+	"=": operator.eq, "<>": operator.ne, "<=": operator.le,
+	">=": operator.ge, "<": operator.lt, ">": operator.gt,
+}
+# Words that can be glued to a number, as in GOTO50 or FOR I=1TO3; the old
+# parser matched keywords as a run of letters only, so keep splitting them.
+keywords = frozenset((
+	"let", "print", "input", "if", "then", "goto", "gosub", "return",
+	"end", "stop", "do", "loop", "while", "until", "for", "to", "step",
+	"next", "def", "fn", "rem", "randomize", "and", "or", "not",
+	"list", "run", "new", "save", "load",
+))
+
+def tokenize(text):
+	result = []
+	i = 0
+	n = len(text)
+	while i < n:
+		c = text[i]
+		if c.isspace():
+			i += 1
+			continue
+		mark = i
+		if c.isdigit():
+			while i < n and text[i].isdigit():
+				i += 1
+			if i < n and text[i] == ".":
+				i += 1
+				while i < n and text[i].isdigit():
+					i += 1
+			result.append(("number", text[mark:i], float(text[mark:i]), mark))
+		elif c.isalpha():
+			while i < n and text[i].isalpha():
+				i += 1
+			if text[mark:i].lower() not in keywords:
+				while i < n and text[i].isalnum():
+					i += 1
+			result.append(("name", text[mark:i].lower(), None, mark))
+		elif c == '"':
+			i = text.find('"', mark + 1)
+			if i < 0:
+				# Only an error if some statement tries to read it.
+				result.append(("error", text[mark:], "Unclosed string", mark))
+				break
+			i += 1
+			result.append(("string", text[mark:i], text[mark + 1:i - 1], mark))
+		elif text.startswith(("<>", "<=", ">="), i):
+			i += 2
+			result.append(("op", text[mark:i], None, mark))
+		else:
+			i += 1
+			result.append(("op", c, None, mark))
+	result.append(("eol", "", None, n))
+	return result
 
-def match_keyword():
-	global cursor, token
-	
-	#skip_whitespace()
-	if cursor >= len(line) or not line[cursor].isalpha():
-		return False
-		
-	mark = cursor
-	while cursor < len(line) and line[cursor].isalpha():
-		cursor += 1
-	token = line[mark:cursor]
-	return True
-
-def match_number():
-	global cursor, token
-	
-	skip_whitespace()
-	if cursor >= len(line) or not line[cursor].isdigit():
-		return False
-		
-	mark = cursor
-	while cursor < len(line) and line[cursor].isdigit():
-		cursor += 1
-	if cursor < len(line) and line[cursor] == ".":
-		cursor += 1
-		while cursor < len(line) and line[cursor].isdigit():
-			cursor += 1
-	token = line[mark:cursor]
-	return True
-
-def match_varname():
-	global cursor, token
-	
-	skip_whitespace()
-	if cursor >= len(line) or not line[cursor].isalpha():
-		return False
-		
-	mark = cursor
-	while cursor < len(line) and line[cursor].isalnum():
-		cursor += 1
-	token = line[mark:cursor]
-	return True
-
-def match_string():
-	global cursor, token
-	
-	skip_whitespace()
-	if cursor >= len(line) or line[cursor] != '"':
+
+def scan_lines(source):
+	"""Split a saved program into (line number, text, tokens) for each line,
+	the way LOAD would store them; return None if some line isn't numbered
+	and so would run right away instead."""
+	lines = []
+	for i in source.splitlines():
+		i = i.strip()
+		tokens = tokenize(i)
+		t = tokens[0]
+		if t[0] != "number" or not t[1].isdigit():
+			return None
+		text = i[tokens[1][3]:]
+		lines.append((int(t[1]), text, tokenize(text)))
+	return lines
+
+version = "1.1"
+
+# Keys the program cache: tokens change with the tokenizer, not the version.
+cache_key = "{}-{}".format(version,
+	cache.fingerprint(tokenize, scan_lines, sorted(keywords)))
+
+engines = ("classic", "closures", "bytecode", "tracing")
+
+class ForFrame(object):
+	"""A FOR loop in progress."""
+
+	__slots__ = (
+		"line", # Index of the FOR line in addr; the body starts after it
+		"slot", # Slot of the loop variable
+		"limit",
+		"step",
+	)
+
+	def __init__(self, line, slot, limit, step):
+		self.line = line
+		self.slot = slot
+		self.limit = limit
+		self.step = step
+
+def loop_statement(tokens):
+	"""Return the keyword and variable name of a FOR or NEXT statement,
+	even after IF ... THEN, or (None, None) for anything else."""
+	i = 0
+	if tokens[0][1] == "if":
+		for j in range(len(tokens)):
+			if tokens[j][0] == "name" and tokens[j][1] == "then":
+				i = j + 1
+				break
+	t = tokens[i]
+	if t[0] == "name" and t[1] in ("for", "next"):
+		if tokens[i + 1][0] == "name":
+			return t[1], tokens[i + 1][1]
+	return None, None
+
+def flow_statement(tokens):
+	"""Return whether a line's statement depends on an IF, its keyword
+	(after any IF ... THEN), and the line number a GOTO or GOSUB goes to,
+	or None if it's worked out at run time."""
+	i = 0
+	if tokens[0][1] == "if":
+		for j in range(len(tokens) - 1, 0, -1):
+			if tokens[j][0] == "name" and tokens[j][1] == "then":
+				i = j + 1
+				break
+	if tokens[i][0] != "name":
+		return i > 0, None, None
+	keyword = tokens[i][1]
+	target = None
+	if keyword in ("goto", "gosub") and tokens[i + 1][0] == "number" \
+			and tokens[i + 2][0] == "eol":
+		target = int(tokens[i + 1][2])
+	return i > 0, keyword, target
+
+# Lines of a few common shapes run fused in the classic engine: instead of
+# going through the statement parser, each runs as one operation with its
+# variable slots, constants and jump target worked out beforehand. The
+# shape of a line is found when it's stored; its targets when it runs.
+# A jump goes straight past REM lines, and through any plain GOTOs it
+# would land on, to the line that does something; a REM line the program
+# runs into sends it past the whole run of them at once.
+
+fused_forms = ("if-goto", "let-add", "let-sub", "goto", "next", "rem")
+
+def operand(t):
+	"""Return (slot, name) for a variable token, (None, value) for a
+	number token, or None for anything else."""
+	if t[0] == "number":
+		return None, t[2]
+	elif t[0] == "name" and t[1] not in ("not", "and", "or"):
+		return t[2], t[1]
+	return None
+
+def line_shape(tokens):
+	"""Return a tuple describing a line that can run fused, starting with
+	its form and keyword, or None:
+
+		("if-goto", "if", left, relation, right, then, line)
+		("let-add" | "let-sub", "let", slot, name, operand)
+		("goto", "goto", line)
+		("next", "next", slot, name)
+		("rem", "rem")
+
+	Left and right are operands, or None if the condition is more than a
+	single comparison; then is the index of the THEN token.
+	"""
+	kw = tokens[0][1] if tokens[0][0] == "name" else None
+	n = len(tokens)
+	if kw == "goto":
+		if n == 3 and tokens[1][0] == "number":
+			return ("goto", kw, int(tokens[1][2]))
+	elif kw == "let":
+		if n == 7 and tokens[1][0] == "name" and tokens[2][1] == "=" \
+				and tokens[3][1] == tokens[1][1] \
+				and tokens[4][1] in ("+", "-") and operand(tokens[3]) \
+				and operand(tokens[5]):
+			form = "let-add" if tokens[4][1] == "+" else "let-sub"
+			return (form, kw, tokens[1][2], tokens[1][1], operand(tokens[5]))
+	elif kw == "next":
+		if n == 3 and tokens[1][0] == "name":
+			return ("next", kw, tokens[1][2], tokens[1][1])
+	elif kw == "rem":
+		return ("rem", kw)
+	elif kw == "if":
+		then = n - 4
+		if then > 1 and tokens[then][1] == "then" \
+				and tokens[then + 1][1] == "goto" \
+				and tokens[then + 2][0] == "number":
+			line_num = int(tokens[then + 2][2])
+			if then == 4 and tokens[2][1] in relations \
+					and operand(tokens[1]) and operand(tokens[3]):
+				return ("if-goto", kw, operand(tokens[1]), tokens[2][1],
+					operand(tokens[3]), then, line_num)
+			return ("if-goto", kw, None, None, None, then, line_num)
+	return None
+
+class Variables(collections.abc.MutableMapping):
+	"""Variable values in a flat list, with a dictionary view by name.
+
+	Each name gets a slot in the list the first time it's seen, and keeps
+	it; names in stored lines are resolved when the line is tokenized, so
+	running code can go straight to the slot. Unset variables hold None.
+	"""
+
+	__slots__ = ("slots", "values")
+
+	def __init__(self):
+		self.slots = {}
+		self.values = []
+
+	def slot(self, name):
+		try:
+			return self.slots[name]
+		except KeyError:
+			self.slots[name] = len(self.values)
+			self.values.append(None)
+			return self.slots[name]
+
+	def __getitem__(self, name):
+		value = self.values[self.slots[name]]
+		if value is None:
+			raise KeyError(name)
+		return value
+
+	def __setitem__(self, name, value):
+		self.values[self.slot(name)] = value
+
+	def __delitem__(self, name):
+		if name not in self:
+			raise KeyError(name)
+		self.values[self.slots[name]] = None
+
+	def __contains__(self, name):
+		return name in self.slots and self.values[self.slots[name]] is not None
+
+	def __iter__(self):
+		return (i for i in self.slots if self.values[self.slots[i]] is not None)
+
+	def __len__(self):
+		return len(self.values) - self.values.count(None)
+
+	def clear(self):
+		# Keep the same list: compiled code holds on to it.
+		self.values[:] = [None] * len(self.values)
+
+	def __repr__(self):
+		return repr(dict(self))
+
+class Program(collections.abc.MutableMapping):
+	"""Stored lines by line number, iterated in order.
+
+	Besides the dictionary of lines, the numbers are kept in a sorted list
+	so running, listing or saving the program needn't sort it, and finding
+	a range of lines takes a binary search. A line stored out of order is
+	appended and the list sorted the next time it's needed, which is
+	nearly linear as most of it is in order already; so loading a program
+	is, whatever the order of its lines.
+	"""
+
+	__slots__ = ("lines", "numbers", "unsorted")
+
+	def __init__(self):
+		self.lines = {}
+		self.numbers = []
+		self.unsorted = False
+
+	def ordered(self):
+		"""Return the sorted list of line numbers."""
+		if self.unsorted:
+			self.numbers.sort()
+			self.unsorted = False
+		return self.numbers
+
+	def __getitem__(self, line_num):
+		return self.lines[line_num]
+
+	def __setitem__(self, line_num, text):
+		if line_num not in self.lines:
+			numbers = self.numbers
+			if numbers and line_num < numbers[-1]:
+				self.unsorted = True
+			numbers.append(line_num)
+		self.lines[line_num] = text
+
+	def __delitem__(self, line_num):
+		del self.lines[line_num]
+		numbers = self.ordered()
+		del numbers[bisect.bisect_left(numbers, line_num)]
+
+	def __contains__(self, line_num):
+		return line_num in self.lines
+
+	def __iter__(self):
+		return iter(self.ordered())
+
+	def __len__(self):
+		return len(self.numbers)
+
+	def clear(self):
+		self.lines.clear()
+		del self.numbers[:]
+		self.unsorted = False
+
+	def span(self, first, last):
+		numbers = self.ordered()
+		start = 0 if first is None else bisect.bisect_left(numbers, first)
+		end = len(numbers) if last is None else bisect.bisect_right(
+			numbers, last)
+		return start, end
+
+	def range(self, first=None, last=None):
+		"""Return the numbers of the lines from first to last, inclusive;
+		either end may be left open."""
+		start, end = self.span(first, last)
+		return self.numbers[start:end]
+
+	def remove(self, first=None, last=None):
+		"""Delete the lines from first to last, like range; return their
+		numbers."""
+		start, end = self.span(first, last)
+		removed = self.numbers[start:end]
+		del self.numbers[start:end]
+		for i in removed:
+			del self.lines[i]
+		return removed
+
+def interactive():
+	try:
+		return sys.stdout.isatty()
+	except (AttributeError, ValueError):
 		return False
-		
-	mark = cursor
-	cursor += 1 # Skip the opening double quote.
-	if cursor >= len(line):
-		raise IndexError("Unclosed string")
-	while line[cursor] != '"':
-		cursor += 1
-		if cursor >= len(line):
-			raise IndexError("Unclosed string")
-	cursor += 1 # Skip the closing double quote.
-	
-	# Save string value without the double quotes.
-	token = line[mark + 1:cursor - 1]
-	return True
-
-def parse_statement():
-	if not match_keyword():
-		raise SyntaxError("Statement expected")
-	
-	stmt = token.lower()
-		
-	if stmt in statements:
-		statements[stmt]()
-	else:
-		raise SyntaxError("Unknown statement: " + stmt)
 
-variables = {}
+class Output(object):
+	"""Where PRINT goes: a file-like buffer in front of an interpreter's
+	stdout (or the console, if that's None).
+
+	Writes pile up in a list and go out joined into one block once there
+	are limit characters waiting, or interval seconds have passed since
+	the last block. The interpreter flushes it before reading input,
+	reporting an error, and whenever a program stops, ends or fails. With
+	a limit of 0 every write goes out right away.
+
+	Nothing checks the clock between writes, so text printed just before
+	a long computation would wait for it; for that reason the console is
+	unbuffered when it's a terminal, the way C's stdio does it.
+	"""
+
+	__slots__ = (
+		"ctx",
+		"parts", # Text written since the last flush
+		"size", # Its length
+		"mark", # When it was last flushed
+		"limit",
+		"interval",
+	)
+
+	def __init__(self, ctx, limit=None, interval=0.1):
+		self.ctx = ctx
+		if limit is None:
+			limit = 0 if ctx.stdout is None and interactive() else 65536
+		self.parts = []
+		self.size = 0
+		self.mark = 0
+		self.limit = limit
+		self.interval = interval
+
+	def write(self, text):
+		self.parts.append(text)
+		self.size += len(text)
+		if self.size >= self.limit:
+			self.flush()
+		elif time.monotonic() - self.mark >= self.interval:
+			self.flush()
+		return len(text)
+
+	def flush(self):
+		self.mark = time.monotonic()
+		if not self.parts:
+			return
+		text = "".join(self.parts)
+		self.parts.clear()
+		self.size = 0
+		target = self.ctx.stdout
+		if target is None:
+			target = sys.stdout
+		target.write(text)
+		target.flush()
+
+class Interpreter(object):
+	"""One independent Tinycat BASIC context: program, variables and I/O.
+
+	Any number of interpreters can live in the same process. Input is read
+	from stdin and output written to stdout; when those are None, the
+	console is used (with line editing, if available). Error messages go
+	to stderr if set, else to stdout like everything else. Output goes
+	through an Output buffer; set its limit to 0 for none.
+	"""
+
+	__slots__ = (
+		"line", # Text of the line being interpreted
+		"tokens", # Tokens of the line being interpreted
+		"cursor", # Index of current token
+		"token", # The last token matched, if any
+		"variables", # A Variables mapping
+		"values", # Its list of values, by slot
+		"program", # A Program
+		"token_cache", # Tokens of each stored line, by line number
+		"shapes", # Result of line_shape() for each stored line
+		"fused", # What each line in addr runs fused, if anything
+		"fused_counts", # Form -> how many times lines of it ran fused
+		"addr",
+		"line_index", # Position of each line number in addr
+		"crt_line",
+		"stop",
+		"stack", # GOSUB return addresses
+		"do_stack", # Where each DO loop in progress starts
+		"for_stack", # A ForFrame for each FOR loop in progress
+		"next_pairs", # Index of each NEXT line -> index of its FOR line
+		"skips", # Index of the first line at or after each that isn't a REM
+		"unreachable", # Line numbers RUN can never get to, or None if unknown
+		"statements",
+		"functions",
+		"function_args",
+		"function_code",
+		"engine", # Which one RUN and CONTINUE use
+		"short_circuit", # Whether AND, OR and IIF skip what they don't need
+		"compiled", # The program compiled by the current engine, if any
+		"edited", # Lines changed since addr was last brought up to date
+		"compiled_functions", # DEF FN bodies compiled to Python functions
+		"hoisted", # What the last RUN FAST moved out of FOR loops
+		"pure_functions", # Names of built-ins that always return the same
+		"memo_size", # Results kept for each pure user function
+		"memos", # Name -> compiler.Memo of each memoized user function
+		"profile", # Line number -> [hits, self, cumulative time] if profiling
+		"cache", # A cache.ProgramCache used by LOAD, or None
+		"rng",
+		"stdin",
+		"stdout",
+		"stderr",
+		"output", # An Output buffer in front of stdout
+	)
+
+	def __init__(self, stdin=None, stdout=None, engine="classic", stderr=None):
+		self.line = ""
+		self.variables = Variables()
+		self.values = self.variables.values
+		self.tokens = self.tokenize("")
+		self.cursor = 0
+		self.token = None
+		self.program = Program()
+		self.token_cache = {}
+		self.shapes = {}
+		self.fused = []
+		self.fused_counts = dict.fromkeys(fused_forms, 0)
+		self.addr = []
+		self.line_index = {}
+		self.crt_line = -1
+		self.stop = False
+		self.stack = []
+		self.do_stack = []
+		self.for_stack = []
+		self.next_pairs = {}
+		self.skips = [0]
+		self.unreachable = []
+		self.statements = dict(statements)
+		self.rng = random.Random()
+		self.functions = dict(functions)
+		self.functions["rnd"] = self.rng.random
+		self.function_args = dict(function_args)
+		self.function_code = {}
+		self.engine = engine
+		self.short_circuit = False
+		self.compiled = None
+		self.edited = False
+		self.compiled_functions = {}
+		self.hoisted = []
+		self.pure_functions = set(pure_functions)
+		self.memo_size = 1024
+		self.memos = {}
+		self.profile = None
+		self.cache = None
+		self.stdin = stdin
+		self.stdout = stdout
+		self.stderr = stderr
+		self.output = Output(self)
+
+	def read_line(self, prompt):
+		self.output.flush()
+		if self.stdin is None:
+			return input(prompt)
+		print(prompt, end="", file=self.stdout)
+		text = self.stdin.readline()
+		if not text:
+			raise EOFError("Out of input")
+		return text.rstrip("\n")
+
+	def print_error(self, *args):
+		if self.stderr is None:
+			print(*args, file=self.output)
+			self.output.flush()
+		else:
+			self.output.flush()
+			print(*args, file=self.stderr)
+
+	def tokenize(self, text):
+		return self.resolve(tokenize(text))
+
+	def resolve(self, tokens):
+		slot = self.variables.slot
+		return [("name", t[1], slot(t[1]), t[3]) if t[0] == "name" else t
+			for t in tokens]
+
+	def set_line(self, text):
+		self.line = text
+		self.tokens = self.tokenize(text)
+		self.cursor = 0
+
+	def column(self):
+		"""Return the text column right after the last token matched."""
+		if self.cursor > 0:
+			t = self.tokens[self.cursor - 1]
+			return t[3] + len(t[1])
+		else:
+			return 0
+
+	def match_keyword(self):
+		t = self.tokens[self.cursor]
+		if t[0] != "name":
+			return False
+		self.token = t[1]
+		self.cursor += 1
+		return True
 
-def parse_rem():
-	global cursor
-	cursor = len(line)
+	def match_number(self):
+		t = self.tokens[self.cursor]
+		if t[0] != "number":
+			return False
+		self.token = t[2]
+		self.cursor += 1
+		return True
 
-def parse_let():
-	if not match_varname():
-		raise SyntaxError("Variable expected")
+	match_varname = match_keyword
+
+	def match_string(self):
+		t = self.tokens[self.cursor]
+		if t[0] == "string":
+			self.token = t[2]
+			self.cursor += 1
+			return True
+		elif t[0] == "error":
+			raise IndexError(t[2])
+		else:
+			return False
+
+	def parse_statement(self):
+		if not self.match_keyword():
+			raise SyntaxError("Statement expected")
 		
-	var_name = token.lower()
-	
-	if not match("="):
-		raise SyntaxError("'=' expected")
-
-	variables[var_name] = parse_disjunction()
-
-def match(text):
-	global cursor
-	skip_whitespace()
-	if line.startswith(text, cursor):
-		cursor += len(text)
-		return True
-	else:
-		return False
+		stmt = self.token
+			
+		if stmt in self.statements:
+			self.statements[stmt](self)
+		else:
+			raise SyntaxError("Unknown statement: " + stmt)
 
-def match_eol():
-	skip_whitespace()
-	return cursor >= len(line)
-
-def parse_print():
-	if match_eol():
-		print()
-		return
-	value = parse_value()
-	while match(","):
-		value += parse_value()
-	if match(";"):
-		print(value, end="")
-	else:
-		print(value)
+	def parse_rem(self):
+		self.cursor = len(self.tokens) - 1
 
-def parse_value():
-	global token
-	if match_string():
-		return token
-	else:
-		return "{:1g}".format(parse_disjunction())
-
-def parse_expression():
-	t1 = parse_term()
-	while match_add_sub():
-		op = token
-		t2 = parse_term()
-		if op == "+":
-			t1 += t2
-		elif op == "-":
-			t1 -= t2
-		else:
-			raise SyntaxError(op)
-	return t1
-	
-def parse_term():
-	t1 = parse_power()
-	while match_mul_div():
-		op = token
-		t2 = parse_power()
-		if op == "*":
-			t1 *= t2
-		elif op == "/":
-			t1 /= t2
-		elif op == "\\":
-			t1 //= t2
-		else:
-			raise SyntaxError("Unknown operator: " + op)
-	return t1
-
-def parse_power():
-	t1 = parse_factor()
-	if match("^"):
-		return t1 ** parse_power()
-	else:
-		return t1
+	def parse_let(self):
+		if not self.match_varname():
+			raise SyntaxError("Variable expected")
+			
+		slot = self.tokens[self.cursor - 1][2]
+		
+		if not self.match("="):
+			raise SyntaxError("'=' expected")
 
-function_args = {
-	"timer": [],
-	"rnd": [],
-	"pi": [],
-	"int": ["n"],
-	"abs": ["n"],
-	"sqr": ["n"],
-	"sin": ["n"],
-	"cos": ["n"],
-	"rad": ["n"],
-	"deg": ["n"],
-	"min": ["a", "b"],
-	"max": ["a", "b"],
-	"mod": ["a", "b"],
-	"hypot2": ["a", "b"],
-	"hypot3": ["a", "b", "c"],
-	"iif": ["a", "b", "c"],
-}
+		self.values[slot] = self.parse_disjunction()
 
-def parse_factor():
-	global token
-	
-	if match("-"):
-		signum = -1
-	else:
-		signum = 1
-	
-	if match_number():
-		return float(token) * signum
-	elif match_varname():
-		name = token.lower()
-		if name in function_args:
-			args = parse_args()
-			return call_fn(name, args) * signum
-		elif name in variables:
-			return variables[name] * signum
-		else:
-			raise NameError("Var not found: " + name)
-	elif match("("):
-		value = parse_disjunction()
-		if match(")"):
-			return value * signum
+	def match(self, text):
+		if self.tokens[self.cursor][1] == text:
+			self.cursor += 1
+			return True
 		else:
-			raise SyntaxError("Missing ')'")
-	else:
-		raise SyntaxError("Expression expected")
+			return False
+
+	def match_eol(self):
+		return self.tokens[self.cursor][0] == "eol"
+
+	def parse_print(self):
+		if self.match_eol():
+			self.output.write("\n")
+			return
+		parts = [self.parse_value()]
+		while self.match(","):
+			parts.append(self.parse_value())
+		if not self.match(";"):
+			parts.append("\n")
+		self.output.write("".join(parts))
+
+	def parse_value(self):
+		if self.match_string():
+			return self.token
+		else:
+			return "{:1g}".format(self.parse_disjunction())
+
+	def parse_expression(self):
+		t1 = self.parse_term()
+		while self.match_add_sub():
+			op = self.token
+			t2 = self.parse_term()
+			if op == "+":
+				t1 += t2
+			elif op == "-":
+				t1 -= t2
+			else:
+				raise SyntaxError(op)
+		return t1
+		
+	def parse_term(self):
+		t1 = self.parse_power()
+		while self.match_mul_div():
+			op = self.token
+			t2 = self.parse_power()
+			if op == "*":
+				t1 *= t2
+			elif op == "/":
+				t1 /= t2
+			elif op == "\\":
+				t1 //= t2
+			else:
+				raise SyntaxError("Unknown operator: " + op)
+		return t1
 
-def parse_args():
-	if match("("):
-		if match(")"):
+	def parse_power(self):
+		t1 = self.parse_factor()
+		if self.match("^"):
+			return t1 ** self.parse_power()
+		else:
+			return t1
+
+	def parse_factor(self):
+		t = self.tokens[self.cursor]
+		if t[1] == "-":
+			self.cursor += 1
+			return -self.parse_operand()
+		elif t[0] == "number":
+			# Converted when the line was tokenized; no sign to apply.
+			self.cursor += 1
+			return t[2]
+		else:
+			return self.parse_operand()
+
+	def parse_operand(self):
+		if self.match_number():
+			return self.token
+		elif self.match_varname():
+			name = self.token
+			if name in self.function_args:
+				if name == "iif" and self.short_circuit \
+						and self.tokens[self.cursor][1] == "(":
+					return self.parse_iif()
+				args = self.parse_args()
+				return self.call_fn(name, args)
+			value = self.values[self.tokens[self.cursor - 1][2]]
+			if value is None:
+				raise NameError("Var not found: " + name)
+			return value
+		elif self.match("("):
+			value = self.parse_disjunction()
+			if self.match(")"):
+				return value
+			else:
+				raise SyntaxError("Missing ')'")
+		else:
+			raise SyntaxError("Expression expected")
+
+	def parse_args(self):
+		if self.match("("):
+			if self.match(")"):
+				return []
+			args = [self.parse_disjunction()]
+			while self.match(","):
+				args.append(self.parse_disjunction())
+			if self.match(")"):
+				return args
+			else:
+				raise SyntaxError("Missing ')'")
+		else:
 			return []
-		args = [parse_disjunction()]
-		while match(","):
-			args.append(parse_disjunction())
-		if match(")"):
-			return args
+
+	def parse_iif(self):
+		"""IIF(a, b, c), evaluating only the one of b and c it returns."""
+		self.cursor += 1
+		condition = self.parse_disjunction()
+		if not self.match(","):
+			raise RuntimeError("Bad argument count")
+		if condition != 0:
+			value = self.parse_disjunction()
+			if not self.match(","):
+				raise RuntimeError("Bad argument count")
+			self.skip(compiler.Parser.parse_disjunction)
+		else:
+			self.skip(compiler.Parser.parse_disjunction)
+			if not self.match(","):
+				raise RuntimeError("Bad argument count")
+			value = self.parse_disjunction()
+		if self.match(")"):
+			return value
+		elif self.match(","):
+			raise RuntimeError("Bad argument count")
 		else:
 			raise SyntaxError("Missing ')'")
-	else:
-		return []
 
-function_code = {}
+	def skip(self, method):
+		"""Move the cursor past what a compiler.Parser method would parse
+		from it, without evaluating anything."""
+		parser = compiler.Parser(self.tokens, self.function_args)
+		parser.cursor = self.cursor
+		try:
+			method(parser)
+		finally:
+			self.cursor = parser.cursor
+
+	def call_fn(self, name, args):
+		if len(args) != len(self.function_args[name]):
+			raise RuntimeError("Bad argument count")
+		elif name in self.function_code:
+			return self.call_user_fn(name, args)
+		elif name in self.functions:
+			return self.functions[name](*args)
+		else:
+			# Should never happen, but just in case
+			raise NameError("Unknown function: " + name)
 
-def call_fn(name, args):
-	if len(args) != len(function_args[name]):
-		raise RuntimeError("Bad argument count")
-	elif name in function_code:
-		return call_user_fn(name, args)
-	elif name in functions:
-		return functions[name](*args)
-	else:
-		# Should never happen, but just in case
-		raise NameError("Unknown function: " + name)
-
-def parse_def():
-	global cursor
-	
-	if not match_nocase("fn"):
-		raise SyntaxError("Missing 'fn'")
-	if not match_varname():
-		raise SyntaxError("Name expected")
-
-	name = token.lower()
-
-	if name in function_args:
-		raise RuntimeError("Duplicate function: " + name)
-	if not match("("):
-		raise SyntaxError("Missing '('")
-	
-	if match(")"):
-		args = []
-	else:
-		args = parse_varlist()
-		if not match(")"):
-			raise SyntaxError("Missing ')'")
-	
-	if not match("="):
-		raise SyntaxError("Missing '='")
-	
-	function_args[name] = args
-	function_code[name] = line[cursor:]
-	cursor = len(line)
-
-def call_user_fn(name, args):
-	global line, cursor, variables
-	
-	tmp_line = line
-	tmp_cursor = cursor
-	tmp_variables = variables
-	
-	line = function_code[name]
-	cursor = 0
-	variables = {}
-	argnames = function_args[name]
-	for i in range(len(argnames)):
-		variables[argnames[i]] = args[i]
-	
-	try:
-		result = parse_disjunction()
-	finally:
-		variables = tmp_variables
-		cursor = tmp_cursor
-		line = tmp_line
-	
-	return result
+	def parse_def(self):
+		if not self.match_nocase("fn"):
+			raise SyntaxError("Missing 'fn'")
+		if not self.match_varname():
+			raise SyntaxError("Name expected")
 
-def match_add_sub():
-	global token
-	if match("+"):
-		token = "+"
-		return True
-	elif match("-"):
-		token = "-"
-		return True
-	else:
+		name = self.token
+
+		if name in self.function_args:
+			raise RuntimeError("Duplicate function: " + name)
+		if not self.match("("):
+			raise SyntaxError("Missing '('")
+		
+		if self.match(")"):
+			args = []
+		else:
+			args = self.parse_varlist()
+			if not self.match(")"):
+				raise SyntaxError("Missing ')'")
+		
+		if not self.match("="):
+			raise SyntaxError("Missing '='")
+		
+		self.function_args[name] = args
+		self.function_code[name] = self.tokens[self.cursor:]
+		self.cursor = len(self.tokens) - 1
+
+	def call_user_fn(self, name, args):
+		# Bodies are parsed on their first call, then reused until RUN.
+		function = self.compiled_functions.get(name)
+		if function is None:
+			function = compiler.compile_function(self, name)
+		return function(*args)
+
+	def match_add_sub(self):
+		op = self.tokens[self.cursor][1]
+		if op == "+" or op == "-":
+			self.token = op
+			self.cursor += 1
+			return True
+		else:
+			return False
+
+	def match_mul_div(self):
+		op = self.tokens[self.cursor][1]
+		if op == "*" or op == "/" or op == "\\":
+			self.token = op
+			self.cursor += 1
+			return True
+		else:
+			return False
+
+	def parse_if(self):
+		condition = self.parse_disjunction()
+		if self.match_nocase("then"):
+			if condition != 0:
+				self.parse_statement()
+			else:
+				self.cursor = len(self.tokens) - 1
+		else:
+			raise SyntaxError("IF without THEN")
+
+	def parse_comparison(self):
+		lside = self.parse_expression()
+		if not self.match_relation():
+			return lside
+		else:
+			op = self.token
+			rside = self.parse_expression()
+			if op == "<=":
+				return -(lside <= rside)
+			elif op == "<":
+				return -(lside < rside)
+			elif op == "=":
+				return -(lside == rside)
+			elif op == "<>":
+				return -(lside != rside)
+			elif op == ">":
+				return -(lside > rside)
+			elif op == ">=":
+				return -(lside >= rside)
+
+	def match_relation(self):
+		# The tokenizer already matched the longer operators first.
+		op = self.tokens[self.cursor][1]
+		if op in relations:
+			self.token = op
+			self.cursor += 1
+			return True
 		return False
 
-def match_mul_div():
-	global token
-	if match("*"):
-		token = "*"
+	def parse_disjunction(self):
+		lside = self.parse_conjunction()
+		while self.match_nocase("or"):
+			if self.short_circuit and lside != 0:
+				self.skip(compiler.Parser.parse_conjunction)
+				lside = -1
+				continue
+			rside = -(self.parse_conjunction() != 0)
+			lside = -(lside != 0 or rside != 0)
+		return lside
+
+	def parse_conjunction(self):
+		lside = self.parse_negation()
+		while self.match_nocase("and"):
+			if self.short_circuit and lside == 0:
+				self.skip(compiler.Parser.parse_negation)
+				lside = 0
+				continue
+			rside = -(self.parse_negation() != 0)
+			lside = -(lside != 0 and rside != 0)
+		return lside
+		
+	def parse_negation(self):
+		if self.match_nocase("not"):
+			return -(self.parse_comparison() == 0)
+		else:
+			# Leave purely arithmetic results intact
+			return self.parse_comparison()
+
+	def match_nocase(self, kw):
+		if self.tokens[self.cursor][1] == kw:
+			self.cursor += 1
+			return True
+		else:
+			return False
+
+	def parse_input(self):
+		if self.match_string():
+			prompt = self.token
+			if not self.match(","):
+				raise SyntaxError("Comma expected")
+		else:
+			prompt = ""
+		self.input_values(prompt, self.parse_varlist())
+
+	def input_values(self, prompt, input_vars):
+		data = self.read_line(prompt).split(",")
+		variables = self.variables
+		for i in range(len(input_vars)):
+			v = input_vars[i]
+			if i < len(data):
+				data[i] = data[i].strip()
+				if len(data[i]) == 0:
+					variables[v] = 0
+				else:
+					try:
+						variables[v] = float(data[i])
+					except ValueError:
+						print("Can't parse number: " + data[i],
+							file=self.output)
+						print("Maybe you forgot a comma?", file=self.output)
+						variables[v] = 0
+			else:
+				variables[v] = 0
+
+	def parse_varlist(self):
+		if not self.match_varname():
+			raise SyntaxError("Var expected")
+		varlist = [self.token]
+		while self.match(","):
+			if not self.match_varname():
+				raise SyntaxError("Var expected")
+			varlist.append(self.token)
+		return varlist
+
+	def store_line(self, linenum, text):
+		self.program[linenum] = text
+		self.cache_tokens(linenum, self.tokenize(text))
+		self.edited = True
+
+	def cache_tokens(self, linenum, tokens):
+		self.token_cache[linenum] = tokens
+		self.shapes[linenum] = line_shape(tokens)
+
+	def forget_line(self, linenum):
+		del self.program[linenum]
+		self.token_cache.pop(linenum, None)
+		self.shapes.pop(linenum, None)
+		self.edited = True
+
+	def line_tokens(self, linenum):
+		try:
+			return self.token_cache[linenum]
+		except KeyError:
+			# Lines can also be stored directly by an embedding program.
+			result = self.tokenize(self.program[linenum])
+			self.cache_tokens(linenum, result)
+			return result
+
+	def parse_line(self):
+		t = self.tokens[0]
+		if t[0] == "number" and t[1].isdigit():
+			self.store_line(int(t[1]), self.line[self.tokens[1][3]:])
+		else:
+			self.parse_statement()
+
+	def list_program(self, first=None, last=None):
+		for i in self.program.range(first, last):
+			print(i, self.program[i], sep="\t", file=self.output)
+		self.output.flush()
+
+	def new_program(self):
+		self.program.clear()
+		self.token_cache.clear()
+		self.shapes.clear()
+		self.compiled = None
+		self.edited = True
+
+	def reset_program(self):
+		for i in list(self.function_code.keys()):
+			del self.function_code[i]
+			del self.function_args[i]
+		self.compiled_functions.clear()
+		self.memos.clear()
+		self.update_lines()
+		for i in self.fused_counts:
+			self.fused_counts[i] = 0
+		self.crt_line = 0
+		del self.stack[:]
+		del self.do_stack[:]
+		del self.for_stack[:]
+
+	def update_lines(self):
+		"""Bring addr and everything derived from it up to date with the
+		stored lines, so the program can run, or CONTINUE after an edit.
+
+		Positions kept for a program in progress move along with the
+		lines they point at; one pointing at a deleted line moves to the
+		line after it. Compiled code is updated to match, by the engine
+		that compiled it, which may start over.
+		"""
+		addr = list(self.program)
+		if addr != self.addr:
+			old = self.addr
+			def moved(i):
+				if i < 0:
+					return i
+				elif i < len(old):
+					return bisect.bisect_left(addr, old[i])
+				else:
+					return len(addr)
+			self.crt_line = moved(self.crt_line)
+			self.stack[:] = [moved(i) for i in self.stack]
+			self.do_stack[:] = [moved(i) for i in self.do_stack]
+			for frame in self.for_stack:
+				frame.line = moved(frame.line + 1) - 1
+			self.addr = addr
+			self.line_index = dict((n, i) for i, n in enumerate(addr))
+		self.next_pairs = self.pair_loops()
+		self.skips = self.find_skips()
+		self.unreachable = self.find_unreachable()
+		self.fused = [self.fuse(i) for i in range(len(self.addr))]
+		if self.compiled is not None and not self.compiled.update():
+			self.compiled = None
+		self.edited = False
+
+	def fuse(self, i):
+		"""Return what line i in addr runs fused: a tuple of the method
+		that runs it and what that needs, or None."""
+		line_num = self.addr[i]
+		if line_num not in self.shapes:
+			self.line_tokens(line_num)
+		shape = self.shapes.get(line_num)
+		if shape is None or self.statements.get(shape[1]) is not statements[shape[1]]:
+			return None # Not a fused form, or a statement the host replaced
+		form = shape[0]
+		if form == "goto":
+			if shape[2] in self.line_index:
+				return (Interpreter.run_goto,
+					self.thread(self.line_index[shape[2]]))
+		elif form == "if-goto":
+			if shape[6] in self.line_index \
+					and self.statements.get("goto") is statements["goto"]:
+				return (Interpreter.run_if_goto, shape[2],
+					relation_ops.get(shape[3]), shape[4], shape[5],
+					self.thread(self.line_index[shape[6]]))
+		elif form == "rem":
+			return (Interpreter.run_rem, self.skips[i + 1])
+		elif form == "next":
+			pair = self.next_pairs.get(i)
+			if pair is not None:
+				# A loop whose body is a single line, or nothing, can go
+				# round right here.
+				return (Interpreter.run_next, shape[2], pair,
+					pair in (i - 2, i - 1))
+		else:
+			return (Interpreter.run_let, form, shape[2], shape[4],
+				shape[3])
+		return None
+
+	def run_goto(self, i, fused):
+		self.fused_counts["goto"] += 1
+		self.crt_line = fused[1]
 		return True
-	elif match("/"):
-		token = "/"
+
+	def run_rem(self, i, fused):
+		self.fused_counts["rem"] += 1
+		self.crt_line = fused[1]
 		return True
-	elif match("\\"):
-		token = "\\"
+
+	def run_if_goto(self, i, fused):
+		_, left, relation, right, then, dest = fused
+		if left is not None:
+			values = self.values
+			a = left[1] if left[0] is None else values[left[0]]
+			b = right[1] if right[0] is None else values[right[0]]
+			if a is None or b is None:
+				return False # Let the parser say which one is missing.
+			if left[0] is not None and left[1] in self.function_args:
+				return False
+			if right[0] is not None and right[1] in self.function_args:
+				return False
+			condition = relation(a, b)
+		else:
+			self.tokens = self.line_tokens(self.addr[i])
+			self.cursor = 1
+			condition = self.parse_disjunction()
+			if self.cursor != then:
+				# Not where the parser first stopped; finish the usual way.
+				if not self.match_nocase("then"):
+					raise SyntaxError("IF without THEN")
+				if condition != 0:
+					self.parse_statement()
+				return True
+			condition = condition != 0
+		self.fused_counts["if-goto"] += 1
+		if condition:
+			self.crt_line = dest
 		return True
-	else:
-		return False
 
-def parse_if():
-	global cursor
-	condition = parse_disjunction()
-	if match_nocase("then"):
-		if condition != 0:
-			skip_whitespace()
-			parse_statement()
+	def run_let(self, i, fused):
+		_, form, slot, by, name = fused
+		values = self.values
+		value = values[slot]
+		amount = by[1] if by[0] is None else values[by[0]]
+		if value is None or amount is None or name in self.function_args:
+			return False
+		if by[0] is not None and by[1] in self.function_args:
+			return False
+		self.fused_counts[form] += 1
+		if form == "let-add":
+			values[slot] = value + amount
 		else:
-			cursor = len(line)
-	else:
-		raise SyntaxError("IF without THEN")
+			values[slot] = value - amount
+		return True
 
-def parse_comparison():
-	lside = parse_expression()
-	if not match_relation():
-		return lside
-	else:
-		op = token
-		rside = parse_expression()
-		if op == "<=":
-			return -(lside <= rside)
-		elif op == "<":
-			return -(lside < rside)
-		elif op == "=":
-			return -(lside == rside)
-		elif op == "<>":
-			return -(lside != rside)
-		elif op == ">":
-			return -(lside > rside)
-		elif op == ">=":
-			return -(lside >= rside)
-
-#def match_relation():
-	#global token
-	#for op in ["=", "<>", "<=", ">=", "<", ">"]:
-		#if match(op):
-			#token = op
-			#return True
-	#return False
-
-def match_relation():
-	global token, cursor
-	skip_whitespace()
-	# Always try to match the longer operators first.
-	for op in ["=", "<>", "<=", ">=", "<", ">"]:
-		if line.startswith(op, cursor):
-			token = op
-			cursor += len(op)
+	def run_next(self, i, fused):
+		_, slot, pair, loop = fused
+		values = self.values
+		fors = self.for_stack
+		frame = fors[-1] if fors else None
+		if frame is None or frame.line != pair or values[slot] is None:
+			return False
+		counts = self.fused_counts
+		step = frame.step
+		limit = frame.limit
+		body = pair + 1
+		if loop and body == i:
+			values[slot], times = compiler.empty_loop(values[slot], step, limit)
+			counts["next"] += times
+			fors.pop()
+			self.crt_line = i + 1
 			return True
-	return False
-
-def parse_disjunction():
-	lside = parse_conjunction()
-	while match_nocase("or"):
-		rside = -(parse_conjunction() != 0)
-		lside = -(lside != 0 or rside != 0)
-	return lside
-
-def parse_conjunction():
-	lside = parse_negation()
-	while match_nocase("and"):
-		rside = -(parse_negation() != 0)
-		lside = -(lside != 0 and rside != 0)
-	return lside
-	
-def parse_negation():
-	if match_nocase("not"):
-		return -(parse_comparison() == 0)
-	else:
-		# Leave purely arithmetic results intact
-		return parse_comparison()
-
-def match_nocase(kw):
-	global cursor
-	mark = cursor
-	skip_whitespace()
-	if not match_keyword():
-		cursor = mark
-		return False
-	elif token.lower() != kw.lower():
-		cursor = mark
-		return False
-	else:
-		return True
+		while True:
+			counts["next"] += 1
+			value = values[slot] + step
+			values[slot] = value
+			if value > limit if step > 0 else value < limit:
+				fors.pop()
+				self.crt_line = i + 1
+				return True
+			if not loop:
+				self.crt_line = body
+				return True
+			# Run the body again, as long as it carries on to this NEXT.
+			self.crt_line = i
+			try:
+				fused_body = self.fused[body]
+				if fused_body is None \
+						or not fused_body[0](self, body, fused_body):
+					self.tokens = self.line_tokens(self.addr[body])
+					self.cursor = 0
+					self.parse_statement()
+			except Exception as e:
+				e.basic_index = body
+				raise
+			if self.crt_line != i or self.stop or not fors \
+					or fors[-1] is not frame or values[slot] is None:
+				return True
+
+	def pair_loops(self):
+		"""Match each NEXT with the innermost open FOR on the same variable,
+		going through the program in order."""
+		pairs = {}
+		loops = [] # Variable name and line index of each open FOR
+		for i in range(len(self.addr)):
+			kind, name = loop_statement(self.line_tokens(self.addr[i]))
+			if kind == "for":
+				loops.append((name, i))
+			elif kind == "next":
+				for j in range(len(loops) - 1, -1, -1):
+					if loops[j][0] == name:
+						pairs[i] = loops[j][1]
+						del loops[j:]
+						break
+		return pairs
+
+	def find_skips(self):
+		"""Return the index of the first line at or after each position in
+		addr that isn't a REM, with one more entry for the end."""
+		skips = [len(self.addr)] * (len(self.addr) + 1)
+		if self.statements.get("rem") is not statements["rem"]:
+			return list(range(len(skips)))
+		for i in range(len(self.addr) - 1, -1, -1):
+			line_num = self.addr[i]
+			if line_num not in self.shapes:
+				self.line_tokens(line_num)
+			shape = self.shapes.get(line_num)
+			skips[i] = skips[i + 1] if shape == ("rem", "rem") else i
+		return skips
+
+	def thread(self, i):
+		"""Return where a jump to line index i really ends up: past any
+		REM lines, and through any plain GOTOs, to the first line that
+		does something."""
+		seen = set()
+		goto = self.statements.get("goto") is statements["goto"]
+		while True:
+			i = self.skips[i]
+			if i == len(self.addr) or i in seen or not goto:
+				return i
+			shape = self.shapes.get(self.addr[i])
+			if shape is None or shape[0] != "goto" \
+					or shape[2] not in self.line_index:
+				return i
+			seen.add(i) # Goes round in a circle otherwise
+			i = self.line_index[shape[2]]
+
+	def find_unreachable(self):
+		"""Return the numbers of lines no path from the first line leads
+		to, or None if some jump is worked out at run time, or some
+		statement isn't a built-in one, so there's no telling."""
+		addr = self.addr
+		flow = []
+		for line_num in addr:
+			conditional, keyword, target = flow_statement(
+				self.line_tokens(line_num))
+			if keyword in self.statements \
+					and self.statements[keyword] is not statements.get(keyword):
+				return None
+			if keyword in ("goto", "gosub") and target is None:
+				return None
+			flow.append((conditional, keyword, target))
+		reached = [False] * len(addr)
+		todo = [0] if addr else []
+		while todo:
+			i = todo.pop()
+			if i >= len(addr) or reached[i]:
+				continue
+			reached[i] = True
+			conditional, keyword, target = flow[i]
+			if target in self.line_index:
+				todo.append(self.line_index[target])
+			# A GOSUB carries on after its RETURN; the RETURN itself, and
+			# NEXT and LOOP going round again, only go back to lines
+			# that must have been reached already.
+			if conditional or keyword not in ("goto", "return", "end"):
+				todo.append(i + 1)
+		return [addr[i] for i in range(len(addr)) if not reached[i]]
+
+	def start_loop(self, line, slot, limit, step):
+		fors = self.for_stack
+		for i in range(len(fors) - 1, -1, -1):
+			if fors[i].line == line:
+				# Jumped out of this loop earlier, and now it starts over.
+				del fors[i:]
+				break
+		fors.append(ForFrame(line, slot, limit, step))
+
+	def find_loop(self, line, slot):
+		"""Return the frame a NEXT belongs to, given the index of its FOR
+		line (or None) and its variable; drop any loops left by a jump
+		from inside it."""
+		fors = self.for_stack
+		for i in range(len(fors) - 1, -1, -1):
+			if fors[i].line == line or fors[i].slot == slot:
+				del fors[i + 1:]
+				return fors[i]
+		raise RuntimeError("NEXT without FOR")
+
+	def run_program(self):
+		self.reset_program()
+		self.continue_program()
+
+	def run_fast(self):
+		"""Run the whole program compiled to a single Python function."""
+		self.reset_program()
+		try:
+			fast = transpiler.compile_program(self)
+		except (transpiler.Unsupported, SyntaxError) as e:
+			# A SyntaxError would be a bug in the transpiler, not the program.
+			self.print_error(e, "- running normally")
+			self.continue_program()
+		else:
+			self.hoisted = fast.hoisted
+			try:
+				fast.run()
+			finally:
+				self.output.flush()
 
-def parse_input():
-	if match_string():
-		prompt = token
-		if not match(","):
-			raise SyntaxError("Comma expected")
-	else:
-		prompt = ""
-	input_vars = parse_varlist()
-	data = input(prompt).split(",")
-	for i in range(len(input_vars)):
-		v = input_vars[i]
-		if i < len(data):
-			data[i] = data[i].strip()
-			if len(data[i]) == 0:
-				variables[v] = 0
+	def fast_source(self):
+		self.reset_program()
+		return transpiler.Transpiler(self).source()
+
+	def continue_program(self):
+		if self.edited:
+			self.update_lines()
+		try:
+			if self.profile is not None:
+				self.profile_lines()
+			elif self.engine != "classic":
+				if self.compiled is None:
+					if self.engine == "bytecode":
+						self.compiled = bytecode.compile_program(self)
+					elif self.engine == "tracing":
+						self.compiled = tracing.compile_program(self)
+					else:
+						self.compiled = compiler.compile_program(self)
+				self.compiled.run()
 			else:
+				self.run_lines()
+		finally:
+			# However the program stopped, its output is all out.
+			self.output.flush()
+
+	def run_lines(self):
+		"""The classic engine: interpret the program line by line."""
+		self.stop = False
+		addr = self.addr
+		fused = self.fused
+		try:
+			while self.crt_line < len(addr) and not self.stop:
+				i = self.crt_line
+				self.crt_line = i + 1
+				if fused[i] is not None and fused[i][0](self, i, fused[i]):
+					continue
+				self.tokens = self.line_tokens(addr[i])
+				self.cursor = 0
+				self.parse_statement()
+		except Exception as e:
+			line_num = addr[getattr(e, "basic_index", i)]
+			self.print_error(e, "in line", line_num, "column", self.column())
+
+	def profile_lines(self):
+		"""Like the classic engine, but timing every line it runs.
+
+		Self time is what the line took on its own; cumulative time also
+		counts any subroutine it called, up to the matching RETURN.
+		"""
+		self.stop = False
+		addr = self.addr
+		profile = self.profile
+		clock = time.perf_counter
+		calls = [] # Stack depth, line number and time of pending GOSUBs
+		try:
+			while self.crt_line < len(addr) and not self.stop:
+				line_num = addr[self.crt_line]
+				self.tokens = self.line_tokens(line_num)
+				self.crt_line += 1
+				self.cursor = 0
+				depth = len(self.stack)
+				mark = clock()
 				try:
-					variables[v] = float(data[i])
-				except ValueError:
-					print("Can't parse number: " + data[i])
-					print("Maybe you forgot a comma?")
-					variables[v] = 0
+					self.parse_statement()
+				finally:
+					now = clock()
+					if line_num not in profile:
+						profile[line_num] = [0, 0.0, 0.0]
+					entry = profile[line_num]
+					entry[0] += 1
+					entry[1] += now - mark
+					entry[2] += now - mark
+				if len(self.stack) > depth:
+					calls.append((depth, line_num, now))
+				while calls and len(self.stack) <= calls[-1][0]:
+					profile[calls[-1][1]][2] += now - calls[-1][2]
+					calls.pop()
+		except Exception as e:
+			self.print_error(e, "in line", line_num, "column", self.column())
+		now = clock()
+		for depth, line_num, mark in calls:
+			profile[line_num][2] += now - mark
+
+	def run_profile(self, filename=None):
+		"""Run the program with the profiler, then print a report and
+		optionally save the figures as JSON."""
+		self.reset_program()
+		self.profile = {}
+		try:
+			self.continue_program()
+		finally:
+			profile = self.profile
+			self.profile = None
+		self.profile_report(profile)
+		if filename is not None:
+			with open(filename, "w") as f:
+				json.dump(self.profile_data(profile), f, indent=1)
+
+	def flow_graph(self, filename=None):
+		"""Print the program's control-flow graph in DOT, or save it."""
+		if self.edited:
+			self.update_lines()
+		dot = cfg.FlowGraph(self).dot()
+		if filename is not None:
+			with open(filename, "w") as f:
+				f.write(dot)
 		else:
-			variables[v] = 0
-
-def parse_varlist():
-	if not match_varname():
-		raise SyntaxError("Var expected")
-	varlist = [token.lower()]
-	while match(","):
-		if not match_varname():
-			raise SyntaxError("Var expected")
-		varlist.append(token.lower())
-	return varlist
-
-program = {}
-
-def parse_line():
-	global cursor
-	skip_whitespace()
-	mark = cursor
-	while cursor < len(line) and line[cursor].isdigit():
-		cursor += 1
-	if cursor > mark:
-		linenum = int(line[mark:cursor])
-		skip_whitespace()
-		program[linenum] = line[cursor:]
-	else:
-		parse_statement()
-
-def list_program():
-	addr = sorted(program.keys())
-	for i in addr:
-		print(i, program[i], sep="\t")
-
-addr = []
-crt_line = -1
-stop = False
-
-def run_program():
-	global addr, crt_line
-	addr = sorted(program.keys())
-	crt_line = 0
-	stack.clear()
-	for i in function_code.keys():
-		del function_code[i]
-		del function_args[i]
-	continue_program()
-
-def continue_program():
-	global crt_line, line, cursor, stop
-	stop = False
-	try:
-		while crt_line < len(addr) and not stop:
-			line_num = addr[crt_line]
-			line = program[line_num]
-			crt_line += 1
-			cursor = 0
-			parse_statement()
-	except Exception as e:
-		print(e, "in line", line_num, "column", cursor)
-
-def parse_goto():
-	global crt_line
-	line_num = int(parse_expression())
-	if line_num in addr:
-		crt_line = addr.index(line_num)
-	else:
-		raise ValueError("Line not found: " + line_num)
+			print(dot, end="", file=self.output)
+			self.output.flush()
+
+	def fused_report(self):
+		"""Print how many times lines of each fused form ran since RUN."""
+		for i in fused_forms:
+			print("{:>10} {}".format(self.fused_counts[i], i), file=self.output)
+		self.output.flush()
+
+	def memo_report(self):
+		"""Print how each memoized function's cache did since RUN."""
+		print("{:>10} {:>10} {:>10}  {}".format(
+			"hits", "misses", "evictions", "function"), file=self.output)
+		for name in sorted(self.memos):
+			memo = self.memos[name]
+			print("{:10d} {:10d} {:10d}  {}{}".format(
+				memo.hits, memo.misses, memo.evictions, name,
+				" (given up)" if memo.results is None else ""),
+				file=self.output)
+		self.output.flush()
+
+	def optimizer_report(self):
+		"""Print how much the optimizer took out of the compiled program."""
+		if self.compiled is not None and hasattr(self.compiled, "removed_nodes"):
+			print("{} syntax tree nodes removed".format(
+				self.compiled.removed_nodes()), file=self.output)
+		else:
+			print("No program compiled by the closures or bytecode engine",
+				file=self.output)
+		self.output.flush()
+
+	def hoisting_report(self):
+		"""Print what the last RUN FAST worked out before FOR loops."""
+		for line_num, loop, what, text in self.hoisted:
+			print("{:>6} {} {}, loop at line {}".format(
+				line_num, text, what, loop), file=self.output)
+		if not self.hoisted:
+			print("Nothing hoisted", file=self.output)
+		self.output.flush()
+
+	def unreachable_report(self):
+		"""Print the lines RUN found no way to get to."""
+		if self.unreachable is None:
+			print("Some jumps are computed; can't tell what's unreachable",
+				file=self.output)
+		elif self.unreachable:
+			print("Unreachable lines:", *self.unreachable, file=self.output)
+		else:
+			print("No unreachable lines", file=self.output)
+		self.output.flush()
+
+	def profile_data(self, profile):
+		return [{
+			"line": i,
+			"hits": profile[i][0],
+			"self": profile[i][1],
+			"cumulative": profile[i][2],
+			"source": self.program.get(i, ""),
+		} for i in sorted(profile, key=lambda i: -profile[i][1])]
+
+	def profile_report(self, profile):
+		"""List the lines that ran, slowest first, with hit counts and
+		times in milliseconds in the margin."""
+		print("{:>9} {:>10} {:>10}  {}".format(
+			"hits", "self ms", "cum ms", "line"), file=self.output)
+		total = 0.0
+		for i in self.profile_data(profile):
+			total += i["self"]
+			print("{:9d} {:10.3f} {:10.3f}  {}\t{}".format(
+				i["hits"], i["self"] * 1000, i["cumulative"] * 1000,
+				i["line"], i["source"]), file=self.output)
+		print("Total {:.3f} ms in {} lines".format(
+			total * 1000, len(profile)), file=self.output)
+		self.output.flush()
+
+	def parse_target(self):
+		t = self.tokens[self.cursor]
+		if t[0] == "number" and self.tokens[self.cursor + 1][0] == "eol":
+			# Plain line number, as in most programs: skip the expression parser.
+			self.cursor += 1
+			line_num = int(t[2])
+		else:
+			line_num = int(self.parse_expression())
+		try:
+			return self.line_index[line_num]
+		except KeyError:
+			raise ValueError("Line not found: " + str(line_num))
 
-stack = []
+	def parse_goto(self):
+		self.crt_line = self.parse_target()
 
-def parse_gosub():
-	global crt_line
-	line_num = int(parse_expression())
-	if line_num in addr:
-		stack.append(crt_line)
-		crt_line = addr.index(line_num)
-	else:
-		raise ValueError("Line not found: " + line_num)
+	def parse_gosub(self):
+		target = self.parse_target()
+		self.stack.append(self.crt_line)
+		self.crt_line = target
 
-def parse_return():
-	global crt_line
-	if len(stack) > 0:
-		crt_line = stack.pop()
-	else:
-		raise RuntimeError("Stack underflow")
+	def parse_return(self):
+		if len(self.stack) > 0:
+			self.crt_line = self.stack.pop()
+		else:
+			raise RuntimeError("RETURN without GOSUB")
 
-def parse_end():
-	global crt_line
-	crt_line = len(addr)
+	def parse_end(self):
+		self.crt_line = len(self.addr)
 
-def parse_stop():
-	global stop
-	stop = True
+	def parse_stop(self):
+		self.stop = True
 
-def parse_do():
-	stack.append(crt_line)
+	def parse_do(self):
+		self.do_stack.append(self.crt_line)
 
-def parse_loop():
-	global crt_line
-	if match_nocase("while"):
-		if parse_disjunction():
-			crt_line = stack[-1]
+	def parse_loop(self):
+		if self.match_nocase("while"):
+			repeat = self.parse_disjunction()
+		elif self.match_nocase("until"):
+			repeat = not self.parse_disjunction()
 		else:
-			stack.pop()
-	elif match_nocase("until"):
-		if parse_disjunction():
-			stack.pop()
+			raise SyntaxError("Condition expected")
+		if len(self.do_stack) == 0:
+			raise RuntimeError("LOOP without DO")
+		if repeat:
+			self.crt_line = self.do_stack[-1]
 		else:
-			crt_line = stack[-1]
-	else:
-		raise SyntaxError("Condition expected")
-
-def parse_for():
-	if not match_varname():
-		raise SyntaxError("Variable expected")
-
-	var_name = token.lower()
-	
-	if not match("="):
-		raise SyntaxError("'=' expected")
-
-	variables[var_name] = parse_expression()
-	
-	if not match_nocase("to"):
-		raise SyntaxError("'to' expected")
-
-	limit = parse_expression()
-	
-	if match_nocase("step"):
-		step = parse_expression()
-		if step == 0:
-			raise ValueError("Infinite loop")
-	else:
-		step = 1
-
-	stack.append(crt_line)
-	stack.append(limit)
-	stack.append(step)
-
-def parse_next():
-	global crt_line
-
-	if not match_varname():
-		raise SyntaxError("Variable expected")
-
-	var_name = token.lower()
-
-	if var_name not in variables:
-		raise NameError("Var not found: " + var_name)
-	
-	variables[var_name] += stack[-1]
-	if stack[-1] > 0:
-		done = variables[var_name] > stack[-2]
-	elif stack[-1] < 0:
-		done = variables[var_name] < stack[-2]
-	
-	if done:
-		stack.pop()
-		stack.pop()
-		stack.pop()
-	else:
-		crt_line = stack[-3]
+			self.do_stack.pop()
 
-def parse_randomize():
-	if match_eol():
-		random.seed()
-	else:
-		random.seed(int(parse_expression()))
-
-def parse_delete():
-	line_num1 = parse_expression()
-	if match(","):
-		line_num2 = parse_expression()
-		addr = sorted(program.keys())
-		for i in addr:
-			if line_num1 <= i <= line_num2:
-				del program[i]
-	else:
-		del program[line_num1]
+	def parse_for(self):
+		if not self.match_varname():
+			raise SyntaxError("Variable expected")
+
+		slot = self.tokens[self.cursor - 1][2]
+		
+		if not self.match("="):
+			raise SyntaxError("'=' expected")
+
+		self.values[slot] = self.parse_expression()
+		
+		if not self.match_nocase("to"):
+			raise SyntaxError("'to' expected")
+
+		limit = self.parse_expression()
+		
+		if self.match_nocase("step"):
+			step = self.parse_expression()
+			if step == 0:
+				raise ValueError("Infinite loop")
+		else:
+			step = 1
+
+		self.start_loop(self.crt_line - 1, slot, limit, step)
+
+	def parse_next(self):
+		if not self.match_varname():
+			raise SyntaxError("Variable expected")
+
+		slot = self.tokens[self.cursor - 1][2]
+		values = self.values
+
+		if values[slot] is None:
+			raise NameError("Var not found: " + self.token)
+
+		fors = self.for_stack
+		pair = self.next_pairs.get(self.crt_line - 1)
+		frame = fors[-1] if fors else None
+		if frame is None or frame.line != pair:
+			frame = self.find_loop(pair, slot)
 		
-def save_program():
-	if not match_string():
-		raise SyntaxError("Filename expected")
-	addr = sorted(program.keys())
-	with open(token, "w") as f:
-		for i in addr:
-			print(i, program[i], sep="\t", file=f)
-
-def load_program():
-	global line, cursor
-	if not match_string():
-		raise SyntaxError("Filename expected")
-	with open(token, "r") as f:
-		for i in f:
-			line = i.strip()
-			cursor = 0
-			parse_line()
+		step = frame.step
+		value = values[slot] + step
+		values[slot] = value
+		if value > frame.limit if step > 0 else value < frame.limit:
+			fors.pop()
+		else:
+			self.crt_line = frame.line + 1
+
+	def parse_randomize(self):
+		if self.match_eol():
+			self.rng.seed()
+		else:
+			self.rng.seed(int(self.parse_expression()))
+
+	def parse_range(self):
+		"""Parse the lines a command applies to: a number, a range such as
+		100-200 (or 100,200), or a range with an open end such as 100- or
+		-200. Return the first and last line number, None where open."""
+		first = last = None
+		if self.match_number():
+			first = last = self.token
+		if self.match("-") or self.match(","):
+			last = None
+			if self.match_number():
+				last = self.token
+		if not self.match_eol():
+			raise SyntaxError("Line range expected")
+		return first, last
+
+	def parse_delete(self):
+		first, last = self.parse_range()
+		if first is None and last is None:
+			raise SyntaxError("Line range expected")
+		for i in self.program.remove(first, last):
+			self.token_cache.pop(i, None)
+			self.shapes.pop(i, None)
+		self.edited = True
+			
+	def save_program(self):
+		if not self.match_string():
+			raise SyntaxError("Filename expected")
+		with open(self.token, "w") as f:
+			for i in self.program:
+				print(i, self.program[i], sep="\t", file=f)
+
+	def load_program(self):
+		if not self.match_string():
+			raise SyntaxError("Filename expected")
+		with open(self.token, "r") as f:
+			self.load_source(f.read())
+
+	def load_source(self, source):
+		"""Store the lines of a saved program, from the cache if possible."""
+		if self.cache is None:
+			self.load_lines(source.splitlines())
+			return
+		lines = self.cache.get(source)
+		if lines is None:
+			lines = scan_lines(source)
+			if lines is None:
+				self.load_lines(source.splitlines())
+				return
+			self.cache.put(source, lines)
+		for line_num, text, tokens in lines:
+			self.program[line_num] = text
+			self.cache_tokens(line_num, self.resolve(tokens))
+		self.compiled = None
+		self.edited = True
+
+	def load_lines(self, lines):
+		for i in lines:
+			self.set_line(i.strip())
+			self.parse_line()
+
+	def run(self, source, inputs=""):
+		"""Run the program in source from scratch, and return its output.
+
+		The source is text as in a saved program. Inputs is either a string
+		or a list of lines, and takes the place of the keyboard meanwhile.
+		"""
+		if not isinstance(inputs, str):
+			inputs = "".join(i + "\n" for i in inputs)
+		saved = self.stdin, self.stdout
+		self.stdin = io.StringIO(inputs)
+		self.stdout = io.StringIO()
+		try:
+			self.new_program()
+			self.variables.clear()
+			self.load_source(source)
+			self.run_program()
+			return self.stdout.getvalue()
+		finally:
+			self.stdin, self.stdout = saved
+
+	def command_loop(self, banner):
+		print(banner, file=self.output)
+		done = False
+		while not done:
+			try:
+				self.set_line(self.read_line("> "))
+			except SyntaxError as e:
+				self.print_error(e)
+				continue
+			except EOFError:
+				break
+			if self.match_nocase("bye"):
+				done = True
+			elif self.match_nocase("list"):
+				try:
+					self.list_program(*self.parse_range())
+				except SyntaxError as e:
+					self.print_error(e, "in column", self.column())
+			elif self.match_nocase("run"):
+				if self.match_nocase("fast"):
+					self.run_fast()
+				elif self.match_nocase("profile"):
+					if self.match_string():
+						self.run_profile(self.token)
+					else:
+						self.run_profile()
+				else:
+					self.run_program()
+			elif self.match_nocase("cfg"):
+				if self.match_string():
+					self.flow_graph(self.token)
+				else:
+					self.flow_graph()
+			elif self.match_nocase("continue"):
+				self.continue_program()
+			elif self.match_nocase("clear"):
+				self.variables.clear()
+			elif self.match_nocase("new"):
+				self.new_program()
+			elif self.match_nocase("delete"):
+				try:
+					self.parse_delete()
+				except SyntaxError as e:
+					self.print_error(e, "in column", self.column())
+			elif self.match_nocase("save"):
+				self.save_program()
+			elif self.match_nocase("load"):
+				self.load_program()
+			else:
+				try:
+					self.parse_line()
+				except Exception as e:
+					self.print_error(e, "in column", self.column())
 
 statements = {
-	"let": parse_let,
-	"print": parse_print,
-	"input": parse_input,
-	"if": parse_if,
-	"goto": parse_goto,
-	"gosub": parse_gosub,
-	"return": parse_return,
-	"end": parse_end,
-	"stop": parse_stop,
-	"do": parse_do,
-	"loop": parse_loop,
-	"for": parse_for,
-	"next": parse_next,
-	"def": parse_def,
-	"rem": parse_rem,
-	"randomize": parse_randomize
+	"let": Interpreter.parse_let,
+	"print": Interpreter.parse_print,
+	"input": Interpreter.parse_input,
+	"if": Interpreter.parse_if,
+	"goto": Interpreter.parse_goto,
+	"gosub": Interpreter.parse_gosub,
+	"return": Interpreter.parse_return,
+	"end": Interpreter.parse_end,
+	"stop": Interpreter.parse_stop,
+	"do": Interpreter.parse_do,
+	"loop": Interpreter.parse_loop,
+	"for": Interpreter.parse_for,
+	"next": Interpreter.parse_next,
+	"def": Interpreter.parse_def,
+	"rem": Interpreter.parse_rem,
+	"randomize": Interpreter.parse_randomize
+}
+
+function_args = {
+	"timer": [],
+	"rnd": [],
+	"pi": [],
+	"int": ["n"],
+	"abs": ["n"],
+	"sqr": ["n"],
+	"sin": ["n"],
+	"cos": ["n"],
+	"rad": ["n"],
+	"deg": ["n"],
+	"min": ["a", "b"],
+	"max": ["a", "b"],
+	"mod": ["a", "b"],
+	"hypot2": ["a", "b"],
+	"hypot3": ["a", "b", "c"],
+	"iif": ["a", "b", "c"],
 }
 
 functions = {
@@ -676,53 +1754,95 @@ functions = {
 	"iif": lambda a, b, c: a and b or c
 }
 
+# Built-ins whose result only depends on their arguments. User functions
+# calling nothing else get their results cached.
+pure_functions = set(functions) - set(["timer", "rnd"])
+
 def command_loop(banner):
-	global line, cursor
-	print(banner)
-	done = False
-	while not done:
-		try:
-			line = input("> ")
-		except SyntaxError as e:
-			print(e)
-			continue
-		except EOFError:
-			break
-		cursor = 0
-		if match_nocase("bye"):
-			done = True
-		elif match_nocase("list"):
-			list_program()
-		elif match_nocase("run"):
-			run_program()
-		elif match_nocase("continue"):
-			continue_program()
-		elif match_nocase("clear"):
-			variables.clear()
-		elif match_nocase("new"):
-			program.clear()
-		elif match_nocase("delete"):
-			parse_delete()
-		elif match_nocase("save"):
-			save_program()
-		elif match_nocase("load"):
-			load_program()
-		else:
-			try:
-				parse_line()
-			except Exception as e:
-				print(e, "in column", cursor)
+	Interpreter().command_loop(banner)
 
 if __name__ == "__main__":
-	import sys
-	if len(sys.argv) > 1:
-		for i in sys.argv[1:]:
-			line = '"' + i + '"'
-			cursor = 0
-			load_program()
-		run_program()
-		if stop:
-			command_loop(
-				"Tinycat BASIC v1.1 READY\nType BYE to quit.")
+	import argparse
+	cmdline = argparse.ArgumentParser(description="Tinycat BASIC")
+	cmdline.add_argument("files", nargs="*", help="programs to load and run")
+	cmdline.add_argument("-e", "--engine", choices=engines, default="classic",
+		help="how to execute programs (default: %(default)s)")
+	cmdline.add_argument("-f", "--fast", action="store_true",
+		help="compile the whole program to Python, like RUN FAST")
+	cmdline.add_argument("--python", action="store_true",
+		help="print the Python source RUN FAST would use, then quit")
+	cmdline.add_argument("--cfg", action="store_true",
+		help="print the program's control-flow graph in DOT, then quit")
+	cmdline.add_argument("-s", "--short-circuit", action="store_true",
+		help="only evaluate the operands of AND, OR and IIF that are needed")
+	cmdline.add_argument("--no-cache", action="store_true",
+		help="always tokenize programs, without reading or writing the cache")
+	cmdline.add_argument("--cache-dir", help="where to keep tokenized programs"
+		" (default: $TINYCAT_CACHE or ~/.cache/tinycat-basic)")
+	cmdline.add_argument("--cache-size", type=float, default=16,
+		help="megabytes the cache may take up (default: %(default)s)")
+	cmdline.add_argument("-u", "--unbuffered", action="store_true",
+		help="write PRINT output right away instead of in blocks"
+		" (the default when it goes to a terminal)")
+	cmdline.add_argument("--fused", action="store_true",
+		help="afterwards, print how often each fused line shape ran")
+	cmdline.add_argument("--traces", action="store_true",
+		help="afterwards, print the loops the tracing engine compiled")
+	cmdline.add_argument("--folded", action="store_true",
+		help="afterwards, print how many syntax tree nodes the optimizer"
+			" removed")
+	cmdline.add_argument("--hoisted", action="store_true",
+		help="afterwards, print what RUN FAST moved out of FOR loops")
+	cmdline.add_argument("--unreachable", action="store_true",
+		help="afterwards, print the lines no path from the start leads to")
+	cmdline.add_argument("--memo-size", type=int, default=1024,
+		help="results cached for each pure user function (default:"
+			" %(default)s; 0 turns caching off)")
+	cmdline.add_argument("--memo", action="store_true",
+		help="afterwards, print how the caches of user functions did")
+	cmdline.add_argument("-p", "--profile", action="store_true",
+		help="time each line and print a report, like RUN PROFILE")
+	cmdline.add_argument("--profile-json", metavar="FILE",
+		help="also save the profile as JSON")
+	options = cmdline.parse_args()
+	banner = "Tinycat BASIC v{} READY\nType BYE to quit.".format(version)
+	basic = Interpreter(engine=options.engine)
+	basic.short_circuit = options.short_circuit
+	basic.memo_size = options.memo_size
+	if options.unbuffered:
+		basic.output.limit = 0
+	if not options.no_cache:
+		basic.cache = cache.ProgramCache(cache_key, options.cache_dir,
+			int(options.cache_size * 1024 * 1024))
+	if len(options.files) > 0:
+		for i in options.files:
+			basic.set_line('"' + i + '"')
+			basic.load_program()
+		if options.python:
+			print(basic.fast_source(), end="")
+			sys.exit()
+		elif options.cfg:
+			basic.flow_graph()
+			sys.exit()
+		elif options.fast:
+			basic.run_fast()
+		elif options.profile or options.profile_json:
+			basic.run_profile(options.profile_json)
+		else:
+			basic.run_program()
+		if options.fused:
+			basic.fused_report()
+		if options.memo:
+			basic.memo_report()
+		if options.folded:
+			basic.optimizer_report()
+		if options.unreachable:
+			basic.unreachable_report()
+		if options.hoisted:
+			basic.hoisting_report()
+		if options.traces and isinstance(basic.compiled, tracing.TracingProgram):
+			basic.compiled.report()
+		if basic.stop:
+			basic.command_loop(banner)
 	else:
-		command_loop("Tinycat BASIC v1.1 READY\nType BYE to quit.")
+		basic.command_loop(banner)
@@ -0,0 +1,184 @@
+#!/usr/bin/python3
+
+"""Run many Tinycat BASIC programs on a pool of warm worker processes.
+
+Jobs come either from a directory, where every .bas file is a job and a
+file with the same name ending in .in (if any) is its input, or from a
+manifest: a text file with one program per line, optionally followed by
+the name of its input file. Relative names in a manifest are relative to
+the manifest itself; blank lines and lines starting with # are skipped.
+
+Each worker process keeps one interpreter around and reuses it for every
+job it gets. Output and error messages are captured separately for each
+job, and a job running longer than the timeout is cut short.
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import concurrent.futures
+import io
+import json
+import os
+import signal
+import time
+
+import basic
+import cache
+
+class JobTimeout(BaseException):
+	"""Raised in a worker when a job runs out of time.
+
+	Not an Exception, so the interpreter's own error handling lets it
+	through instead of reporting it as an error in some line.
+	"""
+
+def find_jobs(path):
+	"""Return a list of (name, program file, input file or None)."""
+	jobs = []
+	if os.path.isdir(path):
+		for i in sorted(os.listdir(path)):
+			if i.endswith(".bas"):
+				name = i[:-4]
+				inputs = os.path.join(path, name + ".in")
+				if not os.path.exists(inputs):
+					inputs = None
+				jobs.append((name, os.path.join(path, i), inputs))
+	else:
+		base = os.path.dirname(path)
+		with open(path, "r") as f:
+			for i in f:
+				fields = i.split()
+				if not fields or fields[0].startswith("#"):
+					continue
+				program = os.path.join(base, fields[0])
+				if len(fields) > 1:
+					inputs = os.path.join(base, fields[1])
+				else:
+					inputs = None
+				name = os.path.splitext(fields[0])[0]
+				jobs.append((name, program, inputs))
+	return jobs
+
+def read_job(job, timeout):
+	name, program, inputs = job
+	with open(program, "r") as f:
+		source = f.read()
+	if inputs is None:
+		text = ""
+	else:
+		with open(inputs, "r") as f:
+			text = f.read()
+	return (name, source, text, timeout)
+
+interpreter = None # One per worker process, reused between jobs
+
+def start_worker(engine, use_cache=True):
+	global interpreter
+	interpreter = basic.Interpreter(engine=engine)
+	if use_cache:
+		interpreter.cache = cache.ProgramCache(basic.cache_key)
+
+def time_out(signum, frame):
+	raise JobTimeout()
+
+def run_job(job):
+	"""Run one job in the current worker; return a dict with the results."""
+	name, source, inputs, timeout = job
+	output = io.StringIO()
+	errors = io.StringIO()
+	interpreter.stdin = io.StringIO(inputs)
+	interpreter.stdout = output
+	interpreter.stderr = errors
+	status = "ok"
+	mark = time.time()
+	if timeout:
+		signal.signal(signal.SIGALRM, time_out)
+		signal.setitimer(signal.ITIMER_REAL, timeout)
+	try:
+		interpreter.new_program()
+		interpreter.variables.clear()
+		interpreter.load_source(source)
+		interpreter.run_program()
+	except JobTimeout:
+		status = "timeout"
+	except Exception as e:
+		print(e, file=errors)
+	finally:
+		if timeout:
+			signal.setitimer(signal.ITIMER_REAL, 0)
+	wall = time.time() - mark
+	if status == "ok" and errors.getvalue():
+		status = "error"
+	return {
+		"name": name,
+		"status": status,
+		"wall": wall,
+		"output": output.getvalue(),
+		"errors": errors.getvalue(),
+	}
+
+def run_batch(jobs, workers=None, timeout=None, engine="classic",
+		use_cache=True):
+	"""Run jobs on a process pool; return the results in order, and the
+	total time taken."""
+	todo = [read_job(i, timeout) for i in jobs]
+	workers = workers or os.cpu_count() or 1
+	chunk = max(1, len(todo) // (workers * 4))
+	mark = time.time()
+	with concurrent.futures.ProcessPoolExecutor(
+			max_workers=workers,
+			initializer=start_worker,
+			initargs=(engine, use_cache)) as pool:
+		results = list(pool.map(run_job, todo, chunksize=chunk))
+	return results, time.time() - mark
+
+def save_results(results, directory):
+	if not os.path.isdir(directory):
+		os.makedirs(directory)
+	for i in results:
+		with open(os.path.join(directory, i["name"] + ".out"), "w") as f:
+			f.write(i["output"])
+		with open(os.path.join(directory, i["name"] + ".err"), "w") as f:
+			f.write(i["errors"])
+
+if __name__ == "__main__":
+	import argparse
+	cmdline = argparse.ArgumentParser(
+		description="Run many Tinycat BASIC programs in parallel.")
+	cmdline.add_argument("jobs", help="directory of .bas files, or manifest")
+	cmdline.add_argument("-w", "--workers", type=int,
+		help="worker processes (default: one per CPU)")
+	cmdline.add_argument("-t", "--timeout", type=float,
+		help="seconds each job may run")
+	cmdline.add_argument("-e", "--engine", choices=basic.engines,
+		default="classic", help="execution engine (default: %(default)s)")
+	cmdline.add_argument("--no-cache", action="store_true",
+		help="don't keep tokenized programs between runs")
+	cmdline.add_argument("-o", "--output",
+		help="directory for each job's .out and .err files")
+	cmdline.add_argument("--json", action="store_true",
+		help="print results as JSON instead of a table")
+	options = cmdline.parse_args()
+
+	results, elapsed = run_batch(
+		find_jobs(options.jobs),
+		options.workers,
+		options.timeout,
+		options.engine,
+		not options.no_cache)
+	if options.output:
+		save_results(results, options.output)
+	rate = len(results) / elapsed if elapsed > 0 else 0
+	if options.json:
+		print(json.dumps({
+			"jobs": results,
+			"elapsed": elapsed,
+			"jobs_per_second": rate,
+		}, indent=1))
+	else:
+		for i in results:
+			print("{:<24} {:<8} {:8.3f}s".format(
+				i["name"], i["status"], i["wall"]))
+		print("{} jobs in {:.3f}s, {:.1f} jobs/s".format(
+			len(results), elapsed, rate))
@@ -0,0 +1,803 @@
+#!/usr/bin/python3
+
+"""Bytecode compiler and virtual machine for Tinycat BASIC.
+
+Stored lines are parsed into the same syntax trees as the closure
+compiler uses, then flattened into stack machine code in an array of
+integers: each instruction is an opcode followed by its operands. Numbers
+live in a constant pool of floats, and anything else an instruction needs
+(strings, names, callables) in a second pool of objects. The code of each
+line follows that of the line before, so running on to the next line
+takes no instruction at all. DEF FN bodies are compiled after the
+program, and run by the same loop with their arguments in a tuple.
+
+Line indexes on the GOSUB, DO and FOR stacks are the same as with the
+other engines, so a program stopped here can be continued by another.
+
+Run as a script to disassemble programs, or to check that the virtual
+machine gives the same output as the classic interpreter on every .bas
+file that comes with Tinycat BASIC and the book.
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import bisect
+import glob
+import os
+from array import array
+
+import compiler
+from compiler import Stopped, located
+
+# Opcodes, and how many operands follow each of them.
+opcodes = (
+	("CONST", 1), # Push constant k
+	("LOAD", 1), # Push the variable in slot k
+	("STORE", 1), # Pop into the variable in slot k
+	("ADD", 0), ("SUB", 0), ("MUL", 0), ("DIV", 0), ("IDIV", 0), ("POW", 0),
+	("EQ", 0), ("NE", 0), ("LT", 0), ("LE", 0), ("GT", 0), ("GE", 0),
+	("AND", 0), ("OR", 0), ("NEG", 0), ("NOT", 0),
+	("JUMP_IF_FALSE", 1), # Pop; jump to address if zero
+	("JUMP", 1), # Jump to address
+	("NEXT", 4), # Variable slot, FOR line or -1, next line, 1 if alone on its line
+	("LOAD_ARG", 1), # Push argument k of the current function
+	("CALL", 2), # Call builtin object k with n arguments
+	("CALL_USER", 2), # Call user function named by object k, n arguments
+	("RET", 0), # Return from a function with the value on top
+	("PRINT", 2), # Print n items, then a newline if the flag is set
+	("STR", 1), # Push string object k
+	("GOSUB", 2), # Push return line; jump to address
+	("RETURN", 0),
+	("GOTO", 0), # Pop a line number and go there
+	("GOSUB_LINE", 1), # Pop a line number, push return line, go there
+	("DO", 1), # Push the line starting the loop
+	("LOOP", 2), # Pop condition; 1 for WHILE or 0 for UNTIL, next line
+	("FOR", 3), # Pop start, limit and step (if flag); slot, line, flag
+	("INPUT", 1), # Prompt and names in object k
+	("DEF", 1), # Function definition in object k
+	("RANDOMIZE", 1), # Seed from the value on top if the flag is set
+	("BAD_ARGS", 1), # Pop n arguments and fail with a bad count
+	("MISSING", 1), # Fail: no variable by the name in object k
+	("CLASSIC", 1), # Statement object k runs in the classic interpreter
+	("FAIL", 1), # Raise the exception in object k
+	("STOP", 1), # Stop, resuming at line n
+	("END", 0),
+	("HALT", 0), # The end of the program
+)
+
+opnames = tuple(i[0] for i in opcodes)
+arity = tuple(i[1] for i in opcodes)
+
+(CONST, LOAD, STORE, ADD, SUB, MUL, DIV, IDIV, POW, EQ, NE, LT, LE, GT, GE,
+	AND, OR, NEG, NOT, JUMP_IF_FALSE, JUMP, NEXT, LOAD_ARG, CALL, CALL_USER,
+	RET, PRINT, STR, GOSUB, RETURN, GOTO, GOSUB_LINE, DO, LOOP, FOR, INPUT,
+	DEF, RANDOMIZE, BAD_ARGS, MISSING, CLASSIC, FAIL, STOP, END_, HALT
+	) = range(len(opcodes))
+
+binary_ops = {
+	"+": ADD, "-": SUB, "*": MUL, "/": DIV, "\\": IDIV, "^": POW,
+	"=": EQ, "<>": NE, "<": LT, "<=": LE, ">": GT, ">=": GE,
+	"and": AND, "or": OR,
+}
+
+class BytecodeProgram(object):
+	"""The stored program compiled to bytecode."""
+
+	def __init__(self, ctx):
+		self.ctx = ctx
+		self.index = ctx.line_index
+		self.fn_names = compiler.function_names(ctx)
+		self.code = array("l")
+		self.constants = [] # Floats
+		self.objects = []
+		self.starts = [] # Address of each line's code, by line index
+		self.columns = [] # End column of each line, for error messages
+		self.op_columns = {} # Column of instructions that can fail
+		self.args = None # Argument names -> index, in a function body
+		self.bodies = [] # (DEF object index, body tree) to compile later
+		self.fixups = [] # (operand address, line index) for jumps
+		self.optimizer = compiler.Optimizer(ctx)
+		for i in range(len(ctx.addr)):
+			self.compile_line(i)
+		self.starts.append(len(self.code))
+		self.emit(HALT)
+		for k, args, tree in self.bodies:
+			self.compile_body(k, args, tree)
+		for address, i in self.fixups:
+			self.code[address] = self.starts[i]
+
+	def update(self):
+		"""Edits mean compiling the whole program again, so return False."""
+		return False
+
+	def removed_nodes(self):
+		return self.optimizer.removed
+
+	def emit(self, op, *operands):
+		self.code.append(op)
+		self.code.extend(operands)
+		return len(self.code) - len(operands) - 1
+
+	def constant(self, value):
+		self.constants.append(float(value))
+		return len(self.constants) - 1
+
+	def add_object(self, value):
+		self.objects.append(value)
+		return len(self.objects) - 1
+
+	def compile_line(self, i):
+		ctx = self.ctx
+		self.starts.append(len(self.code))
+		try:
+			tokens = ctx.line_tokens(ctx.addr[i])
+			tree, column = compiler.parse_line(
+				tokens, self.fn_names, ctx.statements)
+			tree = self.optimizer.statement(tree)
+			marks = len(self.code), len(self.fixups), len(self.bodies)
+			try:
+				self.statement(tree, i + 1)
+			except Exception:
+				del self.code[marks[0]:]
+				del self.fixups[marks[1]:]
+				del self.bodies[marks[2]:]
+				raise
+		except Exception as e:
+			self.emit(FAIL, self.add_object(e))
+			column = getattr(e, "column", 0)
+		self.columns.append(column)
+
+	def line_address(self, i):
+		"""Emit the address of line i as an operand, once it's known."""
+		self.fixups.append((len(self.code), i))
+		self.code.append(0)
+
+	def compile_body(self, k, args, tree):
+		self.args = dict((n, i) for i, n in enumerate(args))
+		name, args, tokens, _ = self.objects[k]
+		self.objects[k] = (name, args, tokens, len(self.code))
+		self.expression(tree)
+		self.emit(RET)
+		self.args = None
+
+	# Statements; nxt is the index of the line after this one.
+
+	def statement(self, tree, nxt):
+		getattr(self, "stmt_" + tree[0])(tree, nxt)
+
+	def stmt_rem(self, tree, nxt):
+		pass
+
+	def stmt_let(self, tree, nxt):
+		self.expression(tree[2])
+		self.emit(STORE, self.ctx.variables.slot(tree[1]))
+
+	def stmt_print(self, tree, nxt):
+		for i in tree[1]:
+			if i[0] == "str":
+				self.emit(STR, self.add_object(i[1]))
+			else:
+				self.expression(i)
+		self.emit(PRINT, len(tree[1]), 1 if tree[2] or not tree[1] else 0)
+
+	def stmt_input(self, tree, nxt):
+		self.emit(INPUT, self.add_object((tree[1], tree[2])))
+
+	def stmt_if(self, tree, nxt):
+		self.expression(tree[1])
+		jump = self.emit(JUMP_IF_FALSE, 0)
+		self.statement(tree[2], nxt)
+		self.code[jump + 1] = len(self.code)
+
+	def stmt_goto(self, tree, nxt):
+		if tree[1][0] == "num" and int(tree[1][1]) in self.index:
+			self.code.append(JUMP)
+			self.line_address(self.index[int(tree[1][1])])
+		else:
+			self.expression(tree[1])
+			self.emit(GOTO)
+
+	def stmt_gosub(self, tree, nxt):
+		if tree[1][0] == "num" and int(tree[1][1]) in self.index:
+			self.code.extend((GOSUB, nxt))
+			self.line_address(self.index[int(tree[1][1])])
+		else:
+			self.expression(tree[1])
+			self.emit(GOSUB_LINE, nxt)
+
+	def stmt_return(self, tree, nxt):
+		self.emit(RETURN)
+
+	def stmt_end(self, tree, nxt):
+		self.emit(END_)
+
+	def stmt_stop(self, tree, nxt):
+		self.emit(STOP, nxt)
+
+	def stmt_do(self, tree, nxt):
+		self.emit(DO, nxt)
+
+	def stmt_loop(self, tree, nxt):
+		self.expression(tree[2])
+		self.emit(LOOP, 1 if tree[1] == "while" else 0, nxt)
+
+	def stmt_for(self, tree, nxt):
+		self.expression(tree[2])
+		self.expression(tree[3])
+		if tree[4] is not None:
+			self.expression(tree[4])
+		self.emit(FOR, self.ctx.variables.slot(tree[1]), nxt - 1,
+			0 if tree[4] is None else 1)
+
+	def stmt_next(self, tree, nxt):
+		pair = self.ctx.next_pairs.get(nxt - 1, -1)
+		# A NEXT alone on its line goes round in place if its FOR is the
+		# line before, with nothing in between.
+		alone = self.ctx.line_tokens(
+			self.ctx.addr[nxt - 1])[0][1] == "next"
+		pc = self.emit(NEXT, self.ctx.variables.slot(tree[1]), pair, nxt,
+			1 if alone else 0)
+		self.op_columns[pc] = tree[2]
+
+	def stmt_def(self, tree, nxt):
+		k = self.add_object((tree[1], tree[2], tree[4], None))
+		self.bodies.append((k, tree[2], tree[3]))
+		pc = self.emit(DEF, k)
+		self.op_columns[pc] = tree[5]
+
+	def stmt_randomize(self, tree, nxt):
+		if tree[1] is None:
+			self.emit(RANDOMIZE, 0)
+		else:
+			self.expression(tree[1])
+			self.emit(RANDOMIZE, 1)
+
+	def stmt_error(self, tree, nxt):
+		self.emit(FAIL, self.add_object(tree[1]))
+
+	def stmt_classic(self, tree, nxt):
+		handler = self.ctx.statements[tree[1]]
+		self.emit(CLASSIC, self.add_object((handler, tree[2], tree[3], nxt)))
+
+	# Expressions leave their value on the stack.
+
+	def expression(self, tree):
+		kind = tree[0]
+		if kind == "num":
+			self.emit(CONST, self.constant(tree[1]))
+		elif kind == "var":
+			self.variable(tree[1], tree[2])
+		elif kind == "neg":
+			self.expression(tree[1])
+			self.emit(NEG)
+		elif kind == "not":
+			self.expression(tree[1])
+			self.emit(NOT)
+		elif kind == "call":
+			self.call(tree[1], tree[2], tree[3], tree[4])
+		elif kind in ("and", "or") and self.ctx.short_circuit:
+			self.expression(tree[1])
+			skip = self.emit(JUMP_IF_FALSE, 0)
+			if kind == "and":
+				self.truth(tree[2])
+				done = self.emit(JUMP, 0)
+				self.code[skip + 1] = len(self.code)
+				self.emit(CONST, self.constant(0))
+			else:
+				self.emit(CONST, self.constant(-1))
+				done = self.emit(JUMP, 0)
+				self.code[skip + 1] = len(self.code)
+				self.truth(tree[2])
+			self.code[done + 1] = len(self.code)
+		else:
+			self.expression(tree[1])
+			self.expression(tree[2])
+			pc = self.emit(binary_ops[kind])
+			self.op_columns[pc] = tree[3]
+
+	def truth(self, tree):
+		"""Leave -1 on the stack if the expression is nonzero, else 0."""
+		self.expression(tree)
+		self.emit(NOT)
+		self.emit(NOT)
+
+	def variable(self, name, column):
+		if self.args is None:
+			pc = self.emit(LOAD, self.ctx.variables.slot(name))
+		elif name in self.args:
+			pc = self.emit(LOAD_ARG, self.args[name])
+		else:
+			# Functions only see their own arguments.
+			pc = self.emit(MISSING, self.add_object(name))
+		self.op_columns[pc] = column
+
+	def call(self, name, args, column, name_column):
+		ctx = self.ctx
+		if name in ctx.functions and name not in ctx.function_code \
+				and compiler.lazy_iif(ctx, name, args):
+			self.expression(args[0])
+			skip = self.emit(JUMP_IF_FALSE, 0)
+			self.expression(args[1])
+			done = self.emit(JUMP, 0)
+			self.code[skip + 1] = len(self.code)
+			self.expression(args[2])
+			self.code[done + 1] = len(self.code)
+			return
+		for i in args:
+			self.expression(i)
+		if name in ctx.functions and name not in ctx.function_code:
+			if len(args) != len(ctx.function_args[name]):
+				pc = self.emit(BAD_ARGS, len(args))
+			else:
+				pc = self.emit(CALL,
+					self.add_object(ctx.functions[name]), len(args))
+			self.op_columns[pc] = column
+			return
+		# Until the function is defined, its name reads as a variable.
+		mark = len(self.code)
+		self.variable(name, name_column)
+		undefined = self.code[mark:]
+		del self.code[mark:]
+		pc = self.emit(CALL_USER,
+			self.add_object((name, tuple(undefined), name_column)), len(args))
+		self.op_columns[pc] = column
+
+	def function(self, name, argnames, body):
+		"""Return a Python function running the body at the given address,
+		as the closures engine and the classic interpreter expect."""
+		count = len(argnames)
+		execute = self.execute
+		def function(*args):
+			if len(args) != count:
+				raise RuntimeError("Bad argument count")
+			return execute(body, args)
+		return function
+
+	def run(self):
+		"""Run from ctx.crt_line until the end, an error or STOP."""
+		ctx = self.ctx
+		n = len(ctx.addr)
+		ctx.stop = False
+		try:
+			self.execute(self.starts[min(ctx.crt_line, n)], None)
+			ctx.crt_line = n
+		except Stopped as e:
+			ctx.stop = True
+			ctx.crt_line = e.resume
+		except Exception as e:
+			i = min(bisect.bisect_right(self.starts, e.basic_pc) - 1, n - 1)
+			ctx.crt_line = i + 1
+			column = getattr(e, "column", self.columns[i])
+			ctx.print_error(e, "in line", ctx.addr[i], "column", column)
+
+	def execute(self, pc, args):
+		"""The virtual machine. Runs the program from address pc, or a
+		function body given its arguments, and returns the value left by
+		RET (if any)."""
+		ctx = self.ctx
+		code = self.code
+		constants = self.constants
+		objects = self.objects
+		starts = self.starts
+		values = ctx.values
+		fors = ctx.for_stack
+		fmt = "{:1g}".format
+		write = ctx.output.write
+		stack = []
+		push = stack.append
+		pop = stack.pop
+		try:
+			while True:
+				op = code[pc]
+				if op == LOAD:
+					value = values[code[pc + 1]]
+					if value is None:
+						raise self.missing_var(pc)
+					push(value)
+					pc += 2
+				elif op == CONST:
+					push(constants[code[pc + 1]])
+					pc += 2
+				elif op == STORE:
+					values[code[pc + 1]] = pop()
+					pc += 2
+				elif op == ADD:
+					b = pop()
+					stack[-1] = stack[-1] + b
+					pc += 1
+				elif op == SUB:
+					b = pop()
+					stack[-1] = stack[-1] - b
+					pc += 1
+				elif op == MUL:
+					b = pop()
+					stack[-1] = stack[-1] * b
+					pc += 1
+				elif op == DIV:
+					b = pop()
+					stack[-1] = stack[-1] / b
+					pc += 1
+				elif op == IDIV:
+					b = pop()
+					stack[-1] = stack[-1] // b
+					pc += 1
+				elif op == POW:
+					b = pop()
+					stack[-1] = stack[-1] ** b
+					pc += 1
+				elif op == EQ:
+					b = pop()
+					stack[-1] = -(stack[-1] == b)
+					pc += 1
+				elif op == NE:
+					b = pop()
+					stack[-1] = -(stack[-1] != b)
+					pc += 1
+				elif op == LT:
+					b = pop()
+					stack[-1] = -(stack[-1] < b)
+					pc += 1
+				elif op == LE:
+					b = pop()
+					stack[-1] = -(stack[-1] <= b)
+					pc += 1
+				elif op == GT:
+					b = pop()
+					stack[-1] = -(stack[-1] > b)
+					pc += 1
+				elif op == GE:
+					b = pop()
+					stack[-1] = -(stack[-1] >= b)
+					pc += 1
+				elif op == AND:
+					b = pop()
+					stack[-1] = -(stack[-1] != 0 and b != 0)
+					pc += 1
+				elif op == OR:
+					b = pop()
+					stack[-1] = -(stack[-1] != 0 or b != 0)
+					pc += 1
+				elif op == NEG:
+					stack[-1] = -stack[-1]
+					pc += 1
+				elif op == NOT:
+					stack[-1] = -(stack[-1] == 0)
+					pc += 1
+				elif op == JUMP_IF_FALSE:
+					if pop() == 0:
+						pc = code[pc + 1]
+					else:
+						pc += 2
+				elif op == JUMP:
+					pc = code[pc + 1]
+				elif op == NEXT:
+					slot = code[pc + 1]
+					value = values[slot]
+					if value is None:
+						raise self.missing_var(pc)
+					pair = code[pc + 2]
+					frame = fors[-1] if fors else None
+					if frame is None or frame.line != pair:
+						frame = ctx.find_loop(None if pair < 0 else pair, slot)
+					step = frame.step
+					if code[pc + 4] and frame.line == code[pc + 3] - 2:
+						values[slot] = compiler.empty_loop(
+							value, step, frame.limit)[0]
+						fors.pop()
+						pc += 5
+						continue
+					value += step
+					values[slot] = value
+					if value > frame.limit if step > 0 else value < frame.limit:
+						fors.pop()
+						pc += 5
+					else:
+						pc = starts[frame.line + 1]
+				elif op == LOAD_ARG:
+					push(args[code[pc + 1]])
+					pc += 2
+				elif op == CALL:
+					fn = objects[code[pc + 1]]
+					n = code[pc + 2]
+					if n == 0:
+						push(fn())
+					elif n == 1:
+						stack[-1] = fn(stack[-1])
+					else:
+						argv = stack[-n:]
+						del stack[-n:]
+						push(fn(*argv))
+					pc += 3
+				elif op == CALL_USER:
+					name, undefined, column = objects[code[pc + 1]]
+					n = code[pc + 2]
+					function = ctx.compiled_functions.get(name)
+					if function is None:
+						if name not in ctx.function_code:
+							push(self.undefined(name, undefined, column, args))
+							pc += 3
+							continue
+						function = compiler.compile_function(ctx, name)
+					if n:
+						argv = stack[-n:]
+						del stack[-n:]
+					else:
+						argv = ()
+					try:
+						push(function(*argv))
+					except Exception as e:
+						# Errors show up where the function was called.
+						e.column = self.op_columns[pc]
+						raise
+					pc += 3
+				elif op == RET:
+					return pop()
+				elif op == PRINT:
+					n = code[pc + 1]
+					end = "\n" if code[pc + 2] else ""
+					if n == 0:
+						write(end)
+					else:
+						items = stack[-n:]
+						del stack[-n:]
+						write("".join([i if isinstance(i, str) else fmt(i)
+							for i in items]) + end)
+					pc += 3
+				elif op == STR:
+					push(objects[code[pc + 1]])
+					pc += 2
+				elif op == GOSUB:
+					ctx.stack.append(code[pc + 1])
+					pc = code[pc + 2]
+				elif op == RETURN:
+					if len(ctx.stack) == 0:
+						raise RuntimeError("RETURN without GOSUB")
+					pc = starts[ctx.stack.pop()]
+				elif op == GOTO:
+					pc = starts[self.target(pop())]
+				elif op == GOSUB_LINE:
+					i = self.target(pop())
+					ctx.stack.append(code[pc + 1])
+					pc = starts[i]
+				elif op == DO:
+					ctx.do_stack.append(code[pc + 1])
+					pc += 2
+				elif op == LOOP:
+					repeat = (pop() != 0) == (code[pc + 1] == 1)
+					if len(ctx.do_stack) == 0:
+						raise RuntimeError("LOOP without DO")
+					if repeat:
+						pc = starts[ctx.do_stack[-1]]
+					else:
+						ctx.do_stack.pop()
+						pc += 3
+				elif op == FOR:
+					if code[pc + 3]:
+						step = pop()
+						if step == 0:
+							raise ValueError("Infinite loop")
+					else:
+						step = 1
+					limit = pop()
+					slot = code[pc + 1]
+					values[slot] = pop()
+					ctx.start_loop(code[pc + 2], slot, limit, step)
+					pc += 4
+				elif op == INPUT:
+					prompt, names = objects[code[pc + 1]]
+					ctx.input_values(prompt, names)
+					pc += 2
+				elif op == DEF:
+					name, argnames, tokens, body = objects[code[pc + 1]]
+					if name in ctx.function_args:
+						raise RuntimeError("Duplicate function: " + name)
+					ctx.function_args[name] = argnames
+					ctx.function_code[name] = tokens
+					ctx.compiled_functions[name] = compiler.memoize(ctx, name,
+						self.function(name, argnames, body),
+						compiler.function_body(ctx, name))
+					pc += 2
+				elif op == RANDOMIZE:
+					if code[pc + 1]:
+						ctx.rng.seed(int(pop()))
+					else:
+						ctx.rng.seed()
+					pc += 2
+				elif op == BAD_ARGS:
+					raise RuntimeError("Bad argument count")
+				elif op == MISSING:
+					raise located(
+						NameError("Var not found: " + objects[code[pc + 1]]),
+						self.op_columns[pc])
+				elif op == CLASSIC:
+					handler, tokens, cursor, nxt = objects[code[pc + 1]]
+					ctx.tokens = tokens
+					ctx.cursor = cursor
+					ctx.crt_line = nxt
+					try:
+						handler(ctx)
+					except Exception as e:
+						e.column = ctx.column()
+						raise
+					if ctx.stop:
+						raise Stopped(ctx.crt_line)
+					pc = starts[min(ctx.crt_line, len(starts) - 1)]
+				elif op == FAIL:
+					raise objects[code[pc + 1]]
+				elif op == STOP:
+					raise Stopped(code[pc + 1])
+				elif op == END_ or op == HALT:
+					return None
+				else:
+					raise RuntimeError("Bad opcode {} at {}".format(op, pc))
+		except Stopped:
+			raise
+		except Exception as e:
+			e.basic_pc = pc
+			if pc in self.op_columns:
+				compiler.placed(e, self.op_columns[pc])
+			raise
+
+	def missing_var(self, pc):
+		slot = self.code[pc + 1]
+		for name, i in self.ctx.variables.slots.items():
+			if i == slot:
+				break
+		return located(NameError("Var not found: " + name),
+			self.op_columns[pc])
+
+	def undefined(self, name, code, column, args):
+		# The function name read as a variable, compiled beforehand.
+		if code[0] == LOAD_ARG:
+			return args[code[1]]
+		elif code[0] == LOAD and self.ctx.values[code[1]] is not None:
+			return self.ctx.values[code[1]]
+		raise located(NameError("Var not found: " + name), column)
+
+	def target(self, value):
+		line_num = int(value)
+		try:
+			return self.index[line_num]
+		except KeyError:
+			raise ValueError("Line not found: " + str(line_num))
+
+	def disassemble(self):
+		"""Return the bytecode as text, one instruction per line, under
+		the source of each program line."""
+		ctx = self.ctx
+		labels = {}
+		for i in range(len(ctx.addr)):
+			labels.setdefault(self.starts[i], []).append(
+				"{}\t{}".format(ctx.addr[i], ctx.program.get(ctx.addr[i], "")))
+		labels.setdefault(self.starts[-1], []).append("(end)")
+		for k in self.bodies:
+			name, args, tokens, body = self.objects[k[0]]
+			labels.setdefault(body, []).append(
+				"fn {}({})".format(name, ", ".join(args)))
+		slots = dict((i, n) for n, i in ctx.variables.slots.items())
+		out = []
+		pc = 0
+		while pc < len(self.code):
+			for i in labels.get(pc, ()):
+				out.append(i)
+			op = self.code[pc]
+			operands = list(self.code[pc + 1:pc + 1 + arity[op]])
+			out.append("{:6d}  {:<14}{}".format(pc, opnames[op],
+				self.describe(op, operands, slots)))
+			pc += 1 + arity[op]
+		return "\n".join(out) + "\n"
+
+	def describe(self, op, operands, slots):
+		ctx = self.ctx
+		if op == CONST:
+			return "{:g}".format(self.constants[operands[0]])
+		elif op in (LOAD, STORE):
+			return slots.get(operands[0], "?")
+		elif op == NEXT:
+			return slots.get(operands[0], "?")
+		elif op in (JUMP, JUMP_IF_FALSE):
+			return "-> {}".format(operands[0])
+		elif op == GOSUB:
+			return "-> {}, return to {}".format(operands[1],
+				self.line_name(operands[0]))
+		elif op in (DO, STOP, GOSUB_LINE):
+			return self.line_name(operands[0])
+		elif op == LOOP:
+			return "while" if operands[0] else "until"
+		elif op == FOR:
+			return "{}{}".format(slots.get(operands[0], "?"),
+				" with step" if operands[2] else "")
+		elif op in (STR, MISSING, INPUT, FAIL):
+			return repr(self.objects[operands[0]])
+		elif op == CALL:
+			for name, fn in ctx.functions.items():
+				if fn is self.objects[operands[0]]:
+					return "{}/{}".format(name, operands[1])
+			return "?/{}".format(operands[1])
+		elif op == CALL_USER:
+			return "{}/{}".format(self.objects[operands[0]][0], operands[1])
+		elif op == DEF:
+			name, args, tokens, body = self.objects[operands[0]]
+			return "{} -> {}".format(name, body)
+		elif op == CLASSIC:
+			return self.objects[operands[0]][0].__name__
+		else:
+			return " ".join(str(i) for i in operands)
+
+	def line_name(self, i):
+		if i < len(self.ctx.addr):
+			return "line {}".format(self.ctx.addr[i])
+		else:
+			return "end"
+
+def compile_program(ctx):
+	return BytecodeProgram(ctx)
+
+def bundled_programs():
+	"""The .bas files that come with Tinycat BASIC and the book, and the
+	ones in checks/ that try out corners of the language."""
+	here = os.path.dirname(os.path.abspath(__file__))
+	return sorted(glob.glob(os.path.join(here, "*.bas"))
+		+ glob.glob(os.path.join(here, "checks", "*.bas"))
+		+ glob.glob(os.path.join(here, "..", "*.bas")))
+
+def run_with(engine, source, inputs):
+	import basic
+	interpreter = basic.Interpreter(engine=engine)
+	interpreter.rng.seed(0)
+	ticks = [0]
+	def timer():
+		# The same readings for both engines, so timings compare equal.
+		ticks[0] += 1
+		return ticks[0]
+	interpreter.functions["timer"] = timer
+	return interpreter.run(source, inputs)
+
+def check_conformance(paths=None, report=None):
+	"""Run each program with the classic interpreter and the bytecode
+	engine, and return the list of those whose output differs. Input for
+	a program, if any, comes from a file of the same name ending in .in.
+	"""
+	failed = []
+	for path in paths or bundled_programs():
+		with open(path, "r") as f:
+			source = f.read()
+		inputs = ""
+		if os.path.exists(path[:-4] + ".in"):
+			with open(path[:-4] + ".in", "r") as f:
+				inputs = f.read()
+		expected = run_with("classic", source, inputs)
+		got = run_with("bytecode", source, inputs)
+		if got != expected:
+			failed.append(path)
+		if report:
+			report(path, got == expected)
+	return failed
+
+if __name__ == "__main__":
+	import argparse
+	import sys
+	import basic
+	cmdline = argparse.ArgumentParser(
+		description="Tinycat BASIC bytecode tools.")
+	cmdline.add_argument("files", nargs="*", help="BASIC programs")
+	cmdline.add_argument("-d", "--disassemble", action="store_true",
+		help="print the bytecode of each program")
+	cmdline.add_argument("-c", "--check", action="store_true",
+		help="compare the output with the classic interpreter"
+			" (default: on every bundled program)")
+	options = cmdline.parse_args()
+	if options.disassemble:
+		for i in options.files:
+			interpreter = basic.Interpreter(engine="bytecode")
+			interpreter.set_line('"' + i + '"')
+			interpreter.load_program()
+			interpreter.reset_program()
+			print(compile_program(interpreter).disassemble(), end="")
+	if options.check or not options.disassemble:
+		failed = check_conformance(options.files, lambda path, ok:
+			print("{:<6} {}".format("ok" if ok else "FAIL",
+				os.path.relpath(path))))
+		if failed:
+			sys.exit(1)
@@ -0,0 +1,126 @@
+"""On-disk cache of tokenized Tinycat BASIC programs.
+
+Loading a program means splitting it into lines and tokenizing each of
+them. The result only depends on the source text and the tokenizer, so
+it can be kept in a file named after a hash of the source and a version
+key, much like Python keeps .pyc files, and loaded from there next time.
+The key should change whenever the tokens would; see fingerprint().
+
+Entries are written with marshal, and replaced atomically so several
+processes can share a directory. When the directory grows past its size
+limit, the entries used least recently are removed first.
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import hashlib
+import marshal
+import os
+import tempfile
+
+# Bump when the layout of entries changes.
+FORMAT = 1
+
+def fingerprint(*parts):
+	"""Return a short hash of the given functions' code and of any other
+	values, such as tables they use; a cache keyed on it is invalidated by
+	any change to them, without anyone remembering to bump a number."""
+	h = hashlib.sha256()
+	def add(code):
+		h.update(code.co_code)
+		h.update(repr(code.co_names).encode("utf-8"))
+		for i in code.co_consts:
+			if hasattr(i, "co_code"):
+				add(i)
+			elif isinstance(i, frozenset):
+				h.update(repr(sorted(i)).encode("utf-8")) # Set order varies
+			else:
+				h.update(repr(i).encode("utf-8"))
+	for i in parts:
+		if hasattr(i, "__code__"):
+			add(i.__code__)
+		else:
+			h.update(repr(i).encode("utf-8"))
+	return h.hexdigest()[:16]
+
+def default_directory():
+	if os.environ.get("TINYCAT_CACHE"):
+		return os.environ["TINYCAT_CACHE"]
+	base = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+		os.path.expanduser("~"), ".cache")
+	return os.path.join(base, "tinycat-basic")
+
+class ProgramCache(object):
+	def __init__(self, version, directory=None, max_size=16 * 1024 * 1024):
+		self.version = version
+		self.directory = directory or default_directory()
+		self.max_size = max_size
+		self.hits = 0
+		self.misses = 0
+
+	def path(self, source):
+		key = "{}\0{}\0{}".format(FORMAT, self.version, source)
+		name = hashlib.sha256(key.encode("utf-8")).hexdigest()
+		return os.path.join(self.directory, name + ".tcb")
+
+	def get(self, source):
+		"""Return what was stored for this source, or None."""
+		path = self.path(source)
+		try:
+			with open(path, "rb") as f:
+				data = marshal.loads(f.read())
+			os.utime(path) # Recently used
+		except (OSError, EOFError, ValueError, TypeError):
+			self.misses += 1
+			return None
+		self.hits += 1
+		return data
+
+	def put(self, source, data):
+		try:
+			if not os.path.isdir(self.directory):
+				os.makedirs(self.directory)
+			handle, temp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+			with os.fdopen(handle, "wb") as f:
+				f.write(marshal.dumps(data))
+			os.replace(temp, self.path(source))
+		except (OSError, ValueError):
+			return # A cache that can't be written is simply not used.
+		self.trim()
+
+	def entries(self):
+		"""Return (last used, size, path) for every entry."""
+		found = []
+		for i in os.listdir(self.directory):
+			if i.endswith(".tcb"):
+				path = os.path.join(self.directory, i)
+				try:
+					st = os.stat(path)
+				except OSError:
+					continue
+				found.append((st.st_mtime, st.st_size, path))
+		return found
+
+	def trim(self):
+		"""Remove the least recently used entries until under the limit."""
+		try:
+			found = sorted(self.entries())
+		except OSError:
+			return
+		total = sum(i[1] for i in found)
+		for mtime, size, path in found:
+			if total <= self.max_size:
+				break
+			try:
+				os.remove(path)
+			except OSError:
+				pass
+			total -= size
+
+	def clear(self):
+		for mtime, size, path in self.entries():
+			try:
+				os.remove(path)
+			except OSError:
+				pass
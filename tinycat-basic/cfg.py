@@ -0,0 +1,636 @@
+#!/usr/bin/python3
+
+"""Control-flow graph of a Tinycat BASIC program, and analyses on it.
+
+The stored lines are parsed into the same syntax trees the compilers use,
+and split into basic blocks: runs of lines that are only entered at the
+first and only left after the last. Edges come from falling through to
+the next line, GOTO, GOSUB and RETURN, IF ... THEN, NEXT going back to
+its FOR and LOOP going back to its DO. A NEXT or LOOP goes back to the
+line after the FOR or DO it's paired with, the way the interpreters pair
+them; one without a partner may go back to any of them. A computed jump,
+or a statement added by an embedding program, may go anywhere.
+
+On top of the graph are the usual analyses: reachability, liveness,
+reaching definitions and loop nesting. Variables keep their values when
+the program ends, stops or fails, so they are all taken to be read then.
+The first use of all this is finding dead stores: LETs whose value is
+never read, which can be left out without anything else changing.
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import compiler
+import transpiler
+
+# Operators that can't fail on numbers, so an expression made only of
+# them, numbers and variables known to be set can be left out.
+harmless_ops = frozenset((
+	"neg", "not", "+", "-", "*", "=", "<>", "<", ">", "<=", ">=",
+	"and", "or"))
+
+def expression_names(tree, found, free):
+	"""Add the variables an expression reads to found, counting those
+	read by the user functions it calls; free maps each function to them.
+	"""
+	kind = tree[0]
+	if kind == "var":
+		found.add(tree[1])
+	elif kind == "call":
+		found.update(free.get(tree[1], ()))
+		for i in tree[2]:
+			expression_names(i, found, free)
+	elif kind in ("neg", "not"):
+		expression_names(tree[1], found, free)
+	elif kind not in ("num", "str"):
+		expression_names(tree[1], found, free)
+		expression_names(tree[2], found, free)
+	return found
+
+def harmless(tree, defined):
+	"""Whether an expression can't fail or do anything but give a value,
+	as long as the variables in defined are set."""
+	kind = tree[0]
+	if kind == "num":
+		return True
+	elif kind == "var":
+		return tree[1] in defined
+	elif kind not in harmless_ops:
+		return False
+	elif kind in ("neg", "not"):
+		return harmless(tree[1], defined)
+	else:
+		return harmless(tree[1], defined) and harmless(tree[2], defined)
+
+class Block(object):
+	"""A run of lines always executed together, from first to last."""
+
+	__slots__ = (
+		"index", # Position in FlowGraph.blocks
+		"first", # Index in addr of the first line
+		"last", # Index in addr of the last line
+		"succ", # Indices of the blocks that may come next
+		"pred",
+		"exits", # Whether the program may end after the last line
+	)
+
+	def __init__(self, index, first, last):
+		self.index = index
+		self.first = first
+		self.last = last
+		self.succ = []
+		self.pred = []
+		self.exits = False
+
+	def lines(self):
+		return range(self.first, self.last + 1)
+
+class Loop(object):
+	"""A natural loop: a header block, and the blocks that go round to it."""
+
+	__slots__ = (
+		"header",
+		"blocks", # Set of the indices of the blocks in it, header included
+		"parent", # The innermost loop around it, or None
+		"depth", # 1 for an outermost loop
+	)
+
+	def __init__(self, header, blocks):
+		self.header = header
+		self.blocks = blocks
+		self.parent = None
+		self.depth = 1
+
+class FlowGraph(object):
+	"""The control-flow graph of the program stored in ctx.
+
+	Trees can be given, one per line in addr (None for a line that
+	doesn't parse), if they were already parsed; they're parsed from the
+	stored lines otherwise.
+	"""
+
+	def __init__(self, ctx, trees=None):
+		self.ctx = ctx
+		self.addr = list(ctx.addr)
+		self.index = dict((n, i) for i, n in enumerate(self.addr))
+		if trees is None:
+			trees = []
+			fn_names = compiler.function_names(ctx)
+			for line_num in self.addr:
+				try:
+					tree, column = compiler.parse_line(
+						ctx.line_tokens(line_num), fn_names, ctx.statements)
+				except Exception:
+					tree = None
+				trees.append(tree)
+		self.trees = trees
+		self.free = self.function_names()
+		self.uses = []
+		self.defs = [] # Variables a line may set
+		self.kills = [] # Variables it always sets
+		self.variables = set()
+		for tree in trees:
+			uses, defs, kills = set(), set(), set()
+			self.effects(tree, uses, defs, kills)
+			self.uses.append(uses)
+			self.defs.append(defs)
+			self.kills.append(kills)
+			self.variables.update(uses, defs)
+		for i in self.free.values():
+			self.variables.update(i)
+		self.variables.discard(None)
+		self.find_edges()
+		self.find_blocks()
+		self.cache = {}
+
+	def function_names(self):
+		"""Map each user function to the variables its body reads, not
+		counting its arguments, but counting the functions it calls."""
+		direct = {}
+		calls = {}
+		for tree in self.trees:
+			tree = transpiler.innermost(tree)
+			if tree is None or tree[0] != "def":
+				continue
+			found = direct.setdefault(tree[1], set())
+			expression_names(tree[3], found, {})
+			found.difference_update(tree[2])
+			called = calls.setdefault(tree[1], set())
+			self.find_calls(tree[3], called)
+		free = dict((i, set(direct[i])) for i in direct)
+		changed = True
+		while changed:
+			changed = False
+			for name in free:
+				for callee in calls[name]:
+					more = free.get(callee, set()) - free[name]
+					if more:
+						free[name].update(more)
+						changed = True
+		return free
+
+	def find_calls(self, tree, found):
+		kind = tree[0]
+		if kind == "call":
+			found.add(tree[1])
+			for i in tree[2]:
+				self.find_calls(i, found)
+		elif kind in ("neg", "not"):
+			self.find_calls(tree[1], found)
+		elif kind not in ("num", "str", "var"):
+			self.find_calls(tree[1], found)
+			self.find_calls(tree[2], found)
+
+	def effects(self, tree, uses, defs, kills, conditional=False):
+		"""Add what a statement reads, may set and always sets."""
+		free = self.free
+		if tree is None:
+			return
+		kind = tree[0]
+		if kind == "let":
+			expression_names(tree[2], uses, free)
+			defs.add(tree[1])
+			if not conditional:
+				kills.add(tree[1])
+		elif kind == "print":
+			for i in tree[1]:
+				expression_names(i, uses, free)
+		elif kind == "input":
+			defs.update(tree[2])
+			if not conditional:
+				kills.update(tree[2])
+		elif kind == "if":
+			expression_names(tree[1], uses, free)
+			self.effects(tree[2], uses, defs, kills, True)
+		elif kind in ("goto", "gosub", "randomize"):
+			if tree[1] is not None:
+				expression_names(tree[1], uses, free)
+		elif kind == "loop":
+			expression_names(tree[2], uses, free)
+		elif kind == "for":
+			for i in tree[2:]:
+				if i is not None:
+					expression_names(i, uses, free)
+			defs.add(tree[1])
+			if not conditional:
+				kills.add(tree[1])
+		elif kind == "next":
+			uses.add(tree[1])
+			defs.add(tree[1])
+			if not conditional:
+				kills.add(tree[1])
+		elif kind == "classic":
+			uses.add(None) # Stands for every variable
+
+	def pair_loops(self):
+		"""Map each NEXT and LOOP line to the line after its FOR or DO,
+		or to a list of the lines after every FOR or DO it could mean."""
+		pairs = {}
+		fors, dos = [], []
+		starts = {}
+		for i, tree in enumerate(self.trees):
+			tree = transpiler.innermost(tree)
+			kind = tree[0] if tree is not None else None
+			if kind == "for":
+				fors.append((tree[1], i))
+				starts.setdefault(tree[1], []).append(i + 1)
+			elif kind == "do":
+				dos.append(i)
+				starts.setdefault(None, []).append(i + 1)
+			elif kind == "next":
+				for j in range(len(fors) - 1, -1, -1):
+					if fors[j][0] == tree[1]:
+						pairs[i] = fors[j][1] + 1
+						del fors[j:]
+						break
+			elif kind == "loop" and dos:
+				pairs[i] = dos.pop() + 1
+		for i, tree in enumerate(self.trees):
+			tree = transpiler.innermost(tree)
+			if tree is None or i in pairs:
+				continue
+			if tree[0] == "next":
+				pairs[i] = starts.get(tree[1], [])
+			elif tree[0] == "loop":
+				pairs[i] = starts.get(None, [])
+		return pairs
+
+	def find_edges(self):
+		"""Work out where each line may go next: jumps[i] lists line
+		indices, len(addr) meaning the end of the program. RETURN lines
+		are in returns; they go back after any GOSUB line, in calls."""
+		n = len(self.addr)
+		pairs = self.pair_loops()
+		self.jumps = []
+		self.returns = set()
+		self.calls = set()
+		self.anywhere = False
+		for i, tree in enumerate(self.trees):
+			dests = set()
+			self.statement_edges(tree, i, pairs, dests)
+			self.jumps.append(sorted(dests))
+		self.sites = sorted(i + 1 for i in self.calls)
+
+	def statement_edges(self, tree, i, pairs, dests):
+		n = len(self.addr)
+		if tree is None:
+			dests.add(n) # Fails every time
+			return
+		kind = tree[0]
+		if kind == "if":
+			dests.add(i + 1)
+			self.statement_edges(tree[2], i, pairs, dests)
+		elif kind in ("goto", "gosub"):
+			target = self.target(tree[1])
+			if target is None:
+				self.anywhere = True
+				dests.update(range(n + 1))
+			else:
+				dests.add(target)
+			if kind == "gosub":
+				self.calls.add(i)
+		elif kind == "return":
+			self.returns.add(i)
+		elif kind == "end":
+			dests.add(n)
+		elif kind == "stop":
+			dests.update((i + 1, n))
+		elif kind in ("next", "loop"):
+			dests.add(i + 1)
+			pair = pairs.get(i, [])
+			if isinstance(pair, list):
+				dests.update(pair)
+			else:
+				dests.add(pair)
+		elif kind == "classic":
+			self.anywhere = True
+			dests.update(range(n + 1))
+		else:
+			dests.add(i + 1)
+
+	def target(self, tree):
+		"""The index a jump goes to; the end of the program for a line
+		that doesn't exist (it fails); None if computed."""
+		if tree[0] != "num":
+			return None
+		return self.index.get(int(tree[1]), len(self.addr))
+
+	def successors(self, i):
+		"""Line indices that may come after line i."""
+		if i in self.returns:
+			return sorted(set(self.jumps[i]).union(self.sites))
+		return self.jumps[i]
+
+	def find_blocks(self):
+		n = len(self.addr)
+		leaders = set([0])
+		for i in range(n):
+			succ = self.successors(i)
+			if succ != [i + 1]:
+				leaders.update(succ)
+				leaders.add(i + 1)
+		leaders.discard(n)
+		starts = sorted(leaders)
+		self.blocks = []
+		self.block_of = [0] * n
+		for k, first in enumerate(starts):
+			last = starts[k + 1] - 1 if k + 1 < len(starts) else n - 1
+			if first > last:
+				continue
+			block = Block(len(self.blocks), first, last)
+			for i in block.lines():
+				self.block_of[i] = block.index
+			self.blocks.append(block)
+		for block in self.blocks:
+			for i in self.successors(block.last):
+				if i == n:
+					block.exits = True
+				else:
+					j = self.block_of[i]
+					if j not in block.succ:
+						block.succ.append(j)
+						self.blocks[j].pred.append(block.index)
+
+	# Analyses
+
+	def reachable(self):
+		"""Return the set of indices of the blocks a run can get to.
+
+		RETURN only goes back after the GOSUB lines that can be reached
+		themselves."""
+		if "reachable" in self.cache:
+			return self.cache["reachable"]
+		seen = set()
+		todo = [0] if self.blocks else []
+		while todo:
+			while todo:
+				b = todo.pop()
+				if b in seen:
+					continue
+				seen.add(b)
+				block = self.blocks[b]
+				for i in self.jumps[block.last]:
+					if i < len(self.addr):
+						todo.append(self.block_of[i])
+			if any(self.blocks[b].last in self.returns for b in seen):
+				for i in self.calls:
+					if self.block_of[i] in seen and i + 1 < len(self.addr) \
+							and self.block_of[i + 1] not in seen:
+						todo.append(self.block_of[i + 1])
+		self.cache["reachable"] = seen
+		return seen
+
+	def unreachable_lines(self):
+		"""Line numbers of the lines in blocks a run can't get to."""
+		reached = self.reachable()
+		return [self.addr[i] for b in self.blocks if b.index not in reached
+			for i in b.lines()]
+
+	def failing(self):
+		"""For each line, whether it may raise an error, or do something
+		with every variable."""
+		if "failing" in self.cache:
+			return self.cache["failing"]
+		defined = self.defined()
+		failing = [None in self.uses[i] or self.may_fail(tree, defined[i])
+			for i, tree in enumerate(self.trees)]
+		self.cache["failing"] = failing
+		return failing
+
+	def may_fail(self, tree, defined):
+		if tree is None:
+			return True
+		kind = tree[0]
+		if kind in ("rem", "end", "stop", "do"):
+			return False
+		elif kind == "let":
+			return not harmless(tree[2], defined)
+		elif kind == "print":
+			return not all(i[0] == "str" or harmless(i, defined)
+				for i in tree[1])
+		elif kind == "if":
+			return not harmless(tree[1], defined) \
+				or self.may_fail(tree[2], defined)
+		elif kind in ("goto", "gosub"):
+			target = self.target(tree[1])
+			return target is None or target == len(self.addr)
+		elif kind == "for":
+			step = tree[4]
+			return not (harmless(tree[2], defined)
+				and harmless(tree[3], defined)
+				and (step is None or transpiler.constant(step)))
+		return True
+
+	def liveness(self):
+		"""Return (live in, live out) for each block: the variables whose
+		values may be read before they're set again, from the start and
+		from the end of the block."""
+		if "liveness" in self.cache:
+			return self.cache["liveness"]
+		everything = frozenset(self.variables)
+		failing = self.failing()
+		blocks = self.blocks
+		live_in = [frozenset()] * len(blocks)
+		live_out = [frozenset()] * len(blocks)
+		todo = list(range(len(blocks)))
+		pending = set(todo)
+		while todo:
+			b = todo.pop()
+			pending.discard(b)
+			block = blocks[b]
+			out = set(everything if block.exits else ())
+			for j in block.succ:
+				out.update(live_in[j])
+			live_out[b] = frozenset(out)
+			live = self.backward(block, out, failing, everything)
+			if live != live_in[b]:
+				live_in[b] = live
+				for j in block.pred:
+					if j not in pending:
+						pending.add(j)
+						todo.append(j)
+		self.cache["liveness"] = live_in, live_out
+		return live_in, live_out
+
+	def backward(self, block, live, failing, everything, after=None):
+		"""Go back through the lines of a block from what's live at its
+		end; return what's live at its start, and note what's live after
+		each line in after, if given."""
+		live = set(live)
+		for i in range(block.last, block.first - 1, -1):
+			if after is not None:
+				after[i] = frozenset(live)
+			live.difference_update(self.kills[i])
+			live.update(self.uses[i])
+			if failing[i]:
+				live = set(everything)
+		return frozenset(live)
+
+	def reaching_definitions(self):
+		"""Return (reaching in, reaching out) for each block: sets of
+		(name, line index) for the assignments whose value may still be
+		there. (name, None) stands for whatever the variable held before
+		RUN, which may be nothing at all."""
+		if "reaching" in self.cache:
+			return self.cache["reaching"]
+		blocks = self.blocks
+		entry = frozenset((name, None) for name in self.variables)
+		reach_in = [frozenset()] * len(blocks)
+		reach_out = [frozenset()] * len(blocks)
+		todo = list(range(len(blocks) - 1, -1, -1))
+		pending = set(todo)
+		while todo:
+			b = todo.pop()
+			pending.discard(b)
+			block = blocks[b]
+			found = set(entry if b == 0 else ())
+			for j in block.pred:
+				found.update(reach_out[j])
+			reach_in[b] = frozenset(found)
+			out = self.forward(block, found)
+			if out != reach_out[b]:
+				reach_out[b] = out
+				for j in block.succ:
+					if j not in pending:
+						pending.add(j)
+						todo.append(j)
+		self.cache["reaching"] = reach_in, reach_out
+		return reach_in, reach_out
+
+	def forward(self, block, found, before=None):
+		found = set(found)
+		for i in block.lines():
+			if before is not None:
+				before[i] = frozenset(found)
+			kills = self.kills[i]
+			if kills:
+				found = set(d for d in found if d[0] not in kills)
+			found.update((name, i) for name in self.defs[i])
+		return frozenset(found)
+
+	def defined(self):
+		"""For each line, the variables certainly set before it runs."""
+		if "defined" in self.cache:
+			return self.cache["defined"]
+		reach_in, reach_out = self.reaching_definitions()
+		before = [None] * len(self.addr)
+		for block in self.blocks:
+			self.forward(block, reach_in[block.index], before)
+		unset = [frozenset(d[0] for d in i if d[1] is None) for i in before]
+		defined = [frozenset(self.variables - i) for i in unset]
+		self.cache["defined"] = defined
+		return defined
+
+	def loops(self):
+		"""Return the natural loops of the reachable blocks, outermost
+		first, each knowing the loop around it and its depth."""
+		if "loops" in self.cache:
+			return self.cache["loops"]
+		reached = self.reachable()
+		order = sorted(reached)
+		dom = dict((b, set(order)) for b in order)
+		if order:
+			dom[0] = set([0])
+		changed = True
+		while changed:
+			changed = False
+			for b in order:
+				if b == 0:
+					continue
+				preds = [dom[p] for p in self.blocks[b].pred if p in reached]
+				new = set.intersection(*preds) if preds else set()
+				new.add(b)
+				if new != dom[b]:
+					dom[b] = new
+					changed = True
+		bodies = {}
+		for b in order:
+			for h in self.blocks[b].succ:
+				if h in dom[b]: # A back edge
+					body = bodies.setdefault(h, set([h]))
+					todo = [b]
+					while todo:
+						j = todo.pop()
+						if j not in body:
+							body.add(j)
+							todo.extend(p for p in self.blocks[j].pred
+								if p in reached)
+		loops = [Loop(h, frozenset(bodies[h])) for h in sorted(bodies)]
+		loops.sort(key=lambda loop: -len(loop.blocks))
+		for k, loop in enumerate(loops):
+			for outer in reversed(loops[:k]):
+				if loop.blocks < outer.blocks:
+					loop.parent = outer
+					loop.depth = outer.depth + 1
+					break
+		self.cache["loops"] = loops
+		return loops
+
+	def loop_depth(self):
+		"""How many loops each block is in."""
+		depth = [0] * len(self.blocks)
+		for loop in self.loops():
+			for b in loop.blocks:
+				depth[b] = max(depth[b], loop.depth)
+		return depth
+
+	def dead_stores(self):
+		"""Return the set of indices of LET lines that can be left out:
+		reachable, their value never read, and unable to fail."""
+		if "dead" in self.cache:
+			return self.cache["dead"]
+		live_in, live_out = self.liveness()
+		defined = self.defined()
+		everything = frozenset(self.variables)
+		reached = self.reachable()
+		failing = self.failing()
+		after = [None] * len(self.addr)
+		for block in self.blocks:
+			self.backward(block, live_out[block.index], failing,
+				everything, after)
+		dead = set()
+		for i, tree in enumerate(self.trees):
+			if tree is not None and tree[0] == "let" \
+					and self.block_of[i] in reached \
+					and tree[1] not in after[i] \
+					and harmless(tree[2], defined[i]):
+				dead.add(i)
+		self.cache["dead"] = dead
+		return dead
+
+	def dot(self):
+		"""Return the graph in the DOT language, for Graphviz."""
+		reached = self.reachable()
+		dead = self.dead_stores()
+		depth = self.loop_depth()
+		out = ["digraph program {", "\tnode [shape=box, fontname=monospace];"]
+		for block in self.blocks:
+			text = []
+			for i in block.lines():
+				line_num = self.addr[i]
+				text.append("{} {}{}".format(line_num,
+					self.ctx.program.get(line_num, ""),
+					"  (dead)" if i in dead else ""))
+			if depth[block.index]:
+				text.append("loop depth {}".format(depth[block.index]))
+			label = "".join(quote(i) + "\\l" for i in text)
+			style = "" if block.index in reached else ", style=dashed"
+			out.append('\tb{} [label="{}"{}];'.format(
+				block.index, label, style))
+		out.append('\texit [shape=oval, label="end"];')
+		for block in self.blocks:
+			for j in block.succ:
+				style = ""
+				if block.last in self.returns \
+						and self.blocks[j].first in self.sites \
+						and self.blocks[j].first not in self.jumps[block.last]:
+					style = " [style=dotted]"
+				out.append("\tb{} -> b{}{};".format(block.index, j, style))
+			if block.exits:
+				out.append("\tb{} -> exit;".format(block.index))
+		out.append("}")
+		return "\n".join(out) + "\n"
+
+def quote(text):
+	return text.replace("\\", "\\\\").replace('"', '\\"')
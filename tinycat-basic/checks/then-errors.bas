@@ -0,0 +1,12 @@
+10 REM The statement after THEN only has to parse if it runs.
+20 LET x = 0
+30 IF x THEN FOO
+40 IF x THEN PRINT (
+50 IF x THEN PRINT "unclosed
+60 IF x = 0 THEN IF x THEN LET = 1
+70 FOR i = 1 TO 3
+80 IF i > 5 THEN GOTO
+90 PRINT i;
+100 NEXT i
+110 PRINT
+120 IF x = 0 THEN PRINT (1
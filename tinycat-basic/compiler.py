@@ -0,0 +1,1371 @@
+#!/usr/bin/python3
+
+"""Closure compiler for Tinycat BASIC.
+
+Each stored line is parsed once into a small syntax tree made of tuples,
+then turned into a tree of Python closures. Running the program is then
+just a matter of calling one closure per line; each returns the index of
+the next line to run.
+
+The interpreter context passed around (`ctx`) is a basic.Interpreter.
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import math
+import operator
+import sys
+
+# Returned by END, so the run loop stops no matter how long the program is.
+END = sys.maxsize
+
+# User functions with bodies of up to this many nodes are inlined.
+inline_limit = 32
+
+# Syntax tree nodes are tuples whose first item says what they are:
+#
+#	("num", value)
+#	("var", name, column)
+#	("neg", expr) ("not", expr)
+#	(op, left, right, column) for + - * / \ ^ = <> < > <= >= and or
+#	("call", name, [args], column, name column)
+#
+#	("let", name, expr) ("print", [items], newline) ("input", prompt, [names])
+#	("if", cond, stmt) ("goto", expr) ("gosub", expr) ("return",) ("end",)
+#	("stop",) ("do",) ("loop", "while" | "until", expr) ("rem",)
+#	("for", name, start, limit, step or None) ("next", name, column)
+#	("def", name, [args], body, body_tokens, name column)
+#	("randomize", expr or None)
+#	("classic", keyword, tokens, cursor) for statements only the classic
+#	interpreter knows about, e.g. ones added by an embedding program.
+#	("error", exc) for a statement after THEN that doesn't parse; like the
+#	interpreter, it only fails if the condition is true.
+#
+# Print items are either expressions or ("str", text). Columns are where
+# the classic interpreter would be when an error came up: right after the
+# name of a variable, function or DEF FN, after the closing parenthesis of
+# a call, and after the right operand of an operator.
+
+class Parser(object):
+	"""Recursive descent parser over a token list, mirroring basic.py."""
+
+	def __init__(self, tokens, fn_names, statements=()):
+		self.tokens = tokens
+		self.cursor = 0
+		self.fn_names = fn_names
+		self.statements = statements
+
+	def column(self):
+		if self.cursor > 0:
+			t = self.tokens[self.cursor - 1]
+			return t[3] + len(t[1])
+		else:
+			return 0
+
+	def error(self, exc):
+		exc.column = self.column()
+		return exc
+
+	def match(self, text):
+		if self.tokens[self.cursor][1] == text:
+			self.cursor += 1
+			return True
+		else:
+			return False
+
+	def match_kind(self, kind):
+		t = self.tokens[self.cursor]
+		if t[0] == kind:
+			self.cursor += 1
+			return t
+		elif t[0] == "error" and kind == "string":
+			raise self.error(IndexError(t[2]))
+		else:
+			return None
+
+	def parse_statement(self):
+		t = self.match_kind("name")
+		if t is None:
+			raise self.error(SyntaxError("Statement expected"))
+		stmt = t[1]
+		method = getattr(self, "parse_" + stmt, None)
+		if method is not None and stmt in self.statements:
+			return method()
+		elif stmt in self.statements:
+			return ("classic", stmt, self.tokens, self.cursor)
+		else:
+			raise self.error(SyntaxError("Unknown statement: " + stmt))
+
+	def parse_varname(self, message="Variable expected"):
+		t = self.match_kind("name")
+		if t is None:
+			raise self.error(SyntaxError(message))
+		return t[1]
+
+	def parse_rem(self):
+		self.cursor = len(self.tokens) - 1
+		return ("rem",)
+
+	def parse_let(self):
+		name = self.parse_varname()
+		if not self.match("="):
+			raise self.error(SyntaxError("'=' expected"))
+		return ("let", name, self.parse_disjunction())
+
+	def parse_print(self):
+		if self.tokens[self.cursor][0] == "eol":
+			return ("print", [], True)
+		items = [self.parse_value()]
+		while self.match(","):
+			items.append(self.parse_value())
+		return ("print", items, not self.match(";"))
+
+	def parse_value(self):
+		t = self.match_kind("string")
+		if t is not None:
+			return ("str", t[2])
+		else:
+			return self.parse_disjunction()
+
+	def parse_input(self):
+		t = self.match_kind("string")
+		if t is not None:
+			prompt = t[2]
+			if not self.match(","):
+				raise self.error(SyntaxError("Comma expected"))
+		else:
+			prompt = ""
+		return ("input", prompt, self.parse_varlist())
+
+	def parse_varlist(self):
+		varlist = [self.parse_varname("Var expected")]
+		while self.match(","):
+			varlist.append(self.parse_varname("Var expected"))
+		return varlist
+
+	def parse_if(self):
+		condition = self.parse_disjunction()
+		if self.match("then"):
+			try:
+				return ("if", condition, self.parse_statement())
+			except Exception as e:
+				self.cursor = len(self.tokens) - 1
+				return ("if", condition, ("error", e))
+		else:
+			raise self.error(SyntaxError("IF without THEN"))
+
+	def parse_goto(self):
+		return ("goto", self.parse_expression())
+
+	def parse_gosub(self):
+		return ("gosub", self.parse_expression())
+
+	def parse_return(self):
+		return ("return",)
+
+	def parse_end(self):
+		return ("end",)
+
+	def parse_stop(self):
+		return ("stop",)
+
+	def parse_do(self):
+		return ("do",)
+
+	def parse_loop(self):
+		if self.match("while"):
+			return ("loop", "while", self.parse_disjunction())
+		elif self.match("until"):
+			return ("loop", "until", self.parse_disjunction())
+		else:
+			raise self.error(SyntaxError("Condition expected"))
+
+	def parse_for(self):
+		name = self.parse_varname()
+		if not self.match("="):
+			raise self.error(SyntaxError("'=' expected"))
+		start = self.parse_expression()
+		if not self.match("to"):
+			raise self.error(SyntaxError("'to' expected"))
+		limit = self.parse_expression()
+		if self.match("step"):
+			step = self.parse_expression()
+		else:
+			step = None
+		return ("for", name, start, limit, step)
+
+	def parse_next(self):
+		name = self.parse_varname()
+		return ("next", name, self.column())
+
+	def parse_def(self):
+		if not self.match("fn"):
+			raise self.error(SyntaxError("Missing 'fn'"))
+		name = self.parse_varname("Name expected")
+		column = self.column()
+		if not self.match("("):
+			raise self.error(SyntaxError("Missing '('"))
+		if self.match(")"):
+			args = []
+		else:
+			args = self.parse_varlist()
+			if not self.match(")"):
+				raise self.error(SyntaxError("Missing ')'"))
+		if not self.match("="):
+			raise self.error(SyntaxError("Missing '='"))
+		body_tokens = self.tokens[self.cursor:]
+		body = self.parse_disjunction()
+		self.cursor = len(self.tokens) - 1
+		return ("def", name, args, body, body_tokens, column)
+
+	def parse_randomize(self):
+		if self.tokens[self.cursor][0] == "eol":
+			return ("randomize", None)
+		else:
+			return ("randomize", self.parse_expression())
+
+	def parse_disjunction(self):
+		lside = self.parse_conjunction()
+		while self.match("or"):
+			lside = ("or", lside, self.parse_conjunction(), self.column())
+		return lside
+
+	def parse_conjunction(self):
+		lside = self.parse_negation()
+		while self.match("and"):
+			lside = ("and", lside, self.parse_negation(), self.column())
+		return lside
+
+	def parse_negation(self):
+		if self.match("not"):
+			return ("not", self.parse_comparison())
+		else:
+			return self.parse_comparison()
+
+	def parse_comparison(self):
+		lside = self.parse_expression()
+		op = self.tokens[self.cursor][1]
+		if op in relations:
+			self.cursor += 1
+			return (op, lside, self.parse_expression(), self.column())
+		else:
+			return lside
+
+	def parse_expression(self):
+		t1 = self.parse_term()
+		op = self.tokens[self.cursor][1]
+		while op == "+" or op == "-":
+			self.cursor += 1
+			t1 = (op, t1, self.parse_term(), self.column())
+			op = self.tokens[self.cursor][1]
+		return t1
+
+	def parse_term(self):
+		t1 = self.parse_power()
+		op = self.tokens[self.cursor][1]
+		while op == "*" or op == "/" or op == "\\":
+			self.cursor += 1
+			t1 = (op, t1, self.parse_power(), self.column())
+			op = self.tokens[self.cursor][1]
+		return t1
+
+	def parse_power(self):
+		t1 = self.parse_factor()
+		if self.match("^"):
+			return ("^", t1, self.parse_power(), self.column())
+		else:
+			return t1
+
+	def parse_factor(self):
+		negative = self.match("-")
+		t = self.tokens[self.cursor]
+		if t[0] == "number":
+			self.cursor += 1
+			node = ("num", t[2])
+		elif t[0] == "name":
+			self.cursor += 1
+			if t[1] in self.fn_names:
+				column = self.column()
+				args = self.parse_args()
+				node = ("call", t[1], args, self.column(), column)
+			else:
+				node = ("var", t[1], self.column())
+		elif self.match("("):
+			node = self.parse_disjunction()
+			if not self.match(")"):
+				raise self.error(SyntaxError("Missing ')'"))
+		else:
+			raise self.error(SyntaxError("Expression expected"))
+		if negative:
+			return ("neg", node)
+		else:
+			return node
+
+	def parse_args(self):
+		if self.match("("):
+			if self.match(")"):
+				return []
+			args = [self.parse_disjunction()]
+			while self.match(","):
+				args.append(self.parse_disjunction())
+			if self.match(")"):
+				return args
+			else:
+				raise self.error(SyntaxError("Missing ')'"))
+		else:
+			return []
+
+relations = ("=", "<>", "<=", ">=", "<", ">")
+
+def defined_names(tokens):
+	"""Names of the functions a line defines with DEF FN."""
+	names = []
+	for i in range(len(tokens) - 2):
+		if tokens[i][1] == "def" and tokens[i + 1][1] == "fn":
+			if tokens[i + 2][0] == "name":
+				names.append(tokens[i + 2][1])
+	return names
+
+def function_names(ctx):
+	"""Names that parse as function calls in the current program."""
+	names = set(ctx.functions)
+	names.update(ctx.function_code)
+	for line_num in ctx.program:
+		names.update(defined_names(ctx.line_tokens(line_num)))
+	return names
+
+def parse_line(tokens, fn_names, statements):
+	"""Parse one stored line; return its syntax tree and end column."""
+	parser = Parser(tokens, fn_names, statements)
+	tree = parser.parse_statement()
+	return tree, parser.column()
+
+class Stopped(Exception):
+	"""Raised by STOP to leave the run loop at a resumable point."""
+
+	def __init__(self, resume):
+		Exception.__init__(self, "Stopped")
+		self.resume = resume
+
+def located(exc, column):
+	exc.column = column
+	return exc
+
+def placed(exc, column):
+	"""Give an error the column of the operation that raised it, unless an
+	operand it came from already did."""
+	if not hasattr(exc, "column"):
+		exc.column = column
+	return exc
+
+def empty_loop(value, step, limit):
+	"""Go round a FOR loop with nothing between it and its NEXT, adding
+	step to value until it passes limit. Return the value and how many
+	times NEXT ran."""
+	times = 1
+	value += step
+	if step > 0:
+		while not value > limit:
+			value += step
+			times += 1
+	else:
+		while not value < limit:
+			value += step
+			times += 1
+	return value, times
+
+class CompiledLine(object):
+	"""One line of a CompiledProgram, and what it was compiled against."""
+
+	__slots__ = (
+		"tokens", # The token list it was parsed from
+		"tree", # Its syntax tree, or None if it didn't parse
+		"column", # End column, for error messages
+		"code", # Its closure
+		"index", # Its position in addr
+		"pair", # Index of the FOR a NEXT goes with, else None
+		"targets", # Line number -> index, for each jump resolved early
+		"removed", # Syntax tree nodes the optimizer took out
+	)
+
+	def __init__(self, tokens, index, pair):
+		self.tokens = tokens
+		self.tree = None
+		self.removed = 0
+		self.column = 0
+		self.code = None
+		self.index = index
+		self.pair = pair
+		self.targets = {}
+
+class CompiledProgram(object):
+	"""The stored program compiled to one closure per line, in addr order.
+
+	Each line remembers what its closure depends on: its own position,
+	those of the lines it jumps to, the FOR its NEXT is paired with, and
+	which names were function calls. After the program is edited, update()
+	only recompiles the lines whose dependencies changed, and only parses
+	again those whose text (or the functions they call) changed.
+	"""
+
+	def __init__(self, ctx):
+		self.ctx = ctx
+		self.build()
+
+	def build(self):
+		ctx = self.ctx
+		self.index = ctx.line_index
+		self.statements = dict(ctx.statements)
+		self.functions = dict(ctx.functions)
+		self.short_circuit = ctx.short_circuit
+		self.user_names = set(ctx.function_code)
+		self.defines = {} # Line number -> names its DEF FN defines
+		for line_num in ctx.program:
+			names = defined_names(ctx.line_tokens(line_num))
+			if names:
+				self.defines[line_num] = names
+		self.fn_names = self.known_names()
+		self.find_definitions()
+		self.optimizer = Optimizer(ctx)
+		self.lines = {} # Line number -> CompiledLine
+		self.targets = None # Those of the line being compiled
+		self.recompiled = len(ctx.addr)
+		self.code = [None] * len(ctx.addr)
+		self.columns = [0] * len(ctx.addr)
+		for i in range(len(ctx.addr)):
+			self.compile_line(i)
+
+	def known_names(self):
+		names = set(self.functions)
+		names.update(self.user_names)
+		for i in self.defines.values():
+			names.update(i)
+		return names
+
+	def find_definitions(self):
+		"""Note the line defining each function defined by just one."""
+		self.definitions = {} # Name -> line number, or None if several
+		for line_num, names in self.defines.items():
+			for name in names:
+				if name in self.definitions:
+					self.definitions[name] = None
+				else:
+					self.definitions[name] = line_num
+		self.inlinable = {} # Name -> what inline() needs, or None
+
+	def compile_line(self, i, reparse=True):
+		ctx = self.ctx
+		line_num = ctx.addr[i]
+		tokens = ctx.line_tokens(line_num)
+		old = self.lines.get(line_num)
+		line = CompiledLine(tokens, i, ctx.next_pairs.get(i))
+		self.targets = line.targets
+		try:
+			if reparse or old is None or old.tree is None:
+				tree, line.column = parse_line(
+					tokens, self.fn_names, ctx.statements)
+				removed = self.optimizer.removed
+				line.tree = self.optimizer.statement(tree)
+				line.removed = self.optimizer.removed - removed
+			else:
+				line.tree, line.column = old.tree, old.column
+				line.removed = old.removed
+			line.code = self.statement(line.tree, i + 1)
+		except Exception as e:
+			line.code = self.failure(e)
+			line.column = getattr(e, "column", 0)
+		self.lines[line_num] = line
+		self.code[i] = line.code
+		self.columns[i] = line.column
+
+	def update(self):
+		"""Catch up with edits to the program, and with the positions in
+		ctx.addr and ctx.next_pairs that came with them. Return True."""
+		ctx = self.ctx
+		if ctx.statements != self.statements or ctx.functions != self.functions \
+				or ctx.short_circuit != self.short_circuit:
+			self.build() # Changed by the host; start over.
+			return True
+		self.index = ctx.line_index
+		edited = set()
+		for line_num in ctx.addr:
+			line = self.lines.get(line_num)
+			tokens = ctx.line_tokens(line_num)
+			if line is None or line.tokens is not tokens:
+				edited.add(line_num)
+				names = defined_names(tokens)
+				if names:
+					self.defines[line_num] = names
+				else:
+					self.defines.pop(line_num, None)
+		if len(self.lines) + len(edited) > len(ctx.addr):
+			for line_num in list(self.lines):
+				if line_num not in ctx.program:
+					del self.lines[line_num]
+					self.defines.pop(line_num, None)
+		# Names that turned into function calls, or stopped being ones
+		self.user_names, old = set(ctx.function_code), self.user_names
+		changed = old ^ self.user_names
+		self.fn_names, old = self.known_names(), self.fn_names
+		changed |= old ^ self.fn_names
+		# And functions whose definition changed, for their inlined calls
+		old = self.definitions
+		self.find_definitions()
+		for name in set(old) | set(self.definitions):
+			line_num = self.definitions.get(name)
+			if line_num != old.get(name) or line_num in edited:
+				changed.add(name)
+		self.code = [None] * len(ctx.addr)
+		self.columns = [0] * len(ctx.addr)
+		self.recompiled = 0
+		for i in range(len(ctx.addr)):
+			line_num = ctx.addr[i]
+			line = self.lines.get(line_num)
+			reparse = line_num in edited
+			if not reparse and changed:
+				for t in line.tokens:
+					if t[0] == "name" and t[1] in changed:
+						reparse = True
+						break
+			if not reparse and self.current(line, i):
+				self.code[i] = line.code
+				self.columns[i] = line.column
+				continue
+			self.compile_line(i, reparse)
+			self.recompiled += 1
+		return True
+
+	def current(self, line, i):
+		"""Tell if a line compiled earlier still fits where it is now."""
+		if line.index != i or line.pair != self.ctx.next_pairs.get(i):
+			return False
+		index = self.index
+		for line_num, dest in line.targets.items():
+			if index.get(line_num) != dest:
+				return False
+		return True
+
+	def removed_nodes(self):
+		"""How many syntax tree nodes the optimizer took out of the lines."""
+		return sum(i.removed for i in self.lines.values())
+
+	def failure(self, exc):
+		def fail():
+			raise exc
+		return fail
+
+	def run(self):
+		"""Run from ctx.crt_line until the end, an error or STOP."""
+		ctx = self.ctx
+		code = self.code
+		n = len(code)
+		i = ctx.crt_line
+		ctx.stop = False
+		try:
+			while i < n:
+				i = code[i]()
+		except Stopped as e:
+			ctx.stop = True
+			ctx.crt_line = e.resume
+			return
+		except Exception as e:
+			ctx.crt_line = i + 1
+			column = getattr(e, "column", self.columns[i])
+			ctx.print_error(e, "in line", ctx.addr[i], "column", column)
+			return
+		ctx.crt_line = min(i, n)
+
+	def target(self, line_num):
+		try:
+			return self.index[line_num]
+		except KeyError:
+			raise ValueError("Line not found: " + str(line_num))
+
+	# Statements. Each closure returns the index of the next line to run,
+	# given `nxt` as the index of the line right after its own.
+
+	def statement(self, tree, nxt):
+		return getattr(self, "stmt_" + tree[0])(tree, nxt)
+
+	def stmt_rem(self, tree, nxt):
+		return lambda: nxt
+
+	def stmt_let(self, tree, nxt):
+		values = self.ctx.values
+		slot = self.ctx.variables.slot(tree[1])
+		value = self.expression(tree[2])
+		def let():
+			values[slot] = value()
+			return nxt
+		return let
+
+	def stmt_print(self, tree, nxt):
+		ctx = self.ctx
+		items = []
+		for i in tree[1]:
+			if i[0] == "str":
+				items.append(self.constant(i[1]))
+			else:
+				items.append(self.formatted(self.expression(i)))
+		write = ctx.output.write
+		if not items:
+			def print_newline():
+				write("\n")
+				return nxt
+			return print_newline
+		end = "\n" if tree[2] else ""
+		if len(items) == 1:
+			item = items[0]
+			def print_one():
+				write(item() + end)
+				return nxt
+			return print_one
+		def print_many():
+			write("".join([i() for i in items]) + end)
+			return nxt
+		return print_many
+
+	def constant(self, value):
+		return lambda: value
+
+	def formatted(self, value):
+		fmt = "{:1g}".format
+		return lambda: fmt(value())
+
+	def stmt_input(self, tree, nxt):
+		ctx = self.ctx
+		prompt = tree[1]
+		names = tree[2]
+		def input_():
+			ctx.input_values(prompt, names)
+			return nxt
+		return input_
+
+	def stmt_if(self, tree, nxt):
+		condition = self.expression(tree[1])
+		then = self.statement(tree[2], nxt)
+		def if_():
+			if condition() != 0:
+				return then()
+			else:
+				return nxt
+		return if_
+
+	def stmt_goto(self, tree, nxt):
+		if tree[1][0] == "num":
+			line_num = int(tree[1][1])
+			self.targets[line_num] = self.index.get(line_num)
+			if line_num in self.index:
+				dest = self.index[line_num]
+				return lambda: dest
+		target = self.target
+		value = self.expression(tree[1])
+		return lambda: target(int(value()))
+
+	def stmt_gosub(self, tree, nxt):
+		ctx = self.ctx
+		if tree[1][0] == "num":
+			line_num = int(tree[1][1])
+			self.targets[line_num] = self.index.get(line_num)
+			if line_num in self.index:
+				dest = self.index[line_num]
+				def gosub_line():
+					ctx.stack.append(nxt)
+					return dest
+				return gosub_line
+		target = self.target
+		value = self.expression(tree[1])
+		def gosub():
+			dest = target(int(value()))
+			ctx.stack.append(nxt)
+			return dest
+		return gosub
+
+	def stmt_return(self, tree, nxt):
+		ctx = self.ctx
+		def return_():
+			if len(ctx.stack) > 0:
+				return ctx.stack.pop()
+			else:
+				raise RuntimeError("RETURN without GOSUB")
+		return return_
+
+	def stmt_end(self, tree, nxt):
+		return lambda: END
+
+	def stmt_stop(self, tree, nxt):
+		def stop():
+			raise Stopped(nxt)
+		return stop
+
+	def stmt_do(self, tree, nxt):
+		do_stack = self.ctx.do_stack
+		def do():
+			do_stack.append(nxt)
+			return nxt
+		return do
+
+	def stmt_loop(self, tree, nxt):
+		do_stack = self.ctx.do_stack
+		condition = self.expression(tree[2])
+		repeat_if = tree[1] == "while"
+		def loop():
+			repeat = (condition() != 0) == repeat_if
+			if not do_stack:
+				raise RuntimeError("LOOP without DO")
+			if repeat:
+				return do_stack[-1]
+			do_stack.pop()
+			return nxt
+		return loop
+
+	def stmt_for(self, tree, nxt):
+		ctx = self.ctx
+		name = tree[1]
+		start = self.expression(tree[2])
+		limit = self.expression(tree[3])
+		step = self.expression(tree[4]) if tree[4] else None
+		values = ctx.values
+		slot = ctx.variables.slot(name)
+		line = nxt - 1
+		def for_():
+			values[slot] = start()
+			until = limit()
+			if step is None:
+				by = 1
+			else:
+				by = step()
+				if by == 0:
+					raise ValueError("Infinite loop")
+			ctx.start_loop(line, slot, until, by)
+			return nxt
+		return for_
+
+	def stmt_next(self, tree, nxt):
+		ctx = self.ctx
+		name = tree[1]
+		column = tree[2]
+		values = ctx.values
+		slot = ctx.variables.slot(name)
+		fors = ctx.for_stack
+		# Paired with its FOR before the run, so usually a single check.
+		pair = ctx.next_pairs.get(nxt - 1)
+		# A NEXT alone on its line goes round right here if its FOR is the
+		# line before, with nothing in between.
+		alone = ctx.line_tokens(ctx.addr[nxt - 1])[0][1] == "next"
+		def next_():
+			value = values[slot]
+			if value is None:
+				raise located(NameError("Var not found: " + name), column)
+			frame = fors[-1] if fors else None
+			if frame is None or frame.line != pair:
+				frame = ctx.find_loop(pair, slot)
+			step = frame.step
+			if alone and frame.line == nxt - 2:
+				values[slot] = empty_loop(value, step, frame.limit)[0]
+				fors.pop()
+				return nxt
+			value += step
+			values[slot] = value
+			if value > frame.limit if step > 0 else value < frame.limit:
+				fors.pop()
+				return nxt
+			return frame.line + 1
+		return next_
+
+	def stmt_def(self, tree, nxt):
+		ctx = self.ctx
+		name, args, body, body_tokens = tree[1], tree[2], tree[3], tree[4]
+		column = tree[5]
+		function = make_function(ctx, args, body)
+		def def_():
+			if name in ctx.function_args:
+				raise located(
+					RuntimeError("Duplicate function: " + name), column)
+			ctx.function_args[name] = args
+			ctx.function_code[name] = body_tokens
+			ctx.compiled_functions[name] = memoize(ctx, name, function, body)
+			return nxt
+		return def_
+
+	def stmt_randomize(self, tree, nxt):
+		ctx = self.ctx
+		if tree[1] is None:
+			def randomize():
+				ctx.rng.seed()
+				return nxt
+			return randomize
+		value = self.expression(tree[1])
+		def randomize_with():
+			ctx.rng.seed(int(value()))
+			return nxt
+		return randomize_with
+
+	def stmt_error(self, tree, nxt):
+		return self.failure(tree[1])
+
+	def stmt_classic(self, tree, nxt):
+		# Let the classic interpreter handle statements we don't know.
+		ctx = self.ctx
+		handler = ctx.statements[tree[1]]
+		tokens, cursor = tree[2], tree[3]
+		def classic():
+			ctx.tokens = tokens
+			ctx.cursor = cursor
+			ctx.crt_line = nxt
+			try:
+				handler(ctx)
+			except Exception as e:
+				e.column = ctx.column()
+				raise
+			if ctx.stop:
+				raise Stopped(ctx.crt_line)
+			return ctx.crt_line
+		return classic
+
+	# Expressions. Each closure takes no arguments and returns a value.
+
+	def expression(self, tree):
+		return getattr(self, "expr_" + binary_names.get(tree[0], tree[0]))(tree)
+
+	def expr_num(self, tree):
+		return self.constant(tree[1])
+
+	def expr_var(self, tree):
+		values = self.ctx.values
+		name = tree[1]
+		slot = self.ctx.variables.slot(name)
+		column = tree[2]
+		def var():
+			value = values[slot]
+			if value is None:
+				raise located(NameError("Var not found: " + name), column)
+			return value
+		return var
+
+	def expr_neg(self, tree):
+		value = self.expression(tree[1])
+		return lambda: -value()
+
+	def expr_not(self, tree):
+		value = self.expression(tree[1])
+		return lambda: -(value() == 0)
+
+	def expr_add(self, tree):
+		a, b = self.expression(tree[1]), self.expression(tree[2])
+		return lambda: a() + b()
+
+	def expr_sub(self, tree):
+		a, b = self.expression(tree[1]), self.expression(tree[2])
+		return lambda: a() - b()
+
+	def expr_mul(self, tree):
+		a, b = self.expression(tree[1]), self.expression(tree[2])
+		return lambda: a() * b()
+
+	def expr_div(self, tree):
+		a, b = self.expression(tree[1]), self.expression(tree[2])
+		column = tree[3]
+		def div():
+			try:
+				return a() / b()
+			except Exception as e:
+				raise placed(e, column)
+		return div
+
+	def expr_floordiv(self, tree):
+		a, b = self.expression(tree[1]), self.expression(tree[2])
+		column = tree[3]
+		def floordiv():
+			try:
+				return a() // b()
+			except Exception as e:
+				raise placed(e, column)
+		return floordiv
+
+	def expr_pow(self, tree):
+		a, b = self.expression(tree[1]), self.expression(tree[2])
+		column = tree[3]
+		def pow():
+			try:
+				return a() ** b()
+			except Exception as e:
+				raise placed(e, column)
+		return pow
+
+	def expr_eq(self, tree):
+		a, b = self.expression(tree[1]), self.expression(tree[2])
+		return lambda: -(a() == b())
+
+	def expr_ne(self, tree):
+		a, b = self.expression(tree[1]), self.expression(tree[2])
+		return lambda: -(a() != b())
+
+	def expr_lt(self, tree):
+		a, b = self.expression(tree[1]), self.expression(tree[2])
+		column = tree[3]
+		def lt():
+			try:
+				return -(a() < b())
+			except Exception as e:
+				raise placed(e, column) # Complex numbers don't compare
+		return lt
+
+	def expr_le(self, tree):
+		a, b = self.expression(tree[1]), self.expression(tree[2])
+		column = tree[3]
+		def le():
+			try:
+				return -(a() <= b())
+			except Exception as e:
+				raise placed(e, column) # Complex numbers don't compare
+		return le
+
+	def expr_gt(self, tree):
+		a, b = self.expression(tree[1]), self.expression(tree[2])
+		column = tree[3]
+		def gt():
+			try:
+				return -(a() > b())
+			except Exception as e:
+				raise placed(e, column) # Complex numbers don't compare
+		return gt
+
+	def expr_ge(self, tree):
+		a, b = self.expression(tree[1]), self.expression(tree[2])
+		column = tree[3]
+		def ge():
+			try:
+				return -(a() >= b())
+			except Exception as e:
+				raise placed(e, column) # Complex numbers don't compare
+		return ge
+
+	def expr_and(self, tree):
+		a, b = self.expression(tree[1]), self.expression(tree[2])
+		if self.ctx.short_circuit:
+			return lambda: 0 if a() == 0 else -(b() != 0)
+		def and_():
+			lside = a()
+			rside = -(b() != 0)
+			return -(lside != 0 and rside != 0)
+		return and_
+
+	def expr_or(self, tree):
+		a, b = self.expression(tree[1]), self.expression(tree[2])
+		if self.ctx.short_circuit:
+			return lambda: -1 if a() != 0 else -(b() != 0)
+		def or_():
+			lside = a()
+			rside = -(b() != 0)
+			return -(lside != 0 or rside != 0)
+		return or_
+
+	def expr_call(self, tree):
+		name = tree[1]
+		args = [self.expression(i) for i in tree[2]]
+		if name in self.ctx.functions and name not in self.ctx.function_code:
+			if lazy_iif(self.ctx, name, args):
+				a, b, c = args
+				return lambda: b() if a() != 0 else c()
+			return self.builtin_call(name, args, tree[3])
+		call = self.user_call(name, args, tree[3], tree[4])
+		found = self.inline_body(name)
+		if found is None or len(found[0]) != len(args):
+			return call
+		return self.inline(name, args, tree[3], call, found)
+
+	def builtin_call(self, name, args, column):
+		fn = self.ctx.functions[name]
+		if len(args) != len(self.ctx.function_args[name]):
+			def bad_call():
+				for i in args:
+					i()
+				raise located(RuntimeError("Bad argument count"), column)
+			return bad_call
+		elif len(args) == 0:
+			return fn
+		elif len(args) == 1:
+			a = args[0]
+			def call():
+				try:
+					return fn(a())
+				except Exception as e:
+					raise placed(e, column)
+		elif len(args) == 2:
+			a, b = args
+			def call():
+				try:
+					return fn(a(), b())
+				except Exception as e:
+					raise placed(e, column)
+		else:
+			def call():
+				try:
+					return fn(*[i() for i in args])
+				except Exception as e:
+					raise placed(e, column)
+		return call
+
+	def inline_body(self, name):
+		"""Return (argument names, body, first body token) for a function
+		whose calls can be inlined, or None."""
+		if name not in self.inlinable:
+			found = None
+			line_num = self.definitions.get(name)
+			if line_num is not None and line_num in self.ctx.program:
+				tree = find_def(parse_line(self.ctx.line_tokens(line_num),
+					self.fn_names, self.ctx.statements)[0], name)
+				if tree is not None and len(tree[4]) > 0 \
+						and count_nodes(tree[3]) <= inline_limit \
+						and name not in self.calls(tree[3], set()):
+					found = (tree[2], tree[3], tree[4][0])
+			self.inlinable[name] = found
+		return self.inlinable[name]
+
+	def calls(self, tree, found):
+		"""Add the user functions an expression calls, directly or not,
+		to the set found; return it."""
+		if tree[0] == "call":
+			name = tree[1]
+			line_num = self.definitions.get(name)
+			if name not in found and line_num is not None \
+					and line_num in self.ctx.program:
+				found.add(name)
+				body = find_def(parse_line(self.ctx.line_tokens(line_num),
+					self.fn_names, self.ctx.statements)[0], name)
+				if body is not None:
+					self.calls(body[3], found)
+			elif name not in self.ctx.functions:
+				found.add(name)
+			for i in tree[2]:
+				self.calls(i, found)
+		elif tree[0] not in ("num", "var"):
+			for i in tree[1:3]:
+				self.calls(i, found)
+		return found
+
+	def inline(self, name, args, column, call, found):
+		"""Run the body of a function right at the call site, as long as
+		the function is defined by the DEF FN line it was taken from;
+		otherwise make the call."""
+		function_code = self.ctx.function_code
+		argnames, tree, first = found
+		frame = [()]
+		body = FunctionBody(self.ctx, argnames, frame).expression(tree)
+		if len(args) == 1:
+			a = args[0]
+			values = lambda: (a(),)
+		elif len(args) == 2:
+			a, b = args
+			values = lambda: (a(), b())
+		else:
+			values = lambda: tuple([i() for i in args])
+		def inlined():
+			code = function_code.get(name)
+			if code is None or code[0] is not first:
+				return call()
+			frame[0] = values()
+			try:
+				return body()
+			except Exception as e:
+				e.column = column
+				raise
+		return inlined
+
+	def user_call(self, name, args, column, name_column):
+		ctx = self.ctx
+		# Until the function is defined, its name reads as a variable.
+		undefined = self.expr_var(("var", name, name_column))
+		def call():
+			function = ctx.compiled_functions.get(name)
+			if function is None:
+				if name not in ctx.function_code:
+					return undefined()
+				# Defined by the classic interpreter, not compiled yet.
+				function = compile_function(ctx, name)
+			values = [i() for i in args]
+			try:
+				return function(*values)
+			except Exception as e:
+				# Errors show up where the function was called.
+				e.column = column
+				raise
+		return call
+
+class FunctionBody(CompiledProgram):
+	"""Compiles the body of a DEF FN. Its arguments are slots in a frame,
+	one frame per call in progress, so calls never touch the variables
+	or parser state of the interpreter, and can nest or recurse."""
+
+	def __init__(self, ctx, argnames, frames):
+		self.ctx = ctx
+		self.slots = dict((n, i) for i, n in enumerate(argnames))
+		self.frames = frames
+		self.definitions = {} # Calls from here aren't inlined.
+		self.inlinable = {}
+
+	def expr_var(self, tree):
+		name = tree[1]
+		column = tree[2]
+		if name not in self.slots:
+			# Functions only see their own arguments.
+			def missing():
+				raise located(NameError("Var not found: " + name), column)
+			return missing
+		frames = self.frames
+		i = self.slots[name]
+		return lambda: frames[-1][i]
+
+def lazy_iif(ctx, name, args):
+	"""Whether a call is to IIF, to be run evaluating only the argument
+	it returns."""
+	return name == "iif" and ctx.short_circuit and len(args) == 3
+
+def make_function(ctx, argnames, tree):
+	"""Turn the syntax tree of a DEF FN body into a Python function
+	taking the arguments positionally."""
+	frames = []
+	body = FunctionBody(ctx, argnames, frames).expression(tree)
+	count = len(argnames)
+	def function(*args):
+		if len(args) != count:
+			raise RuntimeError("Bad argument count")
+		frames.append(args)
+		try:
+			return body()
+		finally:
+			frames.pop()
+	return function
+
+def find_def(tree, name):
+	"""The DEF FN statement for name in a line's syntax tree, or None."""
+	while tree is not None and tree[0] == "if":
+		tree = tree[2]
+	if tree is not None and tree[0] == "def" and tree[1] == name:
+		return tree
+	return None
+
+def count_nodes(tree):
+	if tree[0] == "call":
+		return 1 + sum(count_nodes(i) for i in tree[2])
+	elif tree[0] in ("num", "var"):
+		return 1
+	else:
+		return 1 + sum(count_nodes(i) for i in tree[1:3])
+
+def function_body(ctx, name):
+	"""Parse the body DEF FN stored for a function."""
+	return Parser(ctx.function_code[name], function_names(ctx)).parse_disjunction()
+
+def compile_function(ctx, name):
+	"""Compile a function defined by the classic interpreter, from the
+	tokens DEF FN stored for its body, and keep it for later calls."""
+	tree = function_body(ctx, name)
+	function = memoize(ctx, name,
+		make_function(ctx, ctx.function_args[name], tree), tree)
+	ctx.compiled_functions[name] = function
+	return function
+
+def is_pure(ctx, name, tree, body=None, seen=()):
+	"""Whether a function body only calls pure functions: built-ins in
+	ctx.pure_functions, itself, or user functions that are pure in turn.
+	Bodies can't see variables, so nothing else changes what they return.
+	The body of another function is found with body(name), or parsed from
+	ctx.function_code; functions not defined yet are taken as impure."""
+	kind = tree[0]
+	if kind == "call":
+		callee = tree[1]
+		if callee != name and callee not in seen: # Recursion is fine.
+			if body is not None:
+				callee_body = body(callee)
+			elif callee in ctx.function_code:
+				callee_body = function_body(ctx, callee)
+			else:
+				callee_body = None
+			if callee_body is None:
+				if callee not in ctx.pure_functions:
+					return False
+			elif not is_pure(ctx, callee, callee_body, body, seen + (name,)):
+				return False
+		return all(is_pure(ctx, name, i, body, seen) for i in tree[2])
+	elif kind in ("num", "var"):
+		return True
+	else:
+		return all(is_pure(ctx, name, i, body, seen) for i in tree[1:3])
+
+class Memo(object):
+	"""A pure user function with a cache of its results by arguments,
+	which drops the least recently used ones past a given size. A cache
+	that has been through its size in evictions while hitting less than
+	a quarter of the time is given up, to spare the calls its upkeep."""
+
+	__slots__ = ("function", "size", "results", "hits", "misses", "evictions")
+
+	def __init__(self, function, size):
+		self.function = function
+		self.size = size
+		self.results = collections.OrderedDict() # None once given up
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def __call__(self, *args):
+		results = self.results
+		if results is None or 0 in args:
+			# 0 and -0 would share an entry, but can print differently.
+			return self.function(*args)
+		value = results.get(args)
+		if value is not None:
+			self.hits += 1
+			results.move_to_end(args)
+			return value
+		self.misses += 1
+		value = results[args] = self.function(*args)
+		if len(results) > self.size:
+			results.popitem(False)
+			self.evictions += 1
+			if self.evictions >= self.size and self.hits * 3 < self.misses:
+				self.results = None
+		return value
+
+def memoize(ctx, name, function, tree, body=None):
+	"""Return the function wrapped in a Memo, kept in ctx.memos, if its
+	body is pure and ctx.memo_size allows; else the function itself."""
+	if ctx.memo_size <= 0 or not is_pure(ctx, name, tree, body):
+		return function
+	memo = Memo(function, ctx.memo_size)
+	ctx.memos[name] = memo
+	return memo
+
+# What the operators do to constants, just like the compiled code does.
+fold_ops = {
+	"+": operator.add, "-": operator.sub, "*": operator.mul,
+	"/": operator.truediv, "\\": operator.floordiv, "^": operator.pow,
+	"=": lambda a, b: -(a == b), "<>": lambda a, b: -(a != b),
+	"<": lambda a, b: -(a < b), "<=": lambda a, b: -(a <= b),
+	">": lambda a, b: -(a > b), ">=": lambda a, b: -(a >= b),
+	"and": lambda a, b: -(a != 0 and b != 0),
+	"or": lambda a, b: -(a != 0 or b != 0),
+}
+
+class Optimizer(object):
+	"""Simplifies syntax trees before they're compiled.
+
+	Parts made only of numbers, operators and calls to pure built-ins are
+	worked out beforehand, unless that fails or doesn't give a finite
+	number; those errors are left for when the line runs. A few identities
+	go too: x * 1, 1 * x, x - 0, x / 1 and x ^ 1 become x. (Not x + 0,
+	which turns -0 into 0, nor v ^ 2 into v * v, which overflows to
+	infinity where ** raises an error.)
+	With short-circuit evaluation, AND, OR and IIF with a constant first
+	operand are replaced by the operand they'd pick.
+	"""
+
+	def __init__(self, ctx):
+		self.ctx = ctx
+		self.removed = 0 # Syntax tree nodes, in all
+
+	def statement(self, tree):
+		kind = tree[0]
+		if kind == "let":
+			return ("let", tree[1], self.optimize(tree[2]))
+		elif kind == "print":
+			items = [i if i[0] == "str" else self.optimize(i) for i in tree[1]]
+			return ("print", items, tree[2])
+		elif kind == "if":
+			return ("if", self.optimize(tree[1]), self.statement(tree[2]))
+		elif kind in ("goto", "gosub"):
+			return (kind, self.optimize(tree[1]))
+		elif kind == "loop":
+			return ("loop", tree[1], self.optimize(tree[2]))
+		elif kind == "for":
+			step = tree[4] if tree[4] is None else self.optimize(tree[4])
+			return ("for", tree[1], self.optimize(tree[2]),
+				self.optimize(tree[3]), step)
+		elif kind == "def":
+			return ("def", tree[1], tree[2], self.optimize(tree[3])) + tree[4:]
+		elif kind == "randomize" and tree[1] is not None:
+			return ("randomize", self.optimize(tree[1]))
+		else:
+			return tree
+
+	def optimize(self, tree):
+		"""Return a simpler expression, and count the nodes that went."""
+		simpler = self.expression(tree)
+		if simpler is not tree:
+			self.removed += count_nodes(tree) - count_nodes(simpler)
+		return simpler
+
+	def expression(self, tree):
+		kind = tree[0]
+		if kind in ("num", "var"):
+			return tree
+		elif kind == "call":
+			return self.call(tree)
+		elif kind in ("neg", "not"):
+			a = self.expression(tree[1])
+			if a[0] == "num":
+				if kind == "neg":
+					return self.constant(tree, operator.neg, a[1])
+				else:
+					return self.constant(tree, lambda v: -(v == 0), a[1])
+			return tree if a is tree[1] else (kind, a)
+		a, b = self.expression(tree[1]), self.expression(tree[2])
+		if a[0] == "num" and b[0] == "num":
+			return self.constant((kind, a, b) + tree[3:], fold_ops[kind],
+				a[1], b[1])
+		elif a[0] == "num" and kind in ("and", "or") \
+				and self.ctx.short_circuit:
+			if kind == "and" and a[1] == 0:
+				return ("num", 0)
+			elif kind == "or" and a[1] != 0:
+				return ("num", -1)
+		elif b[0] == "num" and b[1] == 1 and kind in ("*", "/", "^"):
+			return a
+		elif b[0] == "num" and b[1] == 0 and kind == "-":
+			return a
+		elif a[0] == "num" and a[1] == 1 and kind == "*":
+			return b
+		if a is tree[1] and b is tree[2]:
+			return tree
+		return (kind, a, b) + tree[3:]
+
+	def call(self, tree):
+		ctx = self.ctx
+		name = tree[1]
+		args = [self.expression(i) for i in tree[2]]
+		if any(a is not b for a, b in zip(args, tree[2])):
+			tree = ("call", name, args) + tree[3:]
+		if name not in ctx.pure_functions or name in ctx.function_code \
+				or name not in ctx.functions \
+				or len(args) != len(ctx.function_args[name]):
+			return tree
+		elif lazy_iif(ctx, name, args) and args[0][0] == "num":
+			return args[1] if args[0][1] != 0 else args[2]
+		elif all(i[0] == "num" for i in args):
+			return self.constant(tree, ctx.functions[name],
+				*[i[1] for i in args])
+		return tree
+
+	def constant(self, tree, function, *args):
+		"""A number node for the function applied to the arguments, or the
+		tree unchanged if that doesn't work out."""
+		try:
+			value = function(*args)
+		except (ArithmeticError, ValueError, TypeError):
+			return tree
+		if type(value) not in (int, float) or not math.isfinite(value):
+			return tree
+		return ("num", value)
+
+binary_names = {
+	"+": "add", "-": "sub", "*": "mul", "/": "div", "\\": "floordiv",
+	"^": "pow", "=": "eq", "<>": "ne", "<": "lt", "<=": "le",
+	">": "gt", ">=": "ge",
+}
+
+def compile_program(ctx):
+	return CompiledProgram(ctx)
@@ -0,0 +1,51 @@
+#!/usr/bin/python3
+
+"""Measure GOTO and GOSUB latency as the stored program grows.
+
+Each generated program has `size` filler lines, then a loop at the very end
+that jumps backward with GOTO and calls a subroutine with GOSUB. Jump cost
+should stay flat no matter how many lines come before the loop.
+"""
+
+from __future__ import print_function
+
+import sys
+import time
+
+import basic
+import compiler
+
+jumps = 2000
+
+def make_program(interpreter, size):
+	interpreter.new_program()
+	for i in range(size):
+		interpreter.store_line(i + 1, "rem filler")
+	start = size + 1
+	interpreter.store_line(start, "let i = 0")
+	interpreter.store_line(start + 1, "let i = i + 1")
+	interpreter.store_line(start + 2, "gosub {}".format(start + 5))
+	interpreter.store_line(start + 3, "if i < {} then goto {}".format(jumps, start + 1))
+	interpreter.store_line(start + 4, "end")
+	interpreter.store_line(start + 5, "return")
+
+def measure(interpreter, engine):
+	interpreter.engine = engine
+	interpreter.reset_program()
+	interpreter.crt_line = interpreter.line_index[len(interpreter.program) - 5]
+	if engine == "closures":
+		# Compile up front, so only running the loop is timed.
+		interpreter.compiled = compiler.compile_program(interpreter)
+	mark = time.time()
+	interpreter.continue_program()
+	return (time.time() - mark) / (2 * jumps)
+
+if __name__ == "__main__":
+	sizes = [int(i) for i in sys.argv[1:]] or [100, 1000, 10000, 50000]
+	interpreter = basic.Interpreter()
+	print("lines", *basic.engines, sep="\t")
+	for size in sizes:
+		make_program(interpreter, size)
+		timings = ["{:.2f}us".format(measure(interpreter, i) * 1e6)
+			for i in basic.engines]
+		print(size, *timings, sep="\t")
@@ -0,0 +1,89 @@
+#!/usr/bin/python3
+
+"""Checks that AND, OR and IIF give what the short_circuit option says.
+
+Each program below prints one thing when every operand is evaluated and
+another when only those needed are. Run as a script to try them all on
+every engine and RUN FAST, with the option off and on, and print how
+long each took; the exit status is nonzero if any printed the wrong
+thing.
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import io
+import sys
+import time
+
+import basic
+
+# Programs for check_short_circuit(): name, source, and the start of the
+# output without and with short-circuiting. WORK(n) is a built-in that
+# returns n and counts the calls, which WORKED() gives back.
+short_circuit_checks = (
+	("and-guard",
+		"10 DEF FN f(x) = 10 / x\n"
+		"20 LET x = 0\n"
+		"30 IF x <> 0 AND f(x) > 1 THEN PRINT \"yes\"\n"
+		"40 PRINT \"done\"\n",
+		"float division by zero in line 30", "done\n"),
+	("iif-zero", "10 PRINT IIF(1, 0, 5)\n", "5\n", "0\n"),
+	("iif-recursive",
+		"10 DEF FN fact(n) = IIF(n < 2, 1, n * fact(n - 1))\n"
+		"20 PRINT fact(10)\n",
+		"maximum recursion depth exceeded", "3.6288e+06\n"),
+	("calls-skipped",
+		"10 LET n = 0\n"
+		"20 FOR i = 1 TO 1000\n"
+		"30 IF i > 2000 AND WORK(i) THEN PRINT i\n"
+		"40 IF i < 2000 OR WORK(i) THEN LET n = n + 1\n"
+		"50 NEXT i\n"
+		"60 PRINT n\n"
+		"70 PRINT WORKED()\n",
+		"1000\n2000\n", "1000\n0\n"),
+)
+
+def check_short_circuit(report=None):
+	"""Run the short_circuit_checks on every engine and RUN FAST, with the
+	option off and on, and return the list of (name, engine, option) that
+	printed something else. Report gets those and the time taken too."""
+	failed = []
+	for name, source, plain, short in short_circuit_checks:
+		for engine in basic.engines + ("fast",):
+			for option in (False, True):
+				interpreter = basic.Interpreter(
+					engine="classic" if engine == "fast" else engine)
+				interpreter.short_circuit = option
+				calls = [0]
+				def work(n):
+					calls[0] += 1
+					return n
+				interpreter.functions["work"] = work
+				interpreter.function_args["work"] = ["n"]
+				interpreter.functions["worked"] = lambda: calls[0]
+				interpreter.function_args["worked"] = []
+				interpreter.stdin = io.StringIO()
+				interpreter.stdout = io.StringIO()
+				interpreter.new_program()
+				interpreter.load_source(source)
+				mark = time.perf_counter()
+				if engine == "fast":
+					interpreter.run_fast()
+				else:
+					interpreter.run_program()
+				elapsed = time.perf_counter() - mark
+				ok = interpreter.stdout.getvalue().startswith(
+					short if option else plain)
+				if not ok:
+					failed.append((name, engine, option))
+				if report:
+					report(name, engine, option, ok, elapsed)
+	return failed
+
+if __name__ == "__main__":
+	failed = check_short_circuit(lambda name, engine, option, ok, elapsed:
+		print("{:<6} {:<14} {:<9} {:<5} {:.6f}s".format(
+			"ok" if ok else "FAIL", name, engine,
+			"-s" if option else "", elapsed)))
+	sys.exit(1 if failed else 0)
@@ -0,0 +1,363 @@
+#!/usr/bin/python3
+
+"""Tracing engine for Tinycat BASIC.
+
+Lines run in the classic interpreter, which counts the backward jumps made
+by NEXT, LOOP and GOTO. Once a loop has gone round often enough, the lines
+its next time round runs are recorded in order, along with where each went.
+That path becomes a Python function, compiled with exec, which goes round
+the loop for as long as the program keeps to it.
+
+Each IF that jumps is a guard: when it goes the other way, the function
+stops and the interpreter carries on at the line the jump leads to. It
+does the same when the loop ends, or when a line raises an error; in that
+case the interpreter runs the line again, to report the error as usual.
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import compiler
+import transpiler
+
+threshold = 50 # Times round a loop before it's traced
+max_length = 100 # Lines in a trace, at most
+max_attempts = 3 # Recordings that may fail before a loop is left alone
+
+# How a trace stopped
+EXIT, GUARD, ERROR = range(3)
+
+def statement_keyword(tokens):
+	"""The keyword of the statement a line finally runs, after any
+	IF ... THEN, or None."""
+	i = 0
+	if tokens[0][1] == "if":
+		for j in range(len(tokens) - 1, 0, -1):
+			if tokens[j][0] == "name" and tokens[j][1] == "then":
+				i = j + 1
+				break
+	if i < len(tokens) and tokens[i][0] == "name":
+		return tokens[i][1]
+	return None
+
+class Untraceable(Exception):
+	pass
+
+class Trace(object):
+	"""A compiled path through a loop, and how it has fared."""
+
+	__slots__ = (
+		"head", # Index of the first line in the loop
+		"lines", # Indices of the lines on the path, in order
+		"function",
+		"slots", # Slot of each variable the function keeps in a local
+		"fn_count", # How many functions were defined when compiled
+		"frame", # (FOR line, slot) of a NEXT loop, or None
+		"do_loop", # Whether it's a DO ... LOOP
+		"runs",
+		"rounds",
+		"guard_failures",
+	)
+
+	def __init__(self, head, lines):
+		self.head = head
+		self.lines = lines
+		self.function = None
+		self.slots = ()
+		self.fn_count = 0
+		self.frame = None
+		self.do_loop = False
+		self.runs = 0
+		self.rounds = 0
+		self.guard_failures = 0
+
+class TraceCompiler(transpiler.Transpiler):
+	"""Turns a recorded path into Python, translating expressions and
+	simple statements the way RUN FAST does."""
+
+	def __init__(self, ctx):
+		self.ctx = ctx
+		self.index = ctx.line_index
+		self.fn_names = set(ctx.function_args)
+		self.errors = {}
+		self.user_fns = dict(
+			(i, ctx.function_args[i]) for i in ctx.function_code)
+		self.variables = set()
+		self.temps = 0
+		self.optimizer = compiler.Optimizer(ctx)
+		self.dead = set() # Dead stores need the whole program
+		self.replaced = {}
+
+	def defined_call(self, name, call, scope):
+		# Only functions defined by now are called; fn_count guards that.
+		return call
+
+	def parse(self, i):
+		tokens = self.ctx.line_tokens(self.ctx.addr[i])
+		tree, column = compiler.parse_line(
+			tokens, self.fn_names, self.ctx.statements)
+		tree = self.optimizer.statement(tree)
+		if tree[0] == "if" and tree[2][0] == "if":
+			raise Untraceable("nested IF")
+		return tree
+
+	def jump(self, tree, threaded=True):
+		"""The index a GOTO with a constant target goes to, as it runs
+		fused, or else as it's written."""
+		if tree[0] != "goto" or tree[1][0] != "num":
+			raise Untraceable("computed GOTO")
+		line_num = int(tree[1][1])
+		if line_num not in self.index:
+			raise Untraceable("GOTO to a missing line")
+		if threaded:
+			return self.ctx.thread(self.index[line_num])
+		return self.index[line_num]
+
+	def trace(self, head, path):
+		"""Return the Trace for a path recorded as (index, next index)
+		pairs, going from the head round to it again."""
+		trace = Trace(head, [i for i, after in path])
+		body = []
+		indent = "\t\t\t"
+		for i, after in path[:-1]:
+			body.append("{}pc = {}".format(indent, i))
+			self.step(self.parse(i), i, after, body, indent)
+		i, after = path[-1]
+		body.append("{}pc = {}".format(indent, i))
+		self.back(trace, self.parse(i), i, body, indent)
+		names = sorted(self.variables)
+		slots = self.ctx.variables.slot
+		out = ["def trace(ctx, values, fors, do_stack):"]
+		out.append("\twrite = ctx.output.write")
+		for name in names:
+			out.append("\tv_{} = values[{}]".format(name, slots(name)))
+		if trace.frame is not None:
+			out.append("\tframe = fors[-1]")
+			out.append("\tstep = frame.step")
+			out.append("\tlimit = frame.limit")
+		out.append("\tpc = {}".format(head))
+		out.append("\trounds = 0")
+		out.append("\tstatus = {}".format(EXIT))
+		out.append("\ttry:")
+		out.append("\t\twhile True:")
+		out.append("\t\t\trounds += 1")
+		out.extend(body)
+		out.append("\texcept Exception:")
+		out.append("\t\tstatus = {}".format(ERROR))
+		out.append("\tfinally:")
+		for name in names:
+			out.append("\t\tvalues[{}] = v_{}".format(slots(name), name))
+		out.append("\treturn pc, status, rounds")
+		namespace = {"fmt": "{:1g}".format, "bad_count": bad_count}
+		for name, function in self.ctx.functions.items():
+			namespace["fn_" + name] = function
+		for name in self.user_fns:
+			namespace["fu_" + name] = self.ctx.compiled_functions.get(name) \
+				or compiler.compile_function(self.ctx, name)
+		code = compile("\n".join(out) + "\n", "<trace>", "exec")
+		exec(code, namespace)
+		trace.function = namespace["trace"]
+		trace.slots = tuple(slots(i) for i in names)
+		trace.fn_count = len(self.ctx.function_args)
+		return trace
+
+	def step(self, tree, i, after, out, indent):
+		"""A line in the middle of the path, which went on to after."""
+		kind = tree[0]
+		inner = transpiler.innermost(tree)
+		if inner[0] == "let":
+			self.variables.add(inner[1]) # To be stored when the trace ends
+		if kind in ("let", "print", "rem"):
+			self.statement(tree, i, out, indent)
+		elif kind == "goto":
+			if self.jump(tree) != after:
+				raise Untraceable("GOTO went elsewhere")
+		elif kind == "if" and tree[2][0] in ("let", "print", "rem"):
+			self.statement(tree, i, out, indent)
+		elif kind == "if" and tree[2][0] == "goto":
+			dest = self.jump(tree[2])
+			test = self.expr(tree[1])
+			if dest == i + 1:
+				out.append("{}{}".format(indent, test))
+			elif after in (dest, self.jump(tree[2], False)):
+				self.guard("{} == 0".format(test), i + 1, out, indent)
+			else:
+				self.guard("{} != 0".format(test), dest, out, indent)
+		else:
+			raise Untraceable(kind.upper())
+
+	def guard(self, test, dest, out, indent):
+		out.append("{}if {}:".format(indent, test))
+		out.append("{}\tpc = {}".format(indent, dest))
+		out.append("{}\tstatus = {}".format(indent, GUARD))
+		out.append("{}\tbreak".format(indent))
+
+	def leave(self, dest, out, indent):
+		out.append("{}pc = {}".format(indent, dest))
+		out.append("{}break".format(indent))
+
+	def back(self, trace, tree, i, out, indent):
+		"""The line at the end of the path, which jumped back to its head."""
+		kind = tree[0]
+		if kind == "next":
+			pair = self.ctx.next_pairs.get(i)
+			if pair is None or pair + 1 != trace.head:
+				raise Untraceable("NEXT of another loop")
+			var = "v_" + tree[1]
+			self.variables.add(tree[1])
+			trace.frame = (pair, self.ctx.variables.slot(tree[1]))
+			out.append("{}{} += step".format(indent, var))
+			out.append("{0}if {1} > limit if step > 0 else {1} < limit:"
+				.format(indent, var))
+			out.append(indent + "\tfors.pop()")
+			self.leave(i + 1, out, indent + "\t")
+		elif kind == "loop":
+			trace.do_loop = True
+			test = self.expr(tree[2])
+			if tree[1] == "while":
+				out.append("{}if {} == 0:".format(indent, test))
+			else:
+				out.append("{}if {} != 0:".format(indent, test))
+			out.append(indent + "\tdo_stack.pop()")
+			self.leave(i + 1, out, indent + "\t")
+		elif kind == "goto":
+			self.jump(tree)
+		elif kind == "if" and tree[2][0] == "goto":
+			self.jump(tree[2])
+			out.append("{}if {} == 0:".format(indent, self.expr(tree[1])))
+			self.leave(i + 1, out, indent + "\t")
+		else:
+			raise Untraceable(kind.upper())
+
+def bad_count(*args):
+	raise RuntimeError("Bad argument count")
+
+class TracingProgram(object):
+	"""Runs the program in the classic interpreter, with traced loops."""
+
+	def __init__(self, ctx):
+		self.ctx = ctx
+		self.traces = {} # By the index of their head
+		self.counts = {} # Backward jumps to each line
+		self.attempts = {} # Failed recordings of each loop
+		self.recording = None # (head, path) while recording
+		# Interpreted one at a time, NEXT lines come back here to count.
+		self.fused = []
+		for i in ctx.fused:
+			if i is not None and i[0] is ctx.run_next.__func__:
+				i = i[:3] + (False,)
+			self.fused.append(i)
+		self.back_edges = set()
+		for i, line_num in enumerate(ctx.addr):
+			keyword = statement_keyword(ctx.line_tokens(line_num))
+			if keyword in ("next", "loop", "goto"):
+				self.back_edges.add(i)
+
+	def update(self):
+		return False
+
+	def run(self):
+		ctx = self.ctx
+		ctx.stop = False
+		addr = ctx.addr
+		fused = self.fused
+		traces = self.traces
+		back_edges = self.back_edges
+		try:
+			while ctx.crt_line < len(addr) and not ctx.stop:
+				i = ctx.crt_line
+				if i in traces:
+					if self.recording is not None:
+						self.abandon()
+					self.enter(traces[i])
+					i = ctx.crt_line
+					if i >= len(addr):
+						break
+				ctx.crt_line = i + 1
+				if fused[i] is None or not fused[i][0](ctx, i, fused[i]):
+					ctx.tokens = ctx.line_tokens(addr[i])
+					ctx.cursor = 0
+					ctx.parse_statement()
+				after = ctx.crt_line
+				if self.recording is not None:
+					self.record(i, after)
+				elif after <= i and i in back_edges:
+					count = self.counts.get(after, 0) + 1
+					self.counts[after] = count
+					if count == threshold:
+						self.recording = (after, [])
+		except Exception as e:
+			self.recording = None
+			line_num = addr[getattr(e, "basic_index", i)]
+			ctx.print_error(e, "in line", line_num, "column", ctx.column())
+
+	def record(self, i, after):
+		head, path = self.recording
+		path.append((i, after))
+		if after == head and i in self.back_edges:
+			self.recording = None
+			try:
+				self.traces[head] = TraceCompiler(self.ctx).trace(head, path)
+			except (Untraceable, transpiler.Unsupported, SyntaxError):
+				self.give_up(head)
+		elif len(path) >= max_length or self.ctx.stop \
+				or any(j == after for j, k in path):
+			self.abandon()
+
+	def abandon(self):
+		self.give_up(self.recording[0])
+		self.recording = None
+
+	def give_up(self, head):
+		"""Count a failed recording; after too many, stop counting."""
+		self.attempts[head] = self.attempts.get(head, 0) + 1
+		if self.attempts[head] < max_attempts:
+			self.counts[head] = 0
+		else:
+			self.counts[head] = threshold
+
+	def enter(self, trace):
+		"""Run a trace if the state it was compiled for holds, and leave
+		crt_line where the interpreter should carry on."""
+		ctx = self.ctx
+		values = ctx.values
+		fors = ctx.for_stack
+		if len(ctx.function_args) != trace.fn_count:
+			trace.guard_failures += 1
+			return
+		for i in trace.slots:
+			if values[i] is None:
+				trace.guard_failures += 1
+				return
+		if trace.frame is not None:
+			if not fors or (fors[-1].line, fors[-1].slot) != trace.frame:
+				trace.guard_failures += 1
+				return
+		if trace.do_loop:
+			if not ctx.do_stack or ctx.do_stack[-1] != trace.head:
+				trace.guard_failures += 1
+				return
+		trace.runs += 1
+		pc, status, rounds = trace.function(ctx, values, fors, ctx.do_stack)
+		trace.rounds += rounds
+		if status == GUARD:
+			trace.guard_failures += 1
+		ctx.crt_line = pc
+
+	def report(self):
+		"""Print each trace: where it starts, how many lines it has, how
+		often it ran and went round, and how often its guards failed."""
+		ctx = self.ctx
+		print("{} traces compiled".format(len(self.traces)), file=ctx.output)
+		if self.traces:
+			print("{:>6} {:>6} {:>9} {:>11} {:>9}".format(
+				"line", "lines", "runs", "rounds", "guards"), file=ctx.output)
+		for head in sorted(self.traces):
+			trace = self.traces[head]
+			print("{:6d} {:6d} {:9d} {:11d} {:9d}".format(
+				ctx.addr[head], len(trace.lines), trace.runs, trace.rounds,
+				trace.guard_failures), file=ctx.output)
+		ctx.output.flush()
+
+def compile_program(ctx):
+	return TracingProgram(ctx)
@@ -0,0 +1,760 @@
+#!/usr/bin/python3
+
+"""Whole-program BASIC to Python translator for Tinycat BASIC (RUN FAST).
+
+The stored program becomes the source of one Python function. BASIC
+variables are its locals, line numbers are cases of a dispatch loop, and
+built-in functions are bound to locals up front. FOR ... NEXT and DO ... LOOP
+blocks whose bodies can't be jumped into or out of run as Python loops.
+
+Differences from the interpreters: a user function can be called before its
+DEF FN line has run, and statements added by an embedding program are not
+supported (compiling such a program raises Unsupported).
+"""
+
+from __future__ import division
+from __future__ import print_function
+
+import re
+
+import cfg
+import compiler
+
+class Unsupported(Exception):
+	pass
+
+class Transpiler(object):
+	"""Turns the program stored in ctx into Python source."""
+
+	def __init__(self, ctx):
+		self.ctx = ctx
+		self.addr = list(ctx.addr)
+		self.index = dict((n, i) for i, n in enumerate(self.addr))
+		self.fn_names = compiler.function_names(ctx)
+		self.trees = []
+		self.errors = {}
+		self.user_fns = {}
+		self.variables = set()
+		self.temps = 0
+		self.optimizer = compiler.Optimizer(ctx)
+		self.replaced = {} # id() of a subtree -> the local holding its value
+		self.hoisted = [] # What was moved out of loops, for a report
+		self.plans = {} # Result of plan_loop() for each FOR line
+		for i, line_num in enumerate(self.addr):
+			try:
+				tree, column = compiler.parse_line(
+					ctx.line_tokens(line_num),
+					self.fn_names,
+					ctx.statements)
+				tree = self.optimizer.statement(tree)
+			except Exception as e:
+				self.errors[i] = e
+				tree = None
+			self.trees.append(tree)
+			self.scan(tree)
+		# LETs whose value is never read are left out.
+		self.dead = cfg.FlowGraph(ctx, self.trees).dead_stores()
+		self.entries = self.find_entries()
+		self.blocks = {}
+		self.find_blocks()
+		# Loop bodies that don't run as Python loops are jumped back to.
+		for i, tree in enumerate(self.trees):
+			inner = innermost(tree)
+			if inner and inner[0] in ("for", "do") and i not in self.blocks:
+				self.entries.add(i + 1)
+
+	def scan(self, tree):
+		if tree is None:
+			return
+		kind = tree[0]
+		if kind == "classic":
+			raise Unsupported("RUN FAST can't compile " + tree[1].upper())
+		elif kind in ("let", "for", "next"):
+			self.variables.add(tree[1])
+		elif kind == "input":
+			self.variables.update(tree[2])
+		elif kind == "if":
+			self.scan(tree[2])
+		elif kind == "def":
+			self.user_fns[tree[1]] = tree[2]
+
+	def targets(self, tree):
+		"""Constant jump targets of a statement, or None if computed."""
+		if tree is None:
+			return []
+		elif tree[0] == "if":
+			return self.targets(tree[2])
+		elif tree[0] in ("goto", "gosub"):
+			if tree[1][0] == "num":
+				return [self.index.get(int(tree[1][1]))]
+			else:
+				return None
+		else:
+			return []
+
+	def find_entries(self):
+		"""Indices of lines that can be reached other than by falling in."""
+		entries = set([0])
+		for i, tree in enumerate(self.trees):
+			targets = self.targets(tree)
+			if targets is None:
+				# A computed jump could land anywhere.
+				return set(range(len(self.trees) + 1))
+			entries.update(t for t in targets if t is not None)
+			inner = innermost(tree)
+			if inner is not None and inner[0] in ("gosub", "stop"):
+				entries.add(i + 1)
+		return entries
+
+	def find_blocks(self):
+		"""Map FOR and DO lines that can run as Python loops to their end."""
+		open_blocks = []
+		for i, tree in enumerate(self.trees):
+			kind = tree[0] if tree else None
+			if kind in ("for", "do"):
+				open_blocks.append(i)
+			elif kind in ("next", "loop") and open_blocks:
+				start = open_blocks.pop()
+				opener = self.trees[start]
+				if kind == "next" and (
+						opener[0] != "for" or opener[1] != tree[1]):
+					open_blocks = []
+				elif kind == "loop" and opener[0] != "do":
+					open_blocks = []
+				elif self.inlinable(start + 1, i):
+					self.blocks[start] = i
+			elif not self.straight(tree):
+				open_blocks = []
+
+	def straight(self, tree):
+		"""Whether a statement always falls through to the next line."""
+		if tree is None:
+			return False
+		elif tree[0] == "if":
+			return self.straight(tree[2])
+		else:
+			return tree[0] in (
+				"let", "print", "input", "rem", "randomize")
+
+	def inlinable(self, first, last):
+		for i in range(first, last + 1):
+			if i in self.entries:
+				return False
+		i = first
+		while i < last:
+			if i in self.blocks:
+				i = self.blocks[i] + 1
+			elif self.straight(self.trees[i]):
+				i += 1
+			else:
+				return False
+		return True
+
+	# Code generation
+
+	def temp(self, prefix):
+		self.temps += 1
+		return "_{}{}".format(prefix, self.temps)
+
+	def source(self):
+		# Each line reachable by a jump starts a new case of the dispatch
+		# loop; other lines are only reached by falling in from above.
+		body = []
+		i = 0
+		while i < len(self.trees):
+			if i in self.entries:
+				body.append("\t\t\tif pc == {}:".format(i))
+			else:
+				body.append("\t\t\t\tpc = {}".format(i))
+			i = self.line(i, body, "\t\t\t\t")
+			if i in self.entries or i == len(self.trees):
+				body.append("\t\t\t\tpc = {}".format(i))
+		functions = []
+		for name, args in sorted(self.user_fns.items()):
+			functions.append("\tdef fu_{}({}):".format(
+				name, ", ".join("v_" + i for i in args)))
+			functions.append("\t\treturn " + self.expr(
+				self.fn_body(name), args))
+			functions.append("\tfu_{0} = memoize({0!r}, fu_{0})".format(name))
+		out = []
+		out.append("def basic_program(ctx, pc):")
+		out.append("\tvariables = ctx.variables")
+		out.append("\tstack = ctx.stack")
+		out.append("\tdo_stack = ctx.do_stack")
+		out.append("\tfors = ctx.for_stack")
+		out.append("\twrite = ctx.output.write")
+		out.append("\tfunction_code = ctx.function_code")
+		for name in sorted(self.ctx.functions):
+			out.append("\tfn_{0} = functions[{0!r}]".format(name))
+		out.extend(functions)
+		for name in sorted(self.variables):
+			out.append("\tif {0!r} in variables: v_{0} = variables[{0!r}]"
+				.format(name))
+		out.append("\ttry:")
+		out.append("\t\twhile pc < {}:".format(len(self.trees)))
+		out.extend(body or ["\t\t\tpass # No program"])
+		out.append("\texcept Exception as e:")
+		out.append("\t\te.basic_index = pc")
+		out.append("\t\traise")
+		out.append("\tfinally:")
+		out.append("\t\tsave(locals())")
+		out.append("\treturn pc")
+		return "\n".join(out) + "\n"
+
+	def fn_body(self, name):
+		for tree in self.trees:
+			tree = innermost(tree)
+			if tree is not None and tree[0] == "def" and tree[1] == name:
+				return tree[3]
+
+	def line(self, i, out, indent):
+		"""Emit line i, and return the index of the next line to emit."""
+		out.append("{}# {} {}".format(
+			indent, self.addr[i], self.ctx.program.get(self.addr[i], "")))
+		if i in self.errors:
+			out.append(indent + "raise errors[{}]".format(i))
+			return i + 1
+		if i in self.blocks:
+			return self.block(i, out, indent)
+		self.statement(self.trees[i], i, out, indent)
+		return i + 1
+
+	def block(self, i, out, indent):
+		end = self.blocks[i]
+		tree = self.trees[i]
+		inner = indent + "\t"
+		if tree[0] == "for":
+			var = "v_" + tree[1]
+			limit = self.temp("limit")
+			step = self.temp("step")
+			out.append("{}{} = {}".format(indent, var, self.expr(tree[2])))
+			out.append("{}{} = {}".format(indent, limit, self.expr(tree[3])))
+			if tree[4] is None:
+				sign = 1
+				by = "1"
+			elif constant(tree[4]):
+				sign = 1 if constant(tree[4]) > 0 else -1
+				by = number(constant(tree[4]))
+			else:
+				sign = 0
+				by = step
+				out.append("{}{} = {}".format(indent, step, self.expr(tree[4])))
+				out.append("{}if {} == 0: raise ValueError('Infinite loop')"
+					.format(indent, step))
+			if sign > 0:
+				test = "{} > {}".format(var, limit)
+			elif sign < 0:
+				test = "{} < {}".format(var, limit)
+			else:
+				test = "({0} > {1} if {2} > 0 else {0} < {1})".format(
+					var, limit, step)
+			# Products can only be added up exactly with a whole step.
+			whole = sign != 0 and float(constant(tree[4] or ("num", 1))) \
+				.is_integer()
+			hoists, products = self.plan_loop(i, end, whole)
+			if not hoists and not products:
+				self.for_loop(i, end, var, by, test, (), out, indent)
+				return end + 1
+			# Work out what doesn't change beforehand. If anything fails,
+			# or adding up products might not give the same numbers, run
+			# the loop as it is, so that it fails in the same place.
+			fast = self.temp("fast")
+			out.append(indent + "try:")
+			for subtree, local in hoists:
+				out.append("{}{} = {}".format(inner, local, self.expr(subtree)))
+				self.replaced[id(subtree)] = local
+			checks = ["exact_steps({}, {}, {}, {})".format(
+				var, limit, by, self.expr(factor))
+				for subtree, factor, local, delta in products]
+			out.append("{}{} = {}".format(inner, fast,
+				" and ".join(checks) or "True"))
+			out.append(indent + "except Exception:")
+			out.append("{}{} = False".format(inner, fast))
+			out.append("{}if {}:".format(indent, fast))
+			updates = []
+			for subtree, factor, local, delta in products:
+				out.append("{}{} = {} * {}".format(
+					inner, local, var, self.expr(factor)))
+				out.append("{}{} = {} * {}".format(
+					inner, delta, by, self.expr(factor)))
+				updates.append("{} += {}".format(local, delta))
+				self.replaced[id(subtree)] = local
+			self.for_loop(i, end, var, by, test, updates, out, inner)
+			for subtree, local in hoists:
+				del self.replaced[id(subtree)]
+			for subtree, factor, local, delta in products:
+				del self.replaced[id(subtree)]
+			out.append(indent + "else:")
+			self.for_loop(i, end, var, by, test, (), out, inner)
+		else:
+			loop = self.trees[end]
+			out.append(indent + "while True:")
+			self.body(i + 1, end, out, inner)
+			out.append("{}pc = {}".format(inner, end))
+			if loop[1] == "while":
+				out.append("{}if not ({}): break".format(
+					inner, self.expr(loop[2])))
+			else:
+				out.append("{}if {}: break".format(inner, self.expr(loop[2])))
+		return end + 1
+
+	def for_loop(self, i, end, var, by, test, updates, out, indent):
+		inner = indent + "\t"
+		out.append(indent + "while True:")
+		self.body(i + 1, end, out, inner)
+		out.append("{}pc = {}".format(inner, end))
+		out.append("{}{} += {}".format(inner, var, by))
+		for update in updates:
+			out.append(inner + update)
+		out.append("{}if {}: break".format(inner, test))
+
+	def plan_loop(self, i, end, reduce):
+		"""Find what the lines right inside the FOR loop at line i work
+		out the same way every time round: return a list of (subtree,
+		local) to work out before the loop, and one of (product, factor,
+		local, delta) for multiplications of the loop variable by
+		something that doesn't change, which can be kept up to date by
+		adding delta each time round (if reduce is true and the body
+		never sets the loop variable itself)."""
+		if i in self.plans:
+			return self.plans[i]
+		name = self.trees[i][1]
+		assigned = set()
+		for j in range(i + 1, end):
+			inner = innermost(self.trees[j])
+			if inner is None:
+				return [], []
+			elif inner[0] in ("let", "for", "next"):
+				assigned.add(inner[1])
+			elif inner[0] == "input":
+				assigned.update(inner[2])
+		if name in assigned:
+			reduce = False
+		assigned.add(name)
+		hoists, products = [], []
+		j = i + 1
+		while j < end:
+			if j in self.blocks:
+				j = self.blocks[j] + 1
+				continue
+			found = []
+			for expr in evaluated(self.trees[j]):
+				self.invariants(expr, assigned, name, reduce, found)
+			for subtree, factor in found:
+				line_num = self.addr[j]
+				if factor is None:
+					hoists.append((subtree, self.temp("hoist")))
+					self.hoisted.append((line_num, self.addr[i],
+						"hoisted", basic_text(subtree)))
+				else:
+					if not simple(factor):
+						hoists.append((factor, self.temp("hoist")))
+					products.append((subtree, factor, self.temp("product"),
+						self.temp("delta")))
+					self.hoisted.append((line_num, self.addr[i],
+						"reduced to additions", basic_text(subtree)))
+			j += 1
+		self.plans[i] = hoists, products
+		return hoists, products
+
+	def invariants(self, tree, assigned, name, reduce, found):
+		"""Add (subtree, None) to found for the largest parts of tree that
+		come out the same every time round, with at least one variable or
+		call in them, and (product, factor) for each multiplication of the
+		loop variable by such a part, a variable or a number."""
+		if self.invariant(tree, assigned):
+			if not simple(tree) and has_names(tree):
+				found.append((tree, None))
+			return
+		kind = tree[0]
+		if reduce and kind == "*":
+			for var, factor in ((tree[1], tree[2]), (tree[2], tree[1])):
+				if var[0] == "var" and var[1] == name \
+						and self.invariant(factor, assigned):
+					found.append((tree, factor))
+					return
+		if self.lazy(tree):
+			# Only what's always worked out; the rest may be skipped.
+			children = [tree[2][0] if kind == "call" else tree[1]]
+		elif kind == "call":
+			children = tree[2]
+		elif kind in ("neg", "not"):
+			children = [tree[1]]
+		elif kind in ("num", "var"):
+			children = []
+		else:
+			children = [tree[1], tree[2]]
+		for child in children:
+			self.invariants(child, assigned, name, reduce, found)
+
+	def invariant(self, tree, assigned):
+		"""Whether an expression comes out the same every time round a
+		loop that sets the variables in assigned: it doesn't read them,
+		and only calls pure functions. AND, OR and IIF don't count when
+		they short-circuit, so what they'd skip isn't worked out early."""
+		kind = tree[0]
+		if self.lazy(tree):
+			return False
+		elif kind == "var":
+			return tree[1] not in assigned
+		elif kind == "num":
+			return True
+		elif kind == "call":
+			return all(self.invariant(i, assigned) for i in tree[2]) \
+				and compiler.is_pure(self.ctx, None, tree, self.fn_body)
+		elif kind in ("neg", "not"):
+			return self.invariant(tree[1], assigned)
+		else:
+			return self.invariant(tree[1], assigned) \
+				and self.invariant(tree[2], assigned)
+
+	def lazy(self, tree):
+		"""Whether part of an expression may be skipped."""
+		if tree[0] == "call":
+			return compiler.lazy_iif(self.ctx, tree[1], tree[2])
+		return tree[0] in ("and", "or") and self.ctx.short_circuit
+
+	def body(self, first, last, out, indent):
+		i = first
+		while i < last:
+			out.append("{}pc = {}".format(indent, i))
+			i = self.line(i, out, indent)
+
+	def statement(self, tree, i, out, indent):
+		kind = tree[0]
+		if kind == "rem":
+			out.append(indent + "pass")
+		elif kind == "let" and i in self.dead and tree is self.trees[i]:
+			out.append(indent + "pass # Dead store")
+		elif kind == "let":
+			out.append("{}v_{} = {}".format(indent, tree[1], self.expr(tree[2])))
+		elif kind == "print":
+			items = [self.item(j) for j in tree[1]]
+			if tree[2] or not tree[1]:
+				items.append(repr("\n"))
+			out.append("{}write({})".format(indent, " + ".join(items)))
+		elif kind == "input":
+			out.append("{}ctx.input_values({!r}, {!r})".format(
+				indent, tree[1], tree[2]))
+			for name in tree[2]:
+				out.append("{0}v_{1} = variables[{1!r}]".format(indent, name))
+		elif kind == "if":
+			out.append("{}if {} != 0:".format(indent, self.expr(tree[1])))
+			self.statement(tree[2], i, out, indent + "\t")
+		elif kind == "error":
+			self.errors[i, "then"] = tree[1]
+			out.append("{}raise errors[{}, 'then']".format(indent, i))
+		elif kind == "goto":
+			out.append("{}pc = {}".format(indent, self.target(tree[1])))
+			out.append(indent + "continue")
+		elif kind == "gosub":
+			out.append("{}dest = {}".format(indent, self.target(tree[1])))
+			out.append("{}stack.append({})".format(indent, i + 1))
+			out.append(indent + "pc = dest")
+			out.append(indent + "continue")
+		elif kind == "return":
+			out.append(indent + "if not stack: raise RuntimeError('RETURN without GOSUB')")
+			out.append(indent + "pc = stack.pop()")
+			out.append(indent + "continue")
+		elif kind == "end":
+			out.append("{}pc = {}".format(indent, compiler.END))
+			out.append(indent + "continue")
+		elif kind == "stop":
+			out.append(indent + "ctx.stop = True")
+			out.append("{}return {}".format(indent, i + 1))
+		elif kind == "do":
+			out.append("{}do_stack.append({})".format(indent, i + 1))
+		elif kind == "loop":
+			test = self.expr(tree[2])
+			if tree[1] == "until":
+				test = "not ({})".format(test)
+			out.append("{}repeat = {}".format(indent, test))
+			out.append(indent + "if not do_stack: raise RuntimeError('LOOP without DO')")
+			out.append(indent + "if repeat:")
+			out.append(indent + "\tpc = do_stack[-1]")
+			out.append(indent + "\tcontinue")
+			out.append(indent + "do_stack.pop()")
+		elif kind == "for":
+			var = "v_" + tree[1]
+			out.append("{}{} = {}".format(indent, var, self.expr(tree[2])))
+			out.append("{}limit = {}".format(indent, self.expr(tree[3])))
+			if tree[4] is None:
+				out.append(indent + "step = 1")
+			else:
+				out.append("{}step = {}".format(indent, self.expr(tree[4])))
+				out.append(indent + "if step == 0: raise ValueError('Infinite loop')")
+			out.append("{}ctx.start_loop({}, {}, limit, step)".format(
+				indent, i, self.ctx.variables.slot(tree[1])))
+		elif kind == "next":
+			var = "v_" + tree[1]
+			pair = self.ctx.next_pairs.get(i)
+			out.append("{}if fors and fors[-1].line == {}:".format(indent, pair))
+			out.append(indent + "\tframe = fors[-1]")
+			out.append(indent + "else:")
+			out.append("{}\tframe = ctx.find_loop({}, {})".format(
+				indent, pair, self.ctx.variables.slot(tree[1])))
+			out.append("{}{} += frame.step".format(indent, var))
+			out.append("{0}if {1} > frame.limit if frame.step > 0 else {1} < frame.limit:"
+				.format(indent, var))
+			out.append(indent + "\tfors.pop()")
+			out.append(indent + "else:")
+			out.append(indent + "\tpc = frame.line + 1")
+			out.append(indent + "\tcontinue")
+		elif kind == "def":
+			out.append("{}define({!r}, {!r}, {})".format(
+				indent, tree[1], tree[2], i))
+		elif kind == "randomize":
+			if tree[1] is None:
+				out.append(indent + "ctx.rng.seed()")
+			else:
+				out.append("{}ctx.rng.seed(int({}))".format(
+					indent, self.expr(tree[1])))
+
+	def defined_call(self, name, call, scope):
+		"""A call to a user function, which until its DEF FN has run is
+		only a variable, the way the interpreter reads it."""
+		if scope is not None:
+			undefined = "novar({!r})".format(name)
+		else:
+			self.variables.add(name)
+			undefined = "v_" + name
+		return "({} if {!r} in function_code else {})".format(
+			call, name, undefined)
+
+	def target(self, tree):
+		if tree[0] == "num":
+			line_num = int(tree[1])
+			if line_num in self.index:
+				return str(self.index[line_num])
+		return "target(int({}))".format(self.expr(tree))
+
+	def item(self, tree):
+		if tree[0] == "str":
+			return repr(tree[1])
+		else:
+			return "fmt({})".format(self.expr(tree))
+
+	def expr(self, tree, scope=None):
+		kind = tree[0]
+		if scope is None and id(tree) in self.replaced:
+			return self.replaced[id(tree)]
+		elif kind == "num":
+			return number(tree[1])
+		elif kind == "var":
+			if scope is not None and tree[1] not in scope:
+				return "novar({!r})".format(tree[1])
+			elif scope is None:
+				self.variables.add(tree[1])
+			return "v_" + tree[1]
+		elif kind == "neg":
+			return "(-{})".format(self.expr(tree[1], scope))
+		elif kind == "not":
+			return "(-({} == 0))".format(self.expr(tree[1], scope))
+		elif kind == "call":
+			args = ", ".join(self.expr(i, scope) for i in tree[2])
+			name = tree[1]
+			if name in self.user_fns:
+				expected = len(self.user_fns[name])
+				prefix = "fu_"
+			elif name in self.ctx.functions:
+				expected = len(self.ctx.function_args[name])
+				prefix = "fn_"
+			elif scope is not None:
+				return "novar({!r})".format(name)
+			else:
+				self.variables.add(name)
+				return "v_" + name
+			if expected != len(tree[2]):
+				call = "bad_count({})".format(args)
+			elif prefix == "fn_" and compiler.lazy_iif(self.ctx, name, tree[2]):
+				a, b, c = [self.expr(i, scope) for i in tree[2]]
+				return "({} if {} != 0 else {})".format(b, a, c)
+			else:
+				call = "{}{}({})".format(prefix, name, args)
+			if prefix == "fu_":
+				return self.defined_call(name, call, scope)
+			return call
+		elif kind in ("and", "or") and self.ctx.short_circuit:
+			return "(-(({} != 0) {} ({} != 0)))".format(
+				self.expr(tree[1], scope), kind, self.expr(tree[2], scope))
+		elif kind == "and":
+			return "(-(({} != 0) & ({} != 0)))".format(
+				self.expr(tree[1], scope), self.expr(tree[2], scope))
+		elif kind == "or":
+			return "(-(({} != 0) | ({} != 0)))".format(
+				self.expr(tree[1], scope), self.expr(tree[2], scope))
+		elif kind in python_ops:
+			op = python_ops[kind]
+			text = "({} {} {})".format(
+				self.expr(tree[1], scope), op, self.expr(tree[2], scope))
+			if kind in compiler.relations:
+				return "(-{})".format(text)
+			return text
+		else:
+			raise Unsupported("Unknown expression: " + kind)
+
+def innermost(tree):
+	"""The statement an IF ... THEN finally runs, or the statement itself."""
+	while tree is not None and tree[0] == "if":
+		tree = tree[2]
+	return tree
+
+def constant(tree):
+	"""The value of a number, maybe negated, or None."""
+	if tree[0] == "num":
+		return tree[1]
+	elif tree[0] == "neg" and tree[1][0] == "num":
+		return -tree[1][1]
+	else:
+		return None
+
+def number(value):
+	"""A number as Python source. The optimizer folds -2 into a negative
+	constant, which must keep its parentheses: -2.0 ** x is -(2.0 ** x)."""
+	if repr(value).startswith("-"):
+		return "({!r})".format(value)
+	return repr(value)
+
+def simple(tree):
+	"""Whether an expression is just a variable or a number."""
+	return tree[0] in ("var", "num")
+
+def evaluated(tree):
+	"""The expressions a statement works out every time it runs, not
+	counting those behind an IF."""
+	if tree is None:
+		return []
+	kind = tree[0]
+	if kind == "let":
+		return [tree[2]]
+	elif kind == "print":
+		return [i for i in tree[1] if i[0] != "str"]
+	elif kind == "if":
+		return [tree[1]]
+	else:
+		return []
+
+def has_names(tree):
+	"""Whether an expression reads a variable or calls a function."""
+	kind = tree[0]
+	if kind in ("var", "call"):
+		return True
+	elif kind == "num":
+		return False
+	return any(has_names(i) for i in tree[1:3])
+
+def basic_text(tree):
+	"""An expression written out the way it could be in a program."""
+	kind = tree[0]
+	if kind == "num":
+		return "{:1g}".format(tree[1])
+	elif kind == "var":
+		return tree[1].upper()
+	elif kind == "neg":
+		return "-" + operand_text(tree[1])
+	elif kind == "not":
+		return "NOT " + operand_text(tree[1])
+	elif kind == "call":
+		return "{}({})".format(tree[1].upper(), ", ".join(
+			basic_text(i) for i in tree[2]))
+	else:
+		return "{} {} {}".format(operand_text(tree[1]), kind.upper(),
+			operand_text(tree[2]))
+
+def operand_text(tree):
+	if tree[0] == "num" and tree[1] < 0:
+		return "(" + basic_text(tree) + ")"
+	elif tree[0] in ("num", "var", "call"):
+		return basic_text(tree)
+	return "(" + basic_text(tree) + ")"
+
+def exact_steps(start, limit, step, factor):
+	"""Whether, in a FOR loop, adding step * factor to start * factor each
+	time round gives exactly the loop variable times factor: everything
+	is a whole number, nothing gets near 2^53, and the loop variable only
+	starts at 0, if ever, so there's no -0 to tell apart from 0."""
+	for i in (start, step, factor):
+		if not float(i).is_integer():
+			return False
+	if not (start >= 0 and step > 0 or start <= 0 and step < 0):
+		return False
+	bound = max(abs(start), abs(limit) + abs(step)) * abs(factor)
+	return bound < 2.0 ** 53
+
+python_ops = {
+	"+": "+", "-": "-", "*": "*", "/": "/", "\\": "//", "^": "**",
+	"=": "==", "<>": "!=", "<": "<", "<=": "<=", ">": ">", ">=": ">=",
+}
+
+unbound = re.compile(r"'v_(\w+)'")
+
+class FastProgram(object):
+	"""The stored program compiled to one Python function."""
+
+	def __init__(self, ctx):
+		self.ctx = ctx
+		transpiler = Transpiler(ctx)
+		self.source = transpiler.source()
+		self.hoisted = transpiler.hoisted
+		self.addr = transpiler.addr
+		index = transpiler.index
+
+		def target(line_num):
+			try:
+				return index[line_num]
+			except KeyError:
+				raise ValueError("Line not found: " + str(line_num))
+
+		def novar(name):
+			raise NameError("Var not found: " + name)
+
+		def bad_count(*args):
+			raise RuntimeError("Bad argument count")
+
+		def define(name, args, i):
+			if name in ctx.function_args:
+				raise RuntimeError("Duplicate function: " + name)
+			ctx.function_args[name] = args
+			ctx.function_code[name] = innermost(transpiler.trees[i])[4]
+
+		def memoize(name, function):
+			return compiler.memoize(ctx, name, function,
+				transpiler.fn_body(name), transpiler.fn_body)
+
+		def save(scope):
+			for name, value in scope.items():
+				if name.startswith("v_"):
+					ctx.variables[name[2:]] = value
+
+		namespace = {
+			"functions": ctx.functions,
+			"errors": transpiler.errors,
+			"fmt": "{:1g}".format,
+			"target": target,
+			"novar": novar,
+			"bad_count": bad_count,
+			"define": define,
+			"memoize": memoize,
+			"save": save,
+			"exact_steps": exact_steps,
+		}
+		code = compile(self.source, "<RUN FAST>", "exec")
+		exec(code, namespace)
+		self.function = namespace["basic_program"]
+
+	def run(self):
+		ctx = self.ctx
+		ctx.stop = False
+		try:
+			ctx.crt_line = min(self.function(ctx, ctx.crt_line), len(self.addr))
+		except Exception as e:
+			i = getattr(e, "basic_index", ctx.crt_line)
+			ctx.crt_line = i + 1
+			if isinstance(e, UnboundLocalError):
+				found = unbound.search(str(e))
+				if found:
+					e = NameError("Var not found: " + found.group(1))
+			ctx.print_error(e, "in line", self.addr[i])
+
+def compile_program(ctx):
+	return FastProgram(ctx)